@@ -0,0 +1,435 @@
+#! /usr/bin/env python
+#
+# Copyright Solarflare Communications Inc., 2012-13
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of Solarflare Communications Inc. nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL SOLARFLARE COMMUNICATIONS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Control BINDER ovens from an asyncio event loop
+
+This provides AsyncOvenCtl, a coroutine-based equivalent of ovenctl.OvenCtl,
+so that a single event loop can drive many ovens (and other I/O) without
+needing a thread per oven.  It shares the MODBus codec, register map and
+safety checks with ovenctl; see there for details of the protocol.
+
+This module is written for trollius, the Python 2 port of asyncio, since
+ovenctl itself is Python 2 code.  Coroutines therefore use 'yield From(...)'
+and 'raise Return(...)' rather than 'await' and 'return'.
+
+class AsyncOvenCtl is the main class
+  Key methods (all coroutines):
+    get_mode, set_mode_idle, set_mode_active: as OvenCtl
+    get_temp, get_setpoint, set_setpoint: as OvenCtl
+    check_safety: as OvenCtl
+    snapshot: as OvenCtl
+    wait_for_temp: as OvenCtl, but sleeps with asyncio.sleep, and leaves
+     its estimate of the time to temp in self.eta
+  Differences from OvenCtl:
+    bedew_protection is not a property (as a property can't be a
+     coroutine); use get_bedew_protection and set_bedew_protection
+    There is no session mode or cache; each transaction has its own
+     connection.  Transactions on one oven are serialised by self.lock
+    A response timeout raises socket.timeout, as it would for OvenCtl"""
+import socket, time
+import trollius as asyncio
+from trollius import From, Return
+import ovenctl
+
+class AsyncOvenCtl(object):
+    """Control a single oven, asynchronously"""
+    def __init__(self, hostname, port=ovenctl.BINDER_PORT, timeout=2.5,
+                 retries=3, loop=None):
+        """Construct an AsyncOvenCtl instance to control an oven
+        
+        Parameters:
+            hostname: the hostname or IP address of the oven
+            port: the port to connect on (default 10001)
+            timeout: the connect and response timeout in seconds (default 2.5)
+            retries: the number of times to retry connection
+            loop: the event loop to use (default asyncio.get_event_loop())"""
+        self.hostname = hostname
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.lock = asyncio.Lock(loop=self.loop)
+        # read_registers planning; see ovenctl.plan_reads
+        self.plan_max_gap = ovenctl.PLAN_MAX_GAP
+        self.plan_max_words = ovenctl.PLAN_MAX_WORDS
+        self.bad_gaps = set()
+        self.eta = None # see wait_for_temp
+
+    @asyncio.coroutine
+    def _wait(self, coro):
+        """Run coro with our timeout, raising socket.timeout if it expires"""
+        try:
+            result = yield From(asyncio.wait_for(coro, self.timeout,
+                                                 loop=self.loop))
+        except asyncio.TimeoutError:
+            raise socket.timeout("timed out")
+        raise Return(result)
+
+    @asyncio.coroutine
+    def connect(self):
+        """Connect to the oven once; returns (reader, writer) streams
+        
+        trollius raises its own OSError subclasses (eg. ConnectionRefusedError)
+        where OvenCtl would get a socket.error, so they're converted
+        
+        Can raise: socket.error"""
+        try:
+            conn = yield From(self._wait(asyncio.open_connection(
+                self.hostname, self.port, loop=self.loop)))
+        except socket.error:
+            raise
+        except EnvironmentError as err:
+            raise socket.error(err.errno, err.strerror)
+        raise Return(conn)
+
+    @asyncio.coroutine
+    def connect_with_retry(self):
+        """Connect to the oven; returns (reader, writer) streams
+        
+        Can raise: socket.error"""
+        connect = self.connect
+        if not self.retries:
+            conn = yield From(connect())
+            raise Return(conn)
+        delay = 0.01
+        for i in xrange(self.retries):
+            try:
+                conn = yield From(connect())
+                raise Return(conn)
+            except socket.error as err:
+                left = self.retries - i - 1
+                print '%s; %d tries left' % (err, left)
+                if left == 0:
+                    raise err
+            yield From(asyncio.sleep(delay, loop=self.loop))
+            delay *= 2
+
+    @asyncio.coroutine
+    def transact(self, req, decoder):
+        """Send req, a request string, to the oven and receive the response
+        
+        The response is received by decoder, an MbFrameDecoder
+        
+        Returns the decoded response (see MbFrameDecoder.result)
+        
+        Can raise: ModbusException: trouble at t' mill"""
+        with (yield From(self.lock)):
+            reader, writer = yield From(self.connect_with_retry())
+            try:
+                writer.write(req)
+                while not decoder.done():
+                    data = yield From(self._wait(reader.read(decoder.need())))
+                    if not data:
+                        raise ovenctl.ModbusShortMessageException(decoder.have,
+                            decoder.want, decoder.frame())
+                    decoder.feed(data)
+                raise Return(decoder.result())
+            finally:
+                writer.close()
+
+    @asyncio.coroutine
+    def do_readn(self, addr, n_words):
+        """Read n_words words from the oven at address addr
+        
+        Returns a list of words read
+        
+        Can raise: ModbusException: trouble at t' mill"""
+        decoder = ovenctl.MbFrameDecoder(ovenctl.MB_FN_READN, n_words)
+        words = yield From(self.transact(
+            ovenctl.make_readn_request(addr, n_words), decoder))
+        raise Return(words)
+
+    @asyncio.coroutine
+    def do_write(self, addr, data):
+        """Write data, a single word, to address addr on the oven
+        
+        Can raise: ModbusException: trouble at t' mill"""
+        decoder = ovenctl.MbFrameDecoder(ovenctl.MB_FN_WRITE)
+        resp_addr, resp_data = yield From(self.transact(
+            ovenctl.make_write_request(addr, data), decoder))
+        if (resp_addr!=addr) or (resp_data!=data):
+            raise ovenctl.ModbusBadResponseException(decoder.frame())
+
+    @asyncio.coroutine
+    def do_writen(self, addr, data): # data is a list of WORDS
+        """Write data, a list of words, to the oven, starting at address addr
+        
+        Can raise: ModbusException: trouble at t' mill"""
+        decoder = ovenctl.MbFrameDecoder(ovenctl.MB_FN_WRITEN)
+        resp_addr, resp_words = yield From(self.transact(
+            ovenctl.make_writen_request(addr, data), decoder))
+        if (resp_addr!=addr) or (resp_words!=len(data)):
+            raise ovenctl.ModbusBadResponseException(decoder.frame())
+
+    @asyncio.coroutine
+    def read_registers(self, names):
+        """Read several registers, named as in OVEN_REGISTER_TABLE
+        
+        See OvenCtl.read_registers
+        
+        Returns a dict of {name: value}
+        
+        Can raise: ModbusException"""
+        regs = [ovenctl.OVENREG[name] for name in names]
+        values = {}
+        plan = ovenctl.plan_reads(regs, self.plan_max_gap,
+                                  self.plan_max_words, self.bad_gaps)
+        while len(plan):
+            addr, n_words, group = plan.pop(0)
+            try:
+                words = yield From(self.do_readn(addr, n_words))
+            except ovenctl.ModbusErrorException as err:
+                if len(group) < 2 or err.ecode not in (ovenctl.MB_EE_ADDR,
+                                                       ovenctl.MB_EE_RANGE):
+                    raise
+                plan[:0] = ovenctl.replan_failed_read(group, self.bad_gaps)
+                continue
+            ovenctl.decode_read(addr, words, group, values)
+        raise Return(values)
+
+    @asyncio.coroutine
+    def read_float(self, addr):
+        """Read a floating-point value from the oven at address addr
+        
+        Can raise: ModbusException"""
+        data = yield From(self.do_readn(addr, 2))
+        raise Return(ovenctl.decode_float(data))
+
+    @asyncio.coroutine
+    def write_float(self, addr, value):
+        """Write a floating-point value to the oven at address addr
+        
+        Can raise: ModbusException"""
+        yield From(self.do_writen(addr, ovenctl.encode_float(value)))
+
+    @asyncio.coroutine
+    def read_int(self, addr):
+        """Read an integer value from the oven at address addr
+        
+        Can raise: ModbusException"""
+        data = yield From(self.do_readn(addr, 1))
+        raise Return(data[0])
+
+    @asyncio.coroutine
+    def write_int(self, addr, value):
+        """Write an integer value to the oven at address addr
+        
+        Can raise: ModbusException"""
+        yield From(self.do_write(addr, value))
+
+    @asyncio.coroutine
+    def get_temp(self):
+        """Get the oven's current temperature, as a float, in degrees Celsius
+        
+        Can raise: ModbusException"""
+        temp = yield From(self.read_float(ovenctl.OVENADDR_CURTEMP))
+        raise Return(temp)
+
+    @asyncio.coroutine
+    def get_setpoint(self):
+        """Get the oven's temperature setpoint, as a float, in degrees Celsius
+        
+        Can raise: ModbusException"""
+        setpoint = yield From(self.read_float(ovenctl.OVENADDR_SETPOINT))
+        raise Return(setpoint)
+
+    @asyncio.coroutine
+    def get_mode(self):
+        """Get the oven's current operating mode as (int, [str...])
+        
+        See OvenCtl.get_mode
+        
+        Can raise: ModbusException"""
+        mode = yield From(self.read_int(ovenctl.OVENADDR_MODE))
+        raise Return((mode, ovenctl.mode_names(mode)))
+
+    @asyncio.coroutine
+    def get_door_state(self):
+        """Return door state as bool (True = Open)
+        
+        Relies on reverse-engineered address
+        
+        Can raise: ModbusException"""
+        door = yield From(self.read_int(ovenctl.OVENADDR_DOOROPEN))
+        raise Return(bool(door))
+
+    @asyncio.coroutine
+    def get_alarm_state(self):
+        """Return (alarm, note) as (bool, bool)
+        
+        Relies on reverse-engineered address
+        
+        Can raise: ModbusException"""
+        regs = yield From(self.read_registers(('alarm', 'note')))
+        raise Return((bool(regs['alarm']), bool(regs['note'])))
+
+    @asyncio.coroutine
+    def get_alarm_text(self):
+        """Return alarm/note text as string, or None if text was all spaces
+        
+        Relies on reverse-engineered address
+        
+        Can raise:ModbusException"""
+        reg = ovenctl.OVENREG['alrmtext']
+        words = yield From(self.do_readn(reg.addr, reg.length))
+        raise Return(reg.decode(words))
+
+    @asyncio.coroutine
+    def snapshot(self, fields=ovenctl.OVEN_STATUS_FIELDS):
+        """Fetch the oven's status as an OvenStatus
+        
+        See OvenCtl.snapshot
+        
+        Can raise: ModbusException"""
+        table = ovenctl.status_table(fields)
+        start = time.time()
+        regs = yield From(self.read_registers(map(lambda f: f[1], table)))
+        raise Return(ovenctl.OvenStatus.from_registers(table, regs, start,
+                                                       time.time()))
+
+    @asyncio.coroutine
+    def check_safety(self, force=False):
+        """Check the oven is in a safe state.  Returns None
+        
+        See OvenCtl.check_safety
+        
+        Can raise:
+            SafetyException: Oven in unsafe state
+            ModbusException: Trouble at t' mill"""
+        regs = yield From(self.read_registers(ovenctl.safety_registers(force)))
+        ovenctl.check_registers_safe(regs, force)
+
+    @asyncio.coroutine
+    def set_setpoint(self, setpoint, force=False):
+        """Set the oven's temperature setpoint.  Returns None
+        
+        See OvenCtl.set_setpoint
+        
+        Can raise:
+            SafetyException: Oven in unsafe state
+            ModbusException: Trouble at t' mill"""
+        ovenctl.check_setpoint_range(setpoint)
+        yield From(self.check_safety(force))
+        yield From(self.write_float(ovenctl.OVENADDR_MANSETPT, setpoint))
+        yield From(self.write_float(ovenctl.OVENADDR_BASICSETPT, setpoint))
+
+    @asyncio.coroutine
+    def set_mode_idle(self):
+        """Set the oven to Idle mode.  Returns None
+        
+        Can raise: ModbusException"""
+        yield From(self.write_int(ovenctl.OVENADDR_MODE, 0))
+
+    @asyncio.coroutine
+    def set_mode_active(self, force=False):
+        """Set the oven to an active mode.  Returns None
+        
+        Can raise:
+            SafetyException: Oven in unsafe state
+            ModbusException: Trouble at t' mill"""
+        yield From(self.check_safety(force))
+        yield From(self.write_int(ovenctl.OVENADDR_MODE, 0x0800))
+
+    @asyncio.coroutine
+    def set_oplines(self, to_set=0, to_clear=0):
+        """Set or clear the selected operation lines
+        Returns the new operation line value
+        
+        Arguments to_set and to_clear are bitmasks of lines to set or
+        clear."""
+        old = yield From(self.read_int(ovenctl.OVENADDR_OPLINES))
+        new = (old | to_set) & ~to_clear
+        yield From(self.write_int(ovenctl.OVENADDR_OPLINES, new))
+        raise Return(new)
+
+    @asyncio.coroutine
+    def get_bedew_protection(self):
+        """Get bedew protection (condensation prevention), man. secn. 10"""
+        oplines = yield From(self.read_int(ovenctl.OVENADDR_OPLINES))
+        raise Return(oplines&1)
+
+    @asyncio.coroutine
+    def set_bedew_protection(self, value):
+        """Set bedew protection (condensation prevention), man. secn. 10"""
+        yield From(self.set_oplines(to_set = 1 if value else 0,
+                                    to_clear = 0 if value else 1))
+
+    @asyncio.coroutine
+    def wait_for_temp(self, limit, stabilise=False, acclimatise=0,
+                      interval=ovenctl.WAIT_POLL):
+        """Wait until the oven temperature is close to the setpoint
+        
+        Returns None
+        
+        Parameters:
+            limit: the maximum error that counts as 'close'
+            stabilise: if given and True, waits for 6 consecutive readings
+             to be 'close'
+            acclimatise: time in seconds to wait after reaching temp
+            interval: time in seconds between readings once close (default
+             WAIT_POLL)
+        
+        Can raise:
+            OvenStatusException: Oven state inappropriate for waiting
+            ModbusException: trouble at t' mill
+        
+        As for OvenCtl.wait_for_temp, readings while the temperature is far
+        from the setpoint are spaced out according to its trend.  The latest
+        estimate of the time (in seconds) until it's close is kept in
+        self.eta; this is None if there isn't one (eg. not enough readings
+        yet), and 0 once it is close."""
+        setpoint = yield From(self.get_setpoint())
+        since = None
+        stable = 0
+        trend = ovenctl.TempTrend()
+        self.eta = None
+        while True:
+            status = yield From(self.snapshot(('mode', 'setpoint', 'temp')))
+            if status.modes == ["idle"]:
+                raise ovenctl.OvenIdleException(
+                    "Oven is idle, will never reach temp.")
+            if status.setpoint != setpoint:
+                raise ovenctl.OvenSetChangedException(status.setpoint,
+                                                      setpoint)
+            trend.add(ovenctl.monotonic(), status.temp)
+            self.eta = trend.eta(setpoint, limit)
+            delay = interval
+            if abs(status.temp - setpoint) > limit:
+                stable = 0
+                if self.eta is not None:
+                    delay = ovenctl.approach_delay(self.eta)
+            else:
+                stable += 1
+                if stable >= (6 if stabilise else 0):
+                    if not acclimatise:
+                        return
+                    if since is None:
+                        since = time.time()
+                    elif time.time() > since + acclimatise:
+                        return
+            yield From(asyncio.sleep(delay, loop=self.loop))
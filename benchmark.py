@@ -0,0 +1,317 @@
+#! /usr/bin/env python
+#
+# Copyright Solarflare Communications Inc., 2012-13
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of Solarflare Communications Inc. nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL SOLARFLARE COMMUNICATIONS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Benchmarks for ovenctl and rampspec
+
+There are three suites of benchmarks:
+    codec: throughput of the MODBus codec (CRC16, building requests,
+     parsing responses, float encoding), in operations per second.  By
+     default the frame benchmarks are also run with the original bit-by-bit
+     CRC16 from secn 2.8 of the techspec, for comparison
+    client: latency (p50 and p99) of OvenCtl operations against a local
+     simulated oven (see ovensim), in milliseconds
+    rampspec: time to parse large generated (ramptool) profiles, and the
+     cost of RampCtl ticks, against a stand-in oven that does no I/O
+
+Results can be saved as JSON with -o, and compared against a previous run
+with -c, so that regressions between versions can be spotted."""
+import sys, optparse, struct, time, json, contextlib
+import ovenctl, ovensim, rampspec, ramptool
+
+BENCH_SUITES = ('codec', 'client', 'rampspec')
+
+def result(suite, name, value, unit, better):
+    """Make a benchmark result
+    
+    better is "higher" or "lower", saying which direction is good"""
+    return {'suite': suite, 'name': name, 'value': value, 'unit': unit,
+            'better': better}
+
+def calc_crc16_bitwise(msg): # string -> int
+    """The original bit-by-bit CRC16, kept here for comparison"""
+    crc = 0xffff
+    for byte in msg:
+        crc ^= ord(byte)
+        for bit in xrange(8):
+            sbit = crc&1
+            crc>>=1
+            crc^=sbit*0xA001
+    return crc
+
+def make_readn_response(words): # [int...] -> string
+    """Build the response the oven would send to a READN request"""
+    msg = struct.pack('>BBB%dH' % len(words), ovenctl.MB_SLAVEADDR,
+                      ovenctl.MB_FN_READN, len(words)*2, *words)
+    return msg + struct.pack('<H', ovenctl.calc_crc16(msg))
+
+def codec_readn(n_words):
+    """Return a function which builds and parses one READN frame pair"""
+    words = range(n_words)
+    resp = make_readn_response(words)
+    def frame():
+        ovenctl.make_readn_request(ovenctl.OVENADDR_ALRMTEXT, n_words)
+        ovenctl.parse_readn_response(resp)
+    return frame
+
+def codec_write():
+    """Return a function which builds and parses one WRITE frame pair"""
+    resp = ovenctl.make_write_request(ovenctl.OVENADDR_MODE, 0x0800)
+    def frame():
+        ovenctl.make_write_request(ovenctl.OVENADDR_MODE, 0x0800)
+        ovenctl.parse_write_response(resp)
+    return frame
+
+def codec_writen():
+    """Return a function which builds and parses one WRITEN frame pair"""
+    words = ovenctl.encode_float(42.5)
+    msg = struct.pack('>BBHH', ovenctl.MB_SLAVEADDR, ovenctl.MB_FN_WRITEN,
+                      ovenctl.OVENADDR_MANSETPT, len(words))
+    resp = msg + struct.pack('<H', ovenctl.calc_crc16(msg))
+    def frame():
+        ovenctl.make_writen_request(ovenctl.OVENADDR_MANSETPT, words)
+        ovenctl.parse_writen_response(resp)
+    return frame
+
+def codec_decoder(n_words):
+    """Return a function which receives one READN response with
+    MbFrameDecoder, a byte at a time (as if over a slow link)"""
+    resp = make_readn_response(range(n_words))
+    def frame():
+        decoder = ovenctl.MbFrameDecoder(ovenctl.MB_FN_READN, n_words)
+        for byte in resp:
+            decoder.feed(byte)
+        decoder.result()
+    return frame
+
+CODEC_FRAME_BENCHMARKS = (('readn1', lambda: codec_readn(1)),
+                          ('readn2', lambda: codec_readn(2)),
+                          ('readn20', lambda: codec_readn(0x14)),
+                          ('write', codec_write),
+                          ('writen', codec_writen))
+
+def rate(func, duration):
+    """Call func repeatedly for about duration seconds
+    
+    Returns the number of calls per second"""
+    count = 0
+    batch = 100
+    start = time.time()
+    end = start + duration
+    while True:
+        for i in xrange(batch):
+            func()
+        count += batch
+        now = time.time()
+        if now >= end:
+            return count / (now - start)
+
+def bench_codec(options):
+    """Run the codec benchmarks; returns a list of results"""
+    results = []
+    msg = make_readn_response(range(0x14))
+    words = ovenctl.encode_float(42.5)
+    for name, func in (('crc16', lambda: ovenctl.calc_crc16(msg)),
+                       ('encode_float', lambda: ovenctl.encode_float(42.5)),
+                       ('decode_float', lambda: ovenctl.decode_float(words)),
+                       ('decoder20', codec_decoder(0x14))):
+        results.append(result('codec', name, rate(func, options.time),
+                              'ops/s', 'higher'))
+    # The frame benchmarks use calc_crc16; MbFrameDecoder doesn't
+    crcs = [('table', ovenctl.calc_crc16)]
+    if not options.no_compare:
+        crcs.append(('bitwise', calc_crc16_bitwise))
+    saved = ovenctl.calc_crc16
+    try:
+        for crcname, crcfunc in crcs:
+            ovenctl.calc_crc16 = crcfunc
+            for name, maker in CODEC_FRAME_BENCHMARKS:
+                results.append(result('codec', '%s/%s' % (name, crcname),
+                                      rate(maker(), options.time),
+                                      'frames/s', 'higher'))
+    finally:
+        ovenctl.calc_crc16 = saved
+    return results
+
+def percentile(samples, pct):
+    """Return the pct'th percentile of a sorted list of samples"""
+    return samples[min(len(samples)-1, int(len(samples)*pct/100.0))]
+
+def latencies(func, iterations):
+    """Call func iterations times; returns a sorted list of times in ms"""
+    samples = []
+    for i in xrange(iterations):
+        start = time.time()
+        func()
+        samples.append((time.time()-start)*1000)
+    return sorted(samples)
+
+def bench_client(options):
+    """Run the client benchmarks; returns a list of results"""
+    model = ovensim.OvenModel.from_dump(ovensim.DUMPDIR + '/closed.dump')
+    server = ovensim.OvenSimServer(model, port=0, refuse=False)
+    port = server.start()
+    try:
+        oven = ovenctl.OvenCtl('127.0.0.1', port)
+        ops = (('get_temp', oven.get_temp),
+               ('set_setpoint', lambda: oven.set_setpoint(40.0)),
+               ('check_safety', oven.check_safety),
+               ('query', oven.snapshot))
+        results = []
+        for name, func in ops:
+            func() # warm up
+            samples = latencies(func, options.iterations)
+            for pct in (50, 99):
+                results.append(result('client', '%s/p%d' % (name, pct),
+                                      percentile(samples, pct), 'ms',
+                                      'lower'))
+        return results
+    finally:
+        server.stop()
+
+class NullOven(object):
+    """A stand-in oven for RampCtl which does no I/O
+    
+    The temperature is always exactly the setpoint"""
+    def __init__(self):
+        self.setpoint = 25.0
+        self.bedew_protection = False
+    @contextlib.contextmanager
+    def session(self):
+        yield self
+    def set_setpoint(self, setpoint, force=False):
+        self.setpoint = setpoint
+    def get_setpoint(self):
+        return self.setpoint
+    def get_temp(self):
+        return self.setpoint
+    def set_mode_active(self, force=False):
+        pass
+    def set_mode_idle(self):
+        pass
+
+def ramptool_profile(hold, interval):
+    """Generate a ramptool profile (as ramptool.py -T85 -R60 -W)
+    
+    hold is in hours, interval (between subtests) in minutes"""
+    options = optparse.Values({'rate': 60.0, 'interval': interval/60.0,
+                               'xdur': 0.0, 'jump': True, 'dry': False,
+                               'wait': True, 'stable': False, 'limit': 1.0})
+    s = 'Ws%f,l0.5;' % ramptool.AMBIENT
+    ds, t = ramptool.ramp_to(85.0, options, ramptool.AMBIENT)
+    s += ds + ramptool.hold_at(85.0, hold, options)
+    ds, t = ramptool.ramp_to(ramptool.AMBIENT, options, t)
+    return s + ds + 'X;0:I'
+
+def bench_rampspec(options):
+    """Run the rampspec benchmarks; returns a list of results"""
+    results = []
+    for hold in (24, 168):
+        profile = ramptool_profile(hold, 5)
+        start = time.time()
+        spec = rampspec.RampSpec(profile)
+        elapsed = time.time() - start
+        name = 'parse/%dh' % hold
+        results.append(result('rampspec', name, elapsed*1000, 'ms', 'lower'))
+        results.append(result('rampspec', name+'/actions',
+                              len(spec), 'actions', None))
+        results.append(result('rampspec', name+'/program',
+                              len(spec.program), 'instructions', None))
+        # Steady-state cost of a tick, sat in a long Hold at the start
+        spec = rampspec.RampSpec('Hs85,t1000;' + profile)
+        rc = spec.prepare(NullOven())
+        results.append(result('rampspec', 'tick/%dh' % hold,
+                              rate(rc.run, options.time), 'ticks/s',
+                              'higher'))
+        # Cost of stepping through every action of the profile
+        n = len(spec)
+        spec = rampspec.RampSpec('Ht0;' * n)
+        rc = spec.prepare(NullOven())
+        start = time.time()
+        while rc.run():
+            pass
+        elapsed = time.time() - start
+        results.append(result('rampspec', 'walk/%d' % n, elapsed*1000, 'ms',
+                              'lower'))
+    return results
+
+BENCH_FUNCS = {'codec': bench_codec, 'client': bench_client,
+               'rampspec': bench_rampspec}
+
+def compare(results, baseline):
+    """Print results alongside a baseline run (as loaded from JSON)"""
+    old = dict(((r['suite'], r['name']), r) for r in baseline['results'])
+    for r in results:
+        b = old.get((r['suite'], r['name']))
+        if b is None or not b['value'] or r['better'] is None:
+            change = ''
+        else:
+            ratio = float(r['value']) / b['value']
+            if r['better'] == 'lower':
+                ratio = 1/ratio if ratio else float('inf')
+            change = '%6.2fx %s' % (ratio, 'better' if ratio >= 1 else 'WORSE')
+        print "%-8s %-24s %14.3f %-8s %s" % (r['suite'], r['name'],
+                                             r['value'], r['unit'], change)
+
+def parse_cmdline():
+    parser = optparse.OptionParser()
+    parser.usage = "%prog [options]"
+    parser.add_option('-s', '--suite', type='choice', choices=BENCH_SUITES,
+                      action='append', default=[],
+                      help='Suite to run (%s; may be repeated; default all)'
+                           % ', '.join(BENCH_SUITES))
+    parser.add_option('-t', '--time', type='float', default=1.0,
+                      help='Time (in seconds) to run each throughput '
+                           'benchmark')
+    parser.add_option('-i', '--iterations', type='int', default=200,
+                      help='Iterations of each latency benchmark')
+    parser.add_option('-n', '--no-compare', action='store_true',
+                      help="Don't run the bitwise CRC16 for comparison")
+    parser.add_option('-o', '--output', type='string',
+                      help='Write results to this file as JSON')
+    parser.add_option('-c', '--compare', type='string',
+                      help='Compare results with this JSON file from a '
+                           'previous run')
+    options, args = parser.parse_args()
+    if not options.suite:
+        options.suite = list(BENCH_SUITES)
+    return options
+
+if __name__ == '__main__':
+    options = parse_cmdline()
+    baseline = {'results': []}
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+    results = []
+    for suite in options.suite:
+        results.extend(BENCH_FUNCS[suite](options))
+    compare(results, baseline)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'time': time.time(),
+                       'results': results}, f, indent=1)
@@ -0,0 +1,237 @@
+#! /usr/bin/env python
+#
+# Copyright Solarflare Communications Inc., 2012-13
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of Solarflare Communications Inc. nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL SOLARFLARE COMMUNICATIONS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Compare and correlate many nmbdump memory dumps
+
+A DumpStore holds any number of dumps (see nmbdump.py) as rows of a NumPy
+array, one column per address, with words which were MBER or TIME masked
+out.  Each dump can carry labels describing the conditions it was taken in
+(eg. door=1, active=1, or a temperature), and the store ranks addresses (and
+bits within them) by how well they track a label.  Everything works on
+whole columns at once, so the cost is linear in the number of dumps; dumps
+are never compared pairwise.
+
+This is what finding the door register (0x1007) or the alarm register
+(0x123d) amounted to, done by hand with diff on the .hex files."""
+import sys, optparse
+import numpy
+import nmbdump
+
+DUMPSTORE_WIDTH = 0x2000 # Default number of addresses (as nmbdumps/*.dump)
+DUMPSTORE_TOP   = 20     # Default number of candidates to list
+
+class DumpStore(object):
+    """An array of memory dumps, with masks and labels
+    
+    Attributes:
+        words: uint16 array [dump, address] of the words read
+        valid: bool array [dump, address], False for MBER/TIME/missing words
+        names: list of the names of the dumps
+        labels: list of {label: value} dicts, one per dump
+    Only the first len(self) rows of words and valid are in use."""
+    def __init__(self, width=DUMPSTORE_WIDTH):
+        self.width = width
+        self.words = numpy.zeros((0, width), numpy.uint16)
+        self.valid = numpy.zeros((0, width), numpy.bool_)
+        self.names = []
+        self.labels = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def _grow(self, rows, width):
+        """Make room for at least rows dumps of width addresses"""
+        have = self.words.shape[0]
+        if rows <= have and width <= self.width:
+            return
+        rows = max(rows, have * 2, 16)
+        width = max(width, self.width)
+        words = numpy.zeros((rows, width), numpy.uint16)
+        valid = numpy.zeros((rows, width), numpy.bool_)
+        n = len(self)
+        words[:n, :self.width] = self.words[:n]
+        valid[:n, :self.width] = self.valid[:n]
+        self.words, self.valid, self.width = words, valid, width
+
+    def add(self, memory, name=None, labels=None):
+        """Add a dump, as returned by nmbdump.read_dump
+        
+        labels is a dict of {label: value}; labels not given for a dump
+        count as 0 for it."""
+        good = [(a, w) for a, w in memory.iteritems()
+                if w not in (nmbdump.DUMP_MBER, nmbdump.DUMP_TIME)]
+        width = max([a + 1 for a in memory] or [0])
+        self._grow(len(self) + 1, width)
+        row = len(self)
+        if good:
+            addrs, words = zip(*good)
+            self.words[row, list(addrs)] = words
+            self.valid[row, list(addrs)] = True
+        self.names.append(name if name is not None else str(row))
+        self.labels.append(dict(labels or {}))
+
+    def load(self, filename, labels=None):
+        """Add a dump from a .dump or .hex file; see add"""
+        self.add(nmbdump.load_dump(filename), filename, labels)
+
+    def view(self): # -> (words, valid)
+        """Return the rows of words and valid in use"""
+        n = len(self)
+        return self.words[:n], self.valid[:n]
+
+    def label(self, name): # -> float array [dump]
+        """Return the values of label name for each dump"""
+        return numpy.array([l.get(name, 0) for l in self.labels], numpy.float64)
+
+    def diff(self, i, j): # -> int array of addresses
+        """Return the addresses valid in both dumps i and j which differ"""
+        words, valid = self.view()
+        return numpy.flatnonzero(valid[i] & valid[j] & (words[i] != words[j]))
+
+    def changes(self): # -> int array [address]
+        """Count how often each address changes from one dump to the next
+        
+        Only pairs of consecutive dumps where the address is valid in both
+        are counted, so this is meaningful for a series of dumps taken
+        during a run."""
+        words, valid = self.view()
+        changed = (words[1:] != words[:-1]) & valid[1:] & valid[:-1]
+        return changed.sum(axis=0)
+
+    def varying(self): # -> int array of addresses
+        """Return the addresses which don't have the same value in every
+        dump in which they are valid"""
+        words, valid = self.view()
+        lo = numpy.where(valid, words, 0xffff).min(axis=0)
+        hi = numpy.where(valid, words, 0).max(axis=0)
+        return numpy.flatnonzero(valid.any(axis=0) & (lo < hi))
+
+    def correlate(self, name): # -> (word r [address], bit r [address, bit])
+        """Correlate each address, and each bit, with label name
+        
+        Returns the Pearson correlation of the word values and of each of
+        their 16 bits with the label, over the dumps in which the address is
+        valid.  Addresses which don't vary (or whose valid dumps all have the
+        same label value) get 0.  Only the addresses which vary are
+        examined, which in practice is a small fraction of them."""
+        words, valid = self.view()
+        y = self.label(name)[:, None]
+        cols = self.varying()
+        words = words[:, cols]
+        w = valid[:, cols].astype(numpy.float64)
+        n = w.sum(axis=0)
+        n[n == 0] = 1
+        dy = (y - (w * y).sum(axis=0) / n) * w
+        syy = (dy * dy).sum(axis=0)
+        def pearson(x): # x: [dump, column]
+            dx = (x - (w * x).sum(axis=0) / n) * w
+            denom = numpy.sqrt((dx * dx).sum(axis=0) * syy)
+            r = numpy.zeros_like(denom)
+            nz = denom > 0
+            r[nz] = (dx * dy).sum(axis=0)[nz] / denom[nz]
+            return r
+        word_r = numpy.zeros(self.width)
+        bit_r = numpy.zeros((self.width, 16))
+        word_r[cols] = pearson(words.astype(numpy.float64))
+        for bit in xrange(16):
+            bit_r[cols, bit] = pearson(((words >> bit) & 1).astype(numpy.float64))
+        return word_r, bit_r
+
+    def candidates(self, name, top=DUMPSTORE_TOP): # -> [(addr, bit, r)...]
+        """Rank addresses by how well they track label name
+        
+        Returns up to top tuples (address, bit, r), best first, where bit
+        is None if the whole word correlates better than any one bit.  Each
+        address appears at most once.  Ties are broken in favour of the
+        address which changes least often (see changes), since noisy words
+        (like temperatures) correlate with anything given few enough dumps."""
+        word_r, bit_r = self.correlate(name)
+        best_bit = numpy.abs(bit_r).argmax(axis=1)
+        bit_best_r = bit_r[numpy.arange(len(best_bit)), best_bit]
+        use_bit = numpy.abs(bit_best_r) > numpy.abs(word_r)
+        r = numpy.where(use_bit, bit_best_r, word_r)
+        order = numpy.lexsort((self.changes(), -numpy.abs(r)))[:top]
+        return [(int(a), int(best_bit[a]) if use_bit[a] else None, float(r[a]))
+                for a in order if r[a] != 0]
+
+def parse_dumparg(arg): # string -> (filename, {label: value})
+    """Parse a command-line dump argument, "file[:label[=value],...]"
+    
+    A label without a value is 1."""
+    filename, colon, labelstr = arg.partition(':')
+    labels = {}
+    for l in labelstr.split(','):
+        if not len(l): continue
+        name, eq, value = l.partition('=')
+        labels[name] = float(value) if len(eq) else 1
+    return filename, labels
+
+def parse_cmdline():
+    parser = optparse.OptionParser()
+    parser.usage = "%prog [options] file.dump[:label[=value],...]..."
+    parser.add_option('-c', '--condition', type='string',
+                      help='Rank addresses by correlation with this label')
+    parser.add_option('-n', '--top', type='int', default=DUMPSTORE_TOP,
+                      help='Number of candidates to list')
+    options, args = parser.parse_args()
+
+    if not args:
+        parser.print_usage()
+        sys.exit(2)
+    try:
+        options.dumps = map(parse_dumparg, args)
+    except ValueError as err:
+        print "ERROR: Bad label value: %s" % err
+        sys.exit(2)
+
+    return options
+
+if __name__ == '__main__':
+    options = parse_cmdline()
+    store = DumpStore()
+    for filename, labels in options.dumps:
+        try:
+            store.load(filename, labels)
+        except (IOError, nmbdump.DumpParseException) as err:
+            print "ERROR: Failed to load %s: %s" % (filename, err)
+            sys.exit(1)
+    words, valid = store.view()
+    if options.condition:
+        for addr, bit, r in store.candidates(options.condition, options.top):
+            values = ' '.join("%04x" % w if v else nmbdump.DUMP_MBER
+                              for w, v in zip(words[:, addr], valid[:, addr]))
+            where = "%04x" % addr if bit is None else "%04x.%d" % (addr, bit)
+            print "%-7s r=%+.3f  %s" % (where, r, values)
+    else:
+        changes = store.changes()
+        addrs = store.varying()
+        addrs = addrs[numpy.argsort(-changes[addrs], kind='mergesort')]
+        for addr in addrs[:options.top]:
+            values = ' '.join("%04x" % w if v else nmbdump.DUMP_MBER
+                              for w, v in zip(words[:, addr], valid[:, addr]))
+            print "%04x changes=%-4d %s" % (addr, changes[addr], values)
@@ -0,0 +1,275 @@
+#! /usr/bin/env python
+#
+# Copyright Solarflare Communications Inc., 2012-13
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of Solarflare Communications Inc. nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL SOLARFLARE COMMUNICATIONS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Read and write nmbdump memory dumps
+
+tools/nmbdump produces dumps of the MB1's memory in the following format,
+eight words to a line:
+    0000: 3134 302e 0000 MBER MBER TIME 0020 0020
+where MBER denotes that a modbus error was encountered reading that word
+(typically 'parameter value out of range') and TIME denotes that the read
+timed out.  The .hex files are the same, but with lines containing only
+MBERs and TIMEs left out.  See nmbdumps/dumps.readme
+
+Run as a script, this is a faster replacement for tools/nmbdump, built on
+ovenctl.OvenCtl.  Rather than reading one word per transaction, it reads
+blocks of up to DUMP_BLOCK words; when a block gets an MBER (any word in it
+being out of range fails the whole READN) it is split in half until the bad
+words are found, and after a bad word the block size starts again from one
+word and doubles with each good read, so that long MBER regions cost one
+transaction per word rather than a failed bisection per block.  Words found
+to be MBER are remembered in a known-bad file (see read_known_bad) and are
+not read again on later runs."""
+import sys, os, socket, optparse
+import ovenctl
+
+DUMP_WORDS_PER_LINE = 8
+# Markers for words which couldn't be read
+DUMP_MBER = 'MBER'
+DUMP_TIME = 'TIME'
+DUMP_BLOCK = ovenctl.PLAN_MAX_WORDS # Max. words to read in one transaction
+DUMP_KNOWN_BAD = os.path.expanduser('~/.nmbdump.mber') # Default known-bad file
+
+class DumpParseException(Exception): pass
+
+def read_dump(f): # file -> {int: int or str}
+    """Read a .dump or .hex file
+    
+    f is a file object (or any iterable of lines)
+    
+    Returns a dict of {address: word}; words which couldn't be read are
+    DUMP_MBER or DUMP_TIME instead.  Addresses not in the dump (eg. the
+    lines left out of a .hex file) are absent from the dict"""
+    memory = {}
+    for lineno, line in enumerate(f, 1):
+        addr, colon, words = line.partition(':')
+        if not len(colon):
+            if not len(line.strip()): continue
+            raise DumpParseException("Missing ':'", lineno, line)
+        try:
+            addr = int(addr, 16)
+            for off, word in enumerate(words.split()):
+                if word not in (DUMP_MBER, DUMP_TIME):
+                    word = int(word, 16)
+                memory[addr+off] = word
+        except ValueError:
+            raise DumpParseException("Bad hex", lineno, line)
+    return memory
+
+def load_dump(filename): # string -> {int: int or str}
+    """Read a .dump or .hex file by name; see read_dump"""
+    with open(filename) as f:
+        return read_dump(f)
+
+def format_dump(memory, start, end, hexonly=False):
+    """Generate the lines of a dump of memory from start to end
+    
+    memory is as returned by read_dump (words missing from it are written
+    as DUMP_MBER).  If hexonly is set, lines containing only DUMP_MBER and
+    DUMP_TIME are left out, as in a .hex file."""
+    for addr in xrange(start, end, DUMP_WORDS_PER_LINE):
+        words = [memory.get(a, DUMP_MBER) for a in
+                 xrange(addr, min(addr + DUMP_WORDS_PER_LINE, end))]
+        if hexonly and all(w in (DUMP_MBER, DUMP_TIME) for w in words):
+            continue
+        yield "%04x: %s\n" % (addr, ' '.join(w if w in (DUMP_MBER, DUMP_TIME)
+                                              else "%04x" % w for w in words))
+
+def write_dump(f, memory, start, end, hexonly=False):
+    """Write a .dump (or if hexonly is set, .hex) file; see format_dump"""
+    f.writelines(format_dump(memory, start, end, hexonly))
+
+def read_known_bad(filename): # string -> set of int
+    """Read a known-bad file, listing words which gave MBER on earlier runs
+    
+    Each line is a range of addresses, "start-end" (inclusive) in hex, or a
+    single address.  A missing file is treated as empty."""
+    bad = set()
+    try:
+        f = open(filename)
+    except IOError:
+        return bad
+    with f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not len(line): continue
+            first, dash, last = line.partition('-')
+            try:
+                first = int(first, 16)
+                last = int(last, 16) if len(dash) else first
+            except ValueError:
+                raise DumpParseException("Bad range", lineno, line)
+            bad.update(xrange(first, last + 1))
+    return bad
+
+def write_known_bad(filename, bad):
+    """Write a known-bad file from a set of addresses; see read_known_bad"""
+    with open(filename, 'w') as f:
+        addrs = sorted(bad)
+        i = 0
+        while i < len(addrs):
+            j = i
+            while j + 1 < len(addrs) and addrs[j + 1] == addrs[j] + 1:
+                j += 1
+            if j > i:
+                f.write("%04x-%04x\n" % (addrs[i], addrs[j]))
+            else:
+                f.write("%04x\n" % addrs[i])
+            i = j + 1
+
+class Dumper(object):
+    """Read a range of the oven's memory in as few transactions as possible"""
+    def __init__(self, oven, block=DUMP_BLOCK, known_bad=()):
+        """Construct a Dumper
+        
+        Parameters:
+            oven: the ovenctl.OvenCtl to read from
+            block: maximum number of words to read in one transaction
+            known_bad: addresses known to give MBER, which won't be read"""
+        self.oven = oven
+        self.block = block
+        self.known_bad = set(known_bad)
+        self.transactions = 0
+
+    def read(self, addr, n_words):
+        """Read n_words words at addr, counting the transaction"""
+        self.transactions += 1
+        return self.oven.do_readn(addr, n_words)
+
+    def dump(self, start, end, progress=None): # -> {int: int or str}
+        """Read memory from start up to (but not including) end
+        
+        Returns a dict as read_dump.  Words which give MBER are added to
+        self.known_bad.  If progress is given, it is called with each
+        address reached.
+        
+        Can raise: socket.error if the oven can't be reached at all"""
+        memory = {}
+        size = self.block
+        addr = start
+        while addr < end:
+            if progress is not None:
+                progress(addr)
+            if addr in self.known_bad:
+                memory[addr] = DUMP_MBER
+                addr += 1
+                continue
+            n = 1
+            limit = min(size, end - addr)
+            while n < limit and addr + n not in self.known_bad:
+                n += 1
+            try:
+                words = self.read(addr, n)
+            except ovenctl.ModbusErrorException:
+                if n == 1:
+                    memory[addr] = DUMP_MBER
+                    self.known_bad.add(addr)
+                    addr += 1
+                size = max(n // 2, 1)
+                continue
+            except (ovenctl.ModbusException, socket.timeout):
+                if n == 1:
+                    memory[addr] = DUMP_TIME
+                    addr += 1
+                size = max(n // 2, 1)
+                continue
+            for off, word in enumerate(words):
+                memory[addr + off] = word
+            addr += n
+            size = min(size * 2, self.block)
+        return memory
+
+def parse_cmdline():
+    parser = optparse.OptionParser()
+    parser.usage = "%prog -H hostname [-p port] [-a addr] [-l length] [options]"
+    parser.add_option('-H', '--host', help='host to connect to')
+    parser.add_option('-p', '--port', help='TCP port to connect to',
+                      default=ovenctl.BINDER_PORT)
+    parser.add_option('-a', '--addr', type='string', default='0',
+                      help='Address to start at (hex, in words)')
+    parser.add_option('-l', '--length', type='string', default='2000',
+                      help='Number of words to dump (hex)')
+    parser.add_option('-b', '--block', type='int', default=DUMP_BLOCK,
+                      help='Max. words to read in one transaction')
+    parser.add_option('-k', '--known-bad', type='string',
+                      default=DUMP_KNOWN_BAD,
+                      help='File of addresses known to give MBER (default %default)')
+    parser.add_option('-r', '--rescan', action='store_true',
+                      help="Read known-bad addresses again")
+    parser.add_option('-x', '--hex', action='store_true',
+                      help='Leave out lines with no good words (.hex format)')
+    parser.add_option('-o', '--output', type='string',
+                      help='File to write the dump to (default stdout)')
+    options, args = parser.parse_args()
+
+    if not options.host:
+        print "ERROR: -H/--host is required"
+        sys.exit(2)
+
+    try:
+        options.addr = int(options.addr, 16)
+        options.length = int(options.length, 16)
+    except ValueError:
+        print "ERROR: -a/--addr and -l/--length must be in hex"
+        sys.exit(2)
+    if options.length < 1 or options.addr + options.length > 0x10000:
+        print "ERROR: Address + Length must be <= 0x10000"
+        sys.exit(2)
+    if options.block < 1:
+        print "ERROR: -b/--block must be at least 1"
+        sys.exit(2)
+
+    return options
+
+if __name__ == '__main__':
+    options = parse_cmdline()
+    known_bad = set()
+    if options.known_bad:
+        known_bad = read_known_bad(options.known_bad)
+    oven = ovenctl.OvenCtl(options.host, options.port)
+    dumper = Dumper(oven, options.block, () if options.rescan else known_bad)
+    end = options.addr + options.length
+    try:
+        with oven.session():
+            memory = dumper.dump(options.addr, end)
+    except socket.error as err:
+        print >>sys.stderr, "Failed to connect: %s" % (err,)
+        sys.exit(3)
+    if options.known_bad:
+        if options.rescan:
+            # forget any words in the range that read OK this time
+            known_bad.difference_update(xrange(options.addr, end))
+        known_bad.update(dumper.known_bad)
+        write_known_bad(options.known_bad, known_bad)
+    if options.output:
+        with open(options.output, 'w') as f:
+            write_dump(f, memory, options.addr, end, options.hex)
+    else:
+        write_dump(sys.stdout, memory, options.addr, end, options.hex)
+    print >>sys.stderr, "%d words in %d transactions" % (options.length,
+                                                         dumper.transactions)
@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+#
+# Copyright Solarflare Communications Inc., 2012-13
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of Solarflare Communications Inc. nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL SOLARFLARE COMMUNICATIONS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Publish oven status on a shared-memory status board
+
+A single poller takes a snapshot of each oven (see ovenctl.Fleet) at a
+fixed interval, and writes it to an ovenctl.StatusBoard: a memory-mapped
+file that any number of local processes can read consistent snapshots from
+without a socket or an oven transaction (see ovenctl.board_status).
+ovenctl.py -Q answers from the board when it has a fresh status.
+
+The board lives in /dev/shm by default, so it's only ever in memory."""
+import sys, optparse, time
+import ovenctl
+
+BOARD_INTERVAL = 10 # Default time (in seconds) between polls
+
+class BoardPublisher(object):
+    """Poll a fleet of ovens, and post their status on a StatusBoard"""
+    def __init__(self, fleet, board, interval=BOARD_INTERVAL):
+        """Construct a BoardPublisher
+        
+        Parameters:
+            fleet: the ovenctl.Fleet to poll
+            board: the ovenctl.StatusBoard to post to, open for writing
+            interval: time in seconds between polls"""
+        self.fleet = fleet
+        self.board = board
+        self.interval = interval
+        self.sweeps = 0
+        self.failures = 0
+
+    def sweep(self):
+        """Poll every oven once, and post the results"""
+        for oven, status in self.fleet.poll():
+            key = ovenctl.board_key(oven.hostname, oven.port)
+            if isinstance(status, Exception):
+                self.failures += 1
+                self.board.publish_failure(key)
+            else:
+                self.board.publish(key, status)
+        self.sweeps += 1
+
+    def run(self):
+        """Sweep every self.interval seconds, forever"""
+        while True:
+            start = ovenctl.monotonic()
+            self.sweep()
+            time.sleep(max(0, start + self.interval - ovenctl.monotonic()))
+
+def parse_cmdline():
+    parser = optparse.OptionParser()
+    parser.usage = "%prog -H hostname [-H hostname...] [options]"
+    parser.add_option('-H', '--host', action='append', default=[],
+                      help='oven to poll (may be repeated)')
+    parser.add_option('-F', '--hostfile', type='string',
+                      help='file listing ovens to poll')
+    parser.add_option('-p', '--port', help='TCP port to connect to ovens on',
+                      default=ovenctl.BINDER_PORT)
+    parser.add_option('-B', '--board', type='string',
+                      default=ovenctl.BOARD_FILE,
+                      help='Status board file to publish to (default %default)')
+    parser.add_option('-n', '--slots', type='int', default=ovenctl.BOARD_SLOTS,
+                      help='Number of ovens the board has room for')
+    parser.add_option('-i', '--interval', type='float',
+                      default=BOARD_INTERVAL,
+                      help='Time (in seconds) between polls')
+    parser.add_option('-j', '--parallel', type='int',
+                      default=ovenctl.FLEET_PARALLEL,
+                      help='Max. ovens to poll at once')
+    options, args = parser.parse_args()
+
+    if options.hostfile:
+        try:
+            options.host.extend(ovenctl.read_hostfile(options.hostfile))
+        except IOError as err:
+            print "ERROR: Failed to read hostfile: %s" % err
+            sys.exit(2)
+
+    if not options.host:
+        print "ERROR: -H/--host is required"
+        sys.exit(2)
+
+    if len(options.host) > options.slots:
+        print "ERROR: %d ovens won't fit on a board of %d slots" % (
+            len(options.host), options.slots)
+        sys.exit(2)
+
+    return options
+
+if __name__ == '__main__':
+    options = parse_cmdline()
+    fleet = ovenctl.Fleet.from_hosts(options.host, options.port,
+                                     parallel=options.parallel)
+    try:
+        board = ovenctl.StatusBoard(options.board, writer=True,
+                                    slots=options.slots,
+                                    interval=options.interval)
+    except (ovenctl.StatusBoardException, EnvironmentError) as err:
+        print "ERROR: Failed to open status board: %s" % (err,)
+        sys.exit(1)
+    print "Publishing %d ovens on %s every %gs" % (len(fleet.ovens),
+                                                   options.board,
+                                                   options.interval)
+    sys.stdout.flush()
+    publisher = BoardPublisher(fleet, board, options.interval)
+    try:
+        publisher.run()
+    except KeyboardInterrupt:
+        pass
+    board.close()
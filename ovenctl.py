@@ -47,11 +47,40 @@ class OvenCtl is the main class
     wait_for_temp: Block until the oven reaches its setpoint
     temp_ready_tester: Create a closure to test whether the oven has
      reached its setpoint (complicated; see its docstring)
+    snapshot: Get all the oven's status in one go, as an OvenStatus
+    watch: Subscribe to changes in the oven's status, which a background
+     thread polls for (shared by all the oven's subscribers)
+    session: Context manager to reuse one connection for a burst of
+     operations (and share the oven safely between threads)
+    read_registers: Read several registers (named in OVEN_REGISTER_TABLE)
+     in as few transactions as possible
+    cache: Set to a RegisterCache to cache reads (with per-register TTLs)
+    shadow: Set to a ShadowRegisters to skip writes that would change nothing
+    observer: Set to an OvenObserver (eg. a TransactionStats) to be told
+     about every transaction
   Pitfalls:
     Don't call set_mode_active before set_setpoint, or the oven might start
      up the wrong thing (eg. the fridge when you wanted the heater).  The
      lag-time can be several minutes
 
+class Fleet polls many ovens (OvenCtl instances) concurrently
+
+class OvenWatcher polls one oven in a background thread for OvenCtl.watch, and
+ hands changes on to each Subscription
+
+class TempTrend fits a line to recent temperature readings, to estimate when
+ the oven will reach its setpoint; wait_for_temp uses it to space out polls
+
+class StatusBoard is a memory-mapped file of the latest status of some ovens,
+ published by ovenboard.py, which local processes can read without talking
+ to the ovens (board_status is the easy way)
+
+monotonic() is a clock (in seconds) that doesn't jump when the system clock
+ is set, for timing things like rampspec actions
+
+class MbFrameDecoder receives and decodes a MODBus response frame piecewise,
+ as it arrives from the socket; it's used by the OvenCtl.do_* methods
+
 class SafetyException (derived from Exception) is the base class for various
  exceptions which are raised to indicate that oven operation may be unsafe
   Derived classes:
@@ -75,7 +104,9 @@ class OvenStatusException (derived from Exception) is the base class for
   Derived classes:
     OvenIdleException: Oven is in Idle mode
     OvenSetChangedException: Temperature setpoint was changed"""
-import sys, socket, struct, optparse, time
+import sys, socket, struct, optparse, time, threading, contextlib, atexit, weakref
+import os, mmap, bisect, collections
+import Queue
 
 BINDER_PORT = 10001
 
@@ -144,6 +175,47 @@ OVENADDR_ALARM      = 0x123d
 #   Note active (man. secn 12)
 OVENADDR_NOTE       = 0x123e
 
+# Session mode: release the held connection after this many idle seconds
+SESSION_IDLE = 0.5
+
+# With a shadow, a safety check that passed is good for this many seconds
+SAFETY_RECHECK = 1
+
+# Waiting for temperature (wait_for_temp)
+WAIT_POLL          = 10  # Time (in seconds) between readings once close
+WAIT_POLL_MIN      = 2   # Min. time between readings while approaching
+WAIT_POLL_MAX      = 60  # Max. time between readings while approaching
+WAIT_POLL_FRACTION = 0.5 # Read again after this fraction of the ETA
+TREND_POINTS       = 6   # Readings to fit the temperature trend to
+
+# Background watching (OvenCtl.watch)
+WATCH_INTERVAL = 5 # Time (in seconds) between polls of a watched oven
+
+# Status board (see StatusBoard)
+BOARD_FILE        = '/dev/shm/ovenboard' # Default path (tmpfs on Linux)
+BOARD_MAGIC       = 'OVENBRD1'
+BOARD_HEADER      = struct.Struct('<8sIIdI') # magic, slot size, slots, interval, pid
+BOARD_HEADER_SIZE = 64 # header is padded to this size
+BOARD_SEQ         = struct.Struct('<Q') # seqlock sequence number, at the start of each slot
+BOARD_BODY        = struct.Struct('<64sddddHH20s') # key, time, elapsed, temp, setpoint, mode, flags, alarm text
+BOARD_SLOT_SIZE   = BOARD_SEQ.size + BOARD_BODY.size # 128
+BOARD_SLOTS       = 64  # Default number of ovens a board has room for
+BOARD_RETRIES     = 1000 # Times a reader retries a slot that's being written
+BOARD_BACKOFF     = 0.0001 # Time (in seconds) a reader waits between retries
+
+BOARD_FLAG_DOOR   = 1
+BOARD_FLAG_ALARM  = 2
+BOARD_FLAG_NOTE   = 4
+BOARD_FLAG_BEDEW  = 8
+BOARD_FLAG_MODE   = 0x10  # mode is valid
+BOARD_FLAG_FAILED = 0x100 # the latest poll failed; this is from an earlier one
+BOARD_FLAGS = (('door', BOARD_FLAG_DOOR), ('alarm', BOARD_FLAG_ALARM),
+               ('note', BOARD_FLAG_NOTE), ('bedew', BOARD_FLAG_BEDEW))
+
+# Fleet polling
+FLEET_PARALLEL = 16 # Max. ovens to talk to at once
+FLEET_TIMEOUT  = 10 # Time (in seconds) to wait for each oven in a sweep
+
 # Safety limits
 OVENSAFE_MAXTEMP = 180 # Rated max. temperature setting
 OVENSAFE_MINTEMP = -40 # Rated min. temperature setting
@@ -165,8 +237,9 @@ class ModbusException(Exception):
 class ModbusShortMessageException(ModbusException):
     """Indicate that a MODBus message was too short
     
-    This is used internally by the parse_*_response functions and caught by
-    the OvenCtl.do_* methods.  User code should never see it."""
+    This is used internally by the parse_*_response functions, to say that
+    more bytes are needed.  MbFrameDecoder also raises it if the connection
+    is closed before a whole response has arrived."""
     def __init__(self, length, wanted, msgbytes):
         """Construct a ModbusShortMessageException
         
@@ -324,17 +397,99 @@ class SafetyTempException(SafetyException):
 class SafetyDoorException(SafetyException):
     """Indicate that the door of the oven is open"""
 
-def calc_crc16(msg): # string -> int
-    """Calculate the CRC16 checksum according to secn 2.8 of the techspec"""
-    crc = 0xffff
-    for byte in msg:
-        crc ^= ord(byte)
+def _monotonic_source(): # () -> function
+    """Find a clock (in seconds) that wall-clock adjustments don't move
+
+    Python 3 has time.monotonic; on Python 2 under Linux we call
+    clock_gettime(CLOCK_MONOTONIC) ourselves.  Anywhere else we have to
+    make do with time.time."""
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if not sys.platform.startswith('linux'):
+        return time.time
+    try:
+        import ctypes, ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        for lib in ('rt', 'c'):
+            name = ctypes.util.find_library(lib)
+            if name is None: continue
+            clock_gettime = getattr(ctypes.CDLL(name), 'clock_gettime', None)
+            if clock_gettime is not None: break
+        else:
+            return time.time
+    except (ImportError, OSError):
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 1
+    def monotonic():
+        ts = timespec()
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+# monotonic() -> float: seconds since some arbitrary point, never going back
+monotonic = _monotonic_source()
+
+def _make_crc16_table():
+    """Build the 256-entry lookup table used by calc_crc16 and Crc16
+    
+    Entry n is the result of running the bitwise algorithm of secn 2.8 of
+    the techspec over the byte n, starting from a zero register"""
+    table = []
+    for byte in xrange(256):
+        crc = byte
         for bit in xrange(8):
             sbit = crc&1
             crc>>=1
             crc^=sbit*0xA001
+        table.append(crc)
+    return tuple(table)
+
+CRC16_TABLE = _make_crc16_table()
+CRC16_INIT = 0xffff
+
+def crc16_update(crc, msg): # (int, string) -> int
+    """Feed the bytes of msg into a running CRC16 register, crc
+    
+    msg may be a string or a bytearray
+    
+    Returns the updated register.  Start from CRC16_INIT"""
+    table = CRC16_TABLE
+    if not isinstance(msg, bytearray):
+        msg = bytearray(msg)
+    for byte in msg:
+        crc = (crc>>8) ^ table[(crc^byte)&0xff]
     return crc
 
+def calc_crc16(msg): # string -> int
+    """Calculate the CRC16 checksum according to secn 2.8 of the techspec
+    
+    This is table-driven (one lookup per byte rather than eight shifts),
+    but gives the same result as the bitwise algorithm in the techspec"""
+    return crc16_update(CRC16_INIT, msg)
+
+class Crc16(object):
+    """Incremental CRC16 calculation, for messages that arrive in pieces
+    
+    Feed bytes in with update(); value is the CRC16 of everything fed so
+    far, as calc_crc16 would have computed it over the concatenation"""
+    __slots__ = ('value',)
+    def __init__(self, msg=''):
+        """Construct a Crc16, optionally feeding it an initial msg"""
+        self.value = crc16_update(CRC16_INIT, msg)
+    def update(self, msg):
+        """Feed the bytes of msg into the CRC.  Returns self"""
+        self.value = crc16_update(self.value, msg)
+        return self
+    def reset(self):
+        """Restart the CRC as if no bytes had been fed.  Returns self"""
+        self.value = CRC16_INIT
+        return self
+    def digest(self):
+        """Return the CRC as it is sent on the wire (little-endian)"""
+        return struct.pack('<H', self.value)
+
 def encode_float(value): # float -> [int, int]
     """Encode a float into MODBus format as in secn 2.11.1 of the techspec"""
     words=struct.unpack('>HH', struct.pack('>f', value))
@@ -380,10 +535,7 @@ def parse_readn_response(msgbytes): # string -> [int...]
     if crc != checkcrc:
         raise ModbusCrcException(crc, checkcrc, msgbytes)
     n_words = n_bytes>>1
-    words = []
-    for word in xrange(n_words):
-        words.extend(struct.unpack('>H', msgbytes[3+word*2:5+word*2]))
-    return words
+    return list(struct.unpack('>%dH' % n_words, msgbytes[3:3+n_bytes]))
 
 def make_write_request(addr, value): # (int, int) -> string
     """Build a "Write one word" MODBus request string
@@ -423,12 +575,25 @@ def make_writen_request(addr, words): # (int, [int...]) -> string
     
     Techspec: 2.9.3"""
     n_words = len(words)
-    msg = struct.pack('>BBHHB', MB_SLAVEADDR, MB_FN_WRITEN, addr, n_words,
-        n_words*2)
-    for word in words:
-        msg += struct.pack('>H', word)
+    msg = struct.pack('>BBHHB%dH' % n_words, MB_SLAVEADDR, MB_FN_WRITEN, addr,
+        n_words, n_words*2, *words)
     return msg + struct.pack('<H', calc_crc16(msg))
 
+def request_len(msgbytes): # string -> int or None
+    """Work out the length of a request frame from its first bytes
+    
+    This is for the server end (see ovensim and ovenproxy)
+    
+    Returns None if more bytes are needed to tell"""
+    if len(msgbytes) < 2:
+        return None
+    func = ord(msgbytes[1])
+    if func == MB_FN_WRITEN:
+        if len(msgbytes) < 7:
+            return None
+        return 9 + ord(msgbytes[6])
+    return 8 # READN, WRITE, and (we assume) anything else
+
 def parse_writen_response(msgbytes): # string -> (int, int)
     """Parse a "Write more than one word" MODBus response string
     
@@ -472,22 +637,777 @@ def parse_err_response(msgbytes): # string -> (bool, int)
         raise ModbusCrcException(crc, checkcrc, msgbytes)
     return True, ecode
 
+# Register map
+#  (name, address, type, length in words, access)
+#  type is one of "int", "float", "text"; access is "r" or "rw"
+OVEN_REGISTER_TABLE = (
+    ('curtemp',    OVENADDR_CURTEMP,    "float", 2,    "r"),
+    ('setpoint',   OVENADDR_SETPOINT,   "float", 2,    "r"),
+    ('mansetpt',   OVENADDR_MANSETPT,   "float", 2,    "rw"),
+    ('basicsetpt', OVENADDR_BASICSETPT, "float", 2,    "rw"),
+    ('mode',       OVENADDR_MODE,       "int",   1,    "rw"),
+    ('oplines',    OVENADDR_OPLINES,    "int",   1,    "rw"),
+    ('dooropen',   OVENADDR_DOOROPEN,   "int",   1,    "r"),
+    ('templimit',  OVENADDR_TEMPLIMIT,  "int",   1,    "r"),
+    ('alrmtext',   OVENADDR_ALRMTEXT,   "text",  0x14, "r"),
+    ('alarm',      OVENADDR_ALARM,      "int",   1,    "r"),
+    ('note',       OVENADDR_NOTE,       "int",   1,    "r"),
+)
+
+# Read planner limits
+PLAN_MAX_GAP   = 4  # Max. unwanted words to read to join two registers
+PLAN_MAX_WORDS = 32 # Max. words in a single READN
+
+class OvenRegister(object):
+    """Description of a single oven register (or run of words)"""
+    __slots__ = ('name', 'addr', 'kind', 'length', 'access')
+    def __init__(self, name, addr, kind, length, access):
+        """Construct an OvenRegister
+        
+        Parameters:
+            name: the name by which the register is looked up
+            addr: the address of the (first word of the) register
+            kind: "int", "float" or "text"
+            length: the length of the register in words
+            access: "r" (read-only) or "rw" (read/write)"""
+        self.name = name
+        self.addr = addr
+        self.kind = kind
+        self.length = length
+        self.access = access
+    def __repr__(self):
+        return "OvenRegister(%r, 0x%04x, %r, %d, %r)" % (self.name,
+            self.addr, self.kind, self.length, self.access)
+    def end(self):
+        """Return the address just past the end of the register"""
+        return self.addr + self.length
+    def decode(self, words): # [int...] -> int, float, string or None
+        """Decode the value of the register from the words read
+        
+        text registers are stored one byte to a word; if they're all
+        spaces, None is returned"""
+        if self.kind == "float":
+            return decode_float(words)
+        elif self.kind == "int":
+            return words[0]
+        elif self.kind == "text":
+            if not len(filter(lambda x: x!=0x20, words)): return None
+            return ''.join(map(lambda x: chr(x&0xff), words))
+        raise Exception("Register", self.name, "has invalid type", self.kind)
+    def encode(self, value): # int or float -> [int...]
+        """Encode value into words to be written to the register"""
+        if self.kind == "float":
+            return list(encode_float(value))
+        elif self.kind == "int":
+            return [value]
+        raise Exception("Register", self.name, "can't encode type", self.kind)
+
+OVEN_REGISTERS = tuple(OvenRegister(*r) for r in OVEN_REGISTER_TABLE)
+OVENREG = dict((r.name, r) for r in OVEN_REGISTERS)
+
+def plan_reads(regs, max_gap=PLAN_MAX_GAP, max_words=PLAN_MAX_WORDS,
+               avoid=()):
+    """Plan the READN requests needed to read a set of registers
+    
+    Adjacent (or nearly adjacent) registers are coalesced into a single
+    READN, as long as no more than max_gap unwanted words lie between them
+    and the whole READN is no longer than max_words.  Registers longer than
+    max_words are still read in one go.
+    
+    avoid is a list of (start, end) address ranges which are known to
+    produce errors (eg. MBER, 'parameter value outside range') and which
+    must therefore never be read as part of a gap.
+    
+    Returns a list of (addr, n_words, [OvenRegister...])"""
+    plan = []
+    for reg in sorted(set(regs), key=lambda r: (r.addr, r.length)):
+        if len(plan):
+            addr, n_words, group = plan[-1]
+            end = addr + n_words
+            gap_bad = any(s < reg.addr and e > end for s, e in avoid)
+            if (reg.addr - end <= max_gap and
+                    max(end, reg.end()) - addr <= max_words and
+                    not gap_bad):
+                group.append(reg)
+                plan[-1] = (addr, max(end, reg.end()) - addr, group)
+                continue
+        plan.append((reg.addr, reg.length, [reg]))
+    return plan
+
+def replan_failed_read(group, bad_gaps):
+    """Re-plan a coalesced READN of group which got an error
+    
+    We don't know which of the gaps between the registers in group was
+    unreadable, so all of them are added to bad_gaps (a set of (start, end)
+    address ranges, suitable for plan_reads' avoid).
+    
+    Returns a list of READNs (as plan_reads) for the registers singly"""
+    for prev, reg in zip(group, group[1:]):
+        if reg.addr > prev.end():
+            bad_gaps.add((prev.end(), reg.addr))
+    return [(reg.addr, reg.length, [reg]) for reg in group]
+
+def decode_read(addr, words, group, values):
+    """Decode the registers in group from words read at address addr
+    
+    The results are stored in values, a dict of {name: value}"""
+    for reg in group:
+        off = reg.addr - addr
+        values[reg.name] = reg.decode(words[off:off+reg.length])
+
+# Register cache lifetimes, in seconds (0 means never cache)
+#  Alarm, note and door are safety-critical, so they're always read fresh
+CACHE_TTL_TABLE = (
+    ('curtemp',    2),
+    ('setpoint',   30),
+    ('mansetpt',   30),
+    ('basicsetpt', 30),
+    ('mode',       30),
+    ('oplines',    30),
+    ('dooropen',   0),
+    ('templimit',  0),
+    ('alrmtext',   0),
+    ('alarm',      0),
+    ('note',       0),
+)
+#  Writing to a register also changes these other registers
+CACHE_ALIAS_TABLE = (
+    ('mansetpt',   ('setpoint',)),
+    ('basicsetpt', ('setpoint',)),
+)
+
+class RegisterCache(object):
+    """A read-through cache of oven register contents, for OvenCtl
+    
+    Words are cached individually, each with the lifetime (TTL) of the
+    register it belongs to.  Any write to an address invalidates it, along
+    with any registers that CACHE_ALIAS_TABLE says the write affects.
+    
+    Attributes:
+        hits: number of reads satisfied from the cache
+        misses: number of reads that had to go to the oven"""
+    def __init__(self, ttls=None, default_ttl=0):
+        """Construct a RegisterCache
+        
+        Parameters:
+            ttls: dict of {register name: TTL in seconds}, overriding
+             the defaults in CACHE_TTL_TABLE
+            default_ttl: TTL for words not in any known register"""
+        ttl_table = dict(CACHE_TTL_TABLE)
+        if ttls is not None:
+            ttl_table.update(ttls)
+        self.default_ttl = default_ttl
+        self.word_ttl = {}
+        for name, ttl in ttl_table.iteritems():
+            reg = OVENREG[name]
+            for addr in xrange(reg.addr, reg.end()):
+                self.word_ttl[addr] = ttl
+        self.aliases = {}
+        for name, others in CACHE_ALIAS_TABLE:
+            reg = OVENREG[name]
+            self.aliases[reg.addr] = tuple(OVENREG[o] for o in others)
+        self.words = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, addr, n_words): # (int, int) -> [int...] or None
+        """Look up n_words words at address addr, counting a hit or miss
+        
+        Returns the list of words, or None if any of them aren't cached
+        (or have expired)"""
+        words = self.lookup(addr, n_words)
+        if words is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return words
+
+    def lookup(self, addr, n_words): # (int, int) -> [int...] or None
+        """As get, but without counting a hit or miss"""
+        now = time.time()
+        words = []
+        for a in xrange(addr, addr+n_words):
+            entry = self.words.get(a)
+            if entry is None or entry[1] <= now:
+                return None
+            words.append(entry[0])
+        return words
+
+    def put(self, addr, words):
+        """Record words just read from address addr"""
+        now = time.time()
+        for a, word in enumerate(words, addr):
+            ttl = self.word_ttl.get(a, self.default_ttl)
+            if ttl > 0:
+                self.words[a] = (word, now+ttl)
+
+    def invalidate(self, addr, n_words):
+        """Forget n_words words at address addr, and any aliases"""
+        for a in xrange(addr, addr+n_words):
+            self.words.pop(a, None)
+            for reg in self.aliases.get(a, ()):
+                self.invalidate(reg.addr, reg.length)
+
+    def clear(self):
+        """Forget everything (but keep the hit/miss counts)"""
+        self.words.clear()
+
+    def stats(self):
+        """Return a dict of {'hits', 'misses', 'ratio'}
+        
+        ratio is the fraction of reads which hit, or None if no reads"""
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'ratio': float(self.hits)/total if total else None}
+
+SHADOW_REFRESH = 60 # Default time (in seconds) to trust a shadow register
+
+class ShadowRegisters(RegisterCache):
+    """Shadow copies of the words written to the oven, for OvenCtl
+    
+    Each word written (and acknowledged by the oven) is remembered for
+    refresh seconds.  Writing the same value again within that time is
+    skipped, since it would change nothing; after that the next write goes
+    to the oven again, so a change made elsewhere (eg. on the oven's front
+    panel) is put right within refresh seconds.
+    
+    Attributes:
+        skipped: number of writes skipped as redundant
+        written: number of writes sent to the oven"""
+    def __init__(self, refresh=SHADOW_REFRESH):
+        """Construct a ShadowRegisters
+        
+        Parameter: refresh: time in seconds for which to trust a shadow"""
+        RegisterCache.__init__(self, dict((name, refresh) for name, ttl
+                                          in CACHE_TTL_TABLE), refresh)
+        self.skipped = 0
+        self.written = 0
+
+    def stats(self):
+        """Return a dict of {'skipped', 'written'}"""
+        return {'skipped': self.skipped, 'written': self.written}
+
+class MbFrameDecoder(object):
+    """Incrementally receive and decode a single MODBus response frame
+    
+    The frame is assembled in a preallocated buffer.  As soon as the
+    3-byte header has arrived, the decoder knows how long the whole frame
+    will be (and whether it's an error response), so it never asks for
+    more bytes than the frame contains.  The CRC16 is accumulated as the
+    bytes arrive and checked once, when the frame is complete.
+    
+    Usage:
+        decoder = MbFrameDecoder(MB_FN_READN, n_words)
+        while not decoder.recv_from(sock):
+            pass
+        words = decoder.result()
+    or, if you're getting the bytes from somewhere other than a socket,
+    call feed(string) instead of recv_from(sock), and need() to find out
+    how many more bytes the decoder wants"""
+    HEADER_LEN = 3 # slave_addr, function, n_bytes/ecode
+    def __init__(self, func, n_words=0):
+        """Construct an MbFrameDecoder
+        
+        Parameters:
+            func: the Function code of the request (MB_FN_*)
+            n_words: for READN, the number of words requested"""
+        self.func = func
+        if mb_fn_is_readn(func):
+            # slave_addr, function, n_bytes, value(n_words)(2), crc(2)
+            size = 5+(n_words*2)
+        else:
+            # slave_addr, function, addr(2), data/length(2), crc(2)
+            size = 8
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.reset()
+
+    def reset(self):
+        """Discard any partial frame, ready to receive a new one"""
+        self.have = 0
+        self.want = self.HEADER_LEN
+        self.crc = Crc16()
+        self.crced = 0
+        self.iserr = False
+
+    def need(self):
+        """Return the number of bytes still needed to complete the frame"""
+        return self.want - self.have
+
+    def done(self):
+        """Return True if a whole frame has been received"""
+        return self.want == self.have
+
+    def frame(self): # -> string
+        """Return the bytes received so far, as a string"""
+        return bytes(self.buf[:self.have])
+
+    def recv_from(self, sock):
+        """Receive as much of the frame as is available from sock
+        
+        Blocks (subject to the socket timeout) until at least one byte
+        arrives.  Returns True if the frame is now complete
+        
+        Can raise:
+            ModbusShortMessageException: Connection closed mid-frame
+            ModbusException: Bad frame header
+            socket.error"""
+        n = sock.recv_into(self.view[self.have:self.want])
+        if not n:
+            raise ModbusShortMessageException(self.have, self.want,
+                                              self.frame())
+        return self._advance(n)
+
+    def feed(self, msgbytes):
+        """Add msgbytes, a string, to the frame
+        
+        msgbytes must not be longer than need().  Returns True if the frame
+        is now complete
+        
+        Can raise: ModbusException: Bad frame header"""
+        n = len(msgbytes)
+        if n > self.need():
+            raise ModbusBadResponseException(self.frame() + msgbytes)
+        self.view[self.have:self.have+n] = msgbytes
+        return self._advance(n)
+
+    def _advance(self, n):
+        """Account for n new bytes in the buffer; returns done()"""
+        self.have += n
+        if self.want == self.HEADER_LEN and self.have == self.HEADER_LEN:
+            self.want = self._frame_len()
+        end = min(self.have, self.want-2) # don't CRC the CRC
+        if end > self.crced:
+            self.crc.update(self.buf[self.crced:end])
+            self.crced = end
+        return self.done()
+
+    def _frame_len(self):
+        """Work out the total frame length from the header"""
+        func = self.buf[1]
+        if func&0x80:
+            self.iserr = True
+            return 5 # slave_addr, function, ecode, crc(2)
+        if mb_fn_is_readn(self.func):
+            if not mb_fn_is_readn(func):
+                raise ModbusFunctionException(func, MB_FN_READN, self.frame())
+            n_bytes = self.buf[2]
+            if n_bytes&1:
+                raise ModbusException("Odd number of bytes read",
+                                      self.frame())
+            if 5+n_bytes != len(self.buf):
+                # not the number of words we asked for
+                raise ModbusBadResponseException(self.frame())
+        elif func != self.func:
+            raise ModbusFunctionException(func, self.func, self.frame())
+        return len(self.buf)
+
+    def result(self):
+        """Check and decode the completed frame
+        
+        Returns, depending on the function code:
+            READN: a list of words read
+            WRITE: (address written to, value written)
+            WRITEN: (address written to, number of words written)
+        
+        Can raise:
+            ModbusShortMessageException: Frame not yet complete
+            ModbusCrcException
+            ModbusErrorException: Remote sent an error response"""
+        if not self.done():
+            raise ModbusShortMessageException(self.have, self.want,
+                                              self.frame())
+        crc, = struct.unpack_from('<H', self.buf, self.want-2)
+        if crc != self.crc.value:
+            raise ModbusCrcException(crc, self.crc.value, self.frame())
+        if self.iserr:
+            raise ModbusErrorException(self.buf[2], self.frame())
+        if mb_fn_is_readn(self.func):
+            n_words = (self.want-5)>>1
+            return list(struct.unpack_from('>%dH' % n_words, self.buf, 3))
+        return struct.unpack_from('>HH', self.buf, 2)
+
+# Instrumentation: upper bounds (in ms) of latency histogram buckets
+HIST_BOUNDS = tuple(0.25 * 2**i for i in xrange(17)) # 0.25ms to 16s
+
+class TransactionEvent(object):
+    """Details of a single transaction, as passed to OvenObserver.transaction
+    
+    Attributes:
+        oven: the OvenCtl
+        func: the MODBus function code (MB_FN_*)
+        addr: the address read or written
+        words: the number of words read or written
+        connect_ms: time taken to connect, or None if an already-open
+         connection (see OvenCtl.session) was used or connecting failed
+        rtt_ms: time from sending the request to receiving the response
+         (or failing to), or None if the request was never sent
+        bytes_sent, bytes_received: the numbers of bytes actually sent and
+         received
+        retries: the number of failed connection attempts
+        exception: the class name of the exception raised, or None
+        time: time.time() when the transaction finished"""
+    __slots__ = ('oven', 'func', 'addr', 'words', 'connect_ms', 'rtt_ms',
+                 'bytes_sent', 'bytes_received', 'retries', 'exception',
+                 'time')
+    def __init__(self, oven, req):
+        """Construct a TransactionEvent for req, a request string"""
+        self.oven = oven
+        self.func, self.addr, count = struct.unpack('>xBHH', req[:6])
+        self.words = 1 if self.func == MB_FN_WRITE else count
+        self.connect_ms = None
+        self.rtt_ms = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.exception = None
+        self.time = None
+
+class OvenObserver(object):
+    """Base class for OvenCtl instrumentation observers
+    
+    Set an OvenCtl's observer attribute to an instance of (a subclass of)
+    this to be told about each transaction.  The methods here do nothing,
+    except for connect_retry, which prints as OvenCtl always used to"""
+    def transaction(self, event):
+        """Called after each transaction with a TransactionEvent"""
+    def connect_retry(self, oven, err, left):
+        """Called when a connection attempt fails, with left tries left"""
+        print '%s; %d tries left' % (err, left)
+
+class LatencyHistogram(object):
+    """Histogram of latencies, in log2-spaced buckets (see HIST_BOUNDS)"""
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+    def __init__(self):
+        """Construct an empty LatencyHistogram"""
+        self.counts = [0] * (len(HIST_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+    def add(self, ms):
+        """Record a latency of ms milliseconds"""
+        self.counts[bisect.bisect_left(HIST_BOUNDS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if self.min is None or ms < self.min: self.min = ms
+        if self.max is None or ms > self.max: self.max = ms
+    def percentile(self, pct):
+        """Estimate the pct'th percentile (as the upper bound of its bucket)
+        
+        Returns None if the histogram is empty"""
+        if not self.count: return None
+        want = self.count * pct / 100.0
+        seen = 0
+        for bound, count in zip(HIST_BOUNDS, self.counts):
+            seen += count
+            if seen >= want:
+                return min(bound, self.max)
+        return self.max
+    def dump(self):
+        """Return a summary as a dict"""
+        return {'count': self.count, 'min': self.min, 'max': self.max,
+                'mean': self.total/self.count if self.count else None,
+                'p50': self.percentile(50), 'p99': self.percentile(99),
+                'buckets': dict((str(bound), count) for bound, count in
+                                zip(HIST_BOUNDS + ('inf',), self.counts)
+                                if count)}
+
+class TransactionStats(OvenObserver):
+    """An OvenObserver which aggregates transaction statistics in memory
+    
+    Statistics are kept per oven ('hostname:port') and, within that, per
+    register (function and address, named from OVEN_REGISTER_TABLE where
+    possible).  One TransactionStats can be shared by many OvenCtls (eg. a
+    Fleet's).  Use dump() to get the statistics"""
+    def __init__(self, quiet=False):
+        """Construct a TransactionStats
+        
+        If quiet is True, connection retries aren't printed"""
+        self.lock = threading.Lock()
+        self.quiet = quiet
+        self.ovens = {}
+        self.names = dict((r.addr, r.name) for r in OVEN_REGISTERS)
+    def _oven_stats(self, oven):
+        key = '%s:%s' % (oven.hostname, oven.port)
+        stats = self.ovens.get(key)
+        if stats is None:
+            stats = {'transactions': 0, 'connects': 0, 'retries': 0,
+                     'bytes_sent': 0, 'bytes_received': 0, 'errors': {},
+                     'connect': LatencyHistogram(), 'rtt': LatencyHistogram(),
+                     'registers': {}}
+            self.ovens[key] = stats
+        return stats
+    def transaction(self, event):
+        key = '%02x:%s' % (event.func, self.names.get(event.addr,
+                                                      '%04x' % event.addr))
+        with self.lock:
+            stats = self._oven_stats(event.oven)
+            stats['transactions'] += 1
+            stats['retries'] += event.retries
+            stats['bytes_sent'] += event.bytes_sent
+            stats['bytes_received'] += event.bytes_received
+            if event.connect_ms is not None:
+                stats['connects'] += 1
+                stats['connect'].add(event.connect_ms)
+            reg = stats['registers'].get(key)
+            if reg is None:
+                reg = stats['registers'][key] = {'rtt': LatencyHistogram(),
+                                                 'errors': {}}
+            if event.rtt_ms is not None:
+                stats['rtt'].add(event.rtt_ms)
+                reg['rtt'].add(event.rtt_ms)
+            if event.exception is not None:
+                for errors in (stats['errors'], reg['errors']):
+                    errors[event.exception] = errors.get(event.exception,
+                                                         0) + 1
+    def connect_retry(self, oven, err, left):
+        # Retries are counted in the transaction's event
+        if not self.quiet:
+            OvenObserver.connect_retry(self, oven, err, left)
+    def dump(self):
+        """Return the aggregated statistics as a dict (suitable for JSON)
+        
+        {'hostname:port': {'transactions', 'connects', 'retries',
+                           'bytes_sent', 'bytes_received',
+                           'errors': {exception class: count},
+                           'connect': histogram, 'rtt': histogram,
+                           'registers': {'fn:register': {
+                               'rtt': histogram,
+                               'errors': {exception class: count}}}}}
+        where each histogram is as LatencyHistogram.dump"""
+        with self.lock:
+            result = {}
+            for key, stats in self.ovens.iteritems():
+                d = dict(stats)
+                d['errors'] = dict(stats['errors'])
+                d['connect'] = stats['connect'].dump()
+                d['rtt'] = stats['rtt'].dump()
+                d['registers'] = dict((rkey, {'rtt': reg['rtt'].dump(),
+                                              'errors': dict(reg['errors'])})
+                                      for rkey, reg in
+                                      stats['registers'].iteritems())
+                result[key] = d
+            return result
+    def reset(self):
+        """Discard all the statistics gathered so far"""
+        with self.lock:
+            self.ovens.clear()
+
+# Idle timers of all OvenCtl sessions, so they can be stopped at exit
+_idle_timers = weakref.WeakSet()
+
+@atexit.register
+def _stop_idle_timers():
+    """Cancel and reap idle timers, so they don't outlive the interpreter"""
+    for timer in list(_idle_timers):
+        timer.cancel()
+        timer.join()
+
+def mode_names(mode): # int -> [str...]
+    """Describe an operating mode bitmask as a list of strings
+    
+    See OvenCtl.get_mode"""
+    modes = []
+    if mode&0x1000:
+        modes.append("basic")
+    if mode&0x0800:
+        modes.append("manual")
+    if mode&0x0400:
+        modes.append("auto")
+    if not len(modes):
+        modes.append("idle")
+    return modes
+
+# Status snapshot fields
+#  (field, register, conversion from register value)
+OVEN_STATUS_TABLE = (
+    ('alarm',      'alarm',    bool),
+    ('note',       'note',     bool),
+    ('alarm_text', 'alrmtext', None),
+    ('mode',       'mode',     None),
+    ('bedew',      'oplines',  lambda v: bool(v&1)),
+    ('door',       'dooropen', bool),
+    ('temp',       'curtemp',  None),
+    ('setpoint',   'setpoint', None),
+)
+OVEN_STATUS_FIELDS = tuple(f[0] for f in OVEN_STATUS_TABLE)
+
+class OvenStatus(object):
+    """An immutable snapshot of oven status, as returned by OvenCtl.snapshot
+    
+    Attributes:
+        alarm: bool, True if an Alarm is active
+        note: bool, True if a Note is active
+        alarm_text: text of the Alarm or Note, or None if there is none
+        mode: operating mode bitmask (see OvenCtl.get_mode)
+        modes: operating mode as a list of strings (see OvenCtl.get_mode)
+        bedew: bool, True if bedew protection is active
+        door: bool, True if the door is open
+        temp: current temperature, in degrees Celsius
+        setpoint: temperature setpoint, in degrees Celsius
+        time: time.time() when the snapshot was completed
+        elapsed: how long the snapshot took to fetch, in seconds
+        errors: dict of {field: ModbusException} for fields which couldn't
+            be read (see OvenCtl.snapshot's partial argument), or None
+    Fields which weren't fetched are None"""
+    __slots__ = OVEN_STATUS_FIELDS + ('time', 'elapsed', 'errors')
+    def __init__(self, **kwargs):
+        """Construct an OvenStatus; any field not given is None"""
+        for field in self.__slots__:
+            object.__setattr__(self, field, kwargs.pop(field, None))
+        if len(kwargs):
+            raise TypeError("Unknown OvenStatus fields", kwargs.keys())
+    def __setattr__(self, name, value):
+        raise AttributeError("OvenStatus is immutable")
+    def __delattr__(self, name):
+        raise AttributeError("OvenStatus is immutable")
+    def __repr__(self):
+        return "OvenStatus(%s)" % ', '.join("%s=%r" % (field,
+            getattr(self, field)) for field in self.__slots__)
+    @property
+    def modes(self):
+        if self.mode is None: return None
+        return mode_names(self.mode)
+    @classmethod
+    def from_registers(cls, table, regs, start, end, errors=None):
+        """Construct an OvenStatus from registers read
+        
+        Parameters:
+            table: the rows of OVEN_STATUS_TABLE for the fields wanted
+            regs: dict of {register name: value}, as read_registers
+            start, end: time.time() before and after reading regs
+            errors: dict of {field: ModbusException} for the fields of
+                table which couldn't be read, and so aren't in regs"""
+        values = {}
+        for field, reg, conv in table:
+            if errors and field in errors: continue
+            values[field] = conv(regs[reg]) if conv else regs[reg]
+        return cls(time=end, elapsed=end-start, errors=errors, **values)
+
+def status_table(fields): # [str...] -> [(str, str, function)...]
+    """Return the rows of OVEN_STATUS_TABLE for the given fields"""
+    return filter(lambda f: f[0] in fields, OVEN_STATUS_TABLE)
+
+def safety_registers(force=False): # bool -> [str...]
+    """Return the names of the registers check_registers_safe needs"""
+    names = ['alarm', 'note', 'alrmtext']
+    if not force:
+        names.append('dooropen')
+    return names
+
+def check_registers_safe(regs, force=False):
+    """Check registers read (see safety_registers) for a safe state
+    
+    This is the guts of OvenCtl.check_safety; see there
+    
+    Can raise: SafetyException: Oven in unsafe state"""
+    text = (regs['alrmtext'] or '').strip()
+    if regs['alarm']: raise SafetyAlarmException(text)
+    if (not force):
+        if regs['dooropen']: raise SafetyDoorException("Door is open")
+        if regs['note']: raise SafetyNoteException(text)
+
+def check_setpoint_range(setpoint):
+    """Check a temperature setpoint is within the oven's rated range
+    
+    Can raise: SafetyTempException"""
+    if setpoint < OVENSAFE_MINTEMP:
+        raise SafetyTempException(False, setpoint, OVENSAFE_MINTEMP)
+    if setpoint > OVENSAFE_MAXTEMP:
+        raise SafetyTempException(True, setpoint, OVENSAFE_MAXTEMP)
+
+class TempTrend(object):
+    """Estimate where the oven temperature is heading, from recent readings
+    
+    Fits a least-squares straight line to the last few readings.  As the
+    approach to setpoint is roughly exponential, the ETA this gives is on
+    the early side near the end; that only makes wait_for_temp look again
+    sooner, which is the safe way to be wrong."""
+    def __init__(self, points=TREND_POINTS):
+        self.readings = collections.deque(maxlen=points) # (time, temp)
+    def add(self, when, temp):
+        """Add a reading of temp, taken at time when (in seconds)"""
+        self.readings.append((when, temp))
+    def slope(self): # () -> float or None
+        """Rate of change of temperature, in deg C per second
+        
+        Returns None if there aren't enough readings to tell"""
+        n = float(len(self.readings))
+        if n < 2: return None
+        mt = sum(t for t, x in self.readings) / n
+        mx = sum(x for t, x in self.readings) / n
+        stt = sum((t - mt) ** 2 for t, x in self.readings)
+        if not stt: return None
+        return sum((t - mt) * (x - mx) for t, x in self.readings) / stt
+    def eta(self, setpoint, limit): # (float, float) -> float or None
+        """Predict how long until the temperature is within limit of setpoint
+        
+        Returns the time in seconds from the latest reading (0 if that was
+        already close), or None if the temperature isn't heading that way"""
+        if not self.readings: return None
+        temp = self.readings[-1][1]
+        if temp < setpoint - limit:
+            gap = setpoint - limit - temp
+        elif temp > setpoint + limit:
+            gap = setpoint + limit - temp
+        else:
+            return 0.0
+        slope = self.slope()
+        if not slope or (gap > 0) != (slope > 0): return None
+        return gap / slope
+
+def approach_delay(eta): # float -> float
+    """Time (in seconds) to wait for the next reading, ETA seconds from temp"""
+    return min(max(eta * WAIT_POLL_FRACTION, WAIT_POLL_MIN), WAIT_POLL_MAX)
+
+def format_eta(seconds): # float -> str
+    """Format an ETA (in seconds) as h:mm:ss"""
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
 class OvenCtl(object):
     """Control a single oven"""
-    def __init__(self, hostname, port=BINDER_PORT, timeout=2.5, retries=3):
+    def __init__(self, hostname, port=BINDER_PORT, timeout=2.5, retries=3,
+                 session_idle=SESSION_IDLE, cache=None, shadow=None):
         """Construct an OvenCtl instance to control an oven
         
         Parameters:
             hostname: the hostname or IP address of the oven
             port: the port to connect on (default 10001)
             timeout: the connect timeout in seconds (default 2.5)
-            retries: the number of times to retry connection"""
+            retries: the number of times to retry connection
+            session_idle: time in seconds after which a connection held
+             by session() is released if unused (default 0.5)
+            cache: a RegisterCache to cache reads in (default no cache)
+            shadow: a ShadowRegisters to skip redundant writes with
+             (default none)"""
         self.hostname = hostname
         self.port = port
         self.timeout = timeout
         self.retries = retries
+        # Session mode; see session()
+        self.session_idle = session_idle
+        self.lock = threading.RLock()
+        self._sock = None
+        self._sessions = 0
+        self._last_used = 0
+        self._idle_timer = None
+        # read_registers planning; see plan_reads
+        self.plan_max_gap = PLAN_MAX_GAP
+        self.plan_max_words = PLAN_MAX_WORDS
+        self.bad_gaps = set()
+        self.cache = cache
+        self.shadow = shadow
+        self._checked_safe = None # (force, time) of last check; see check_safety
+        self.watcher = None # see watch
+        self._watch_lock = threading.Lock()
+        # Instrumentation; see OvenObserver
+        self.observer = None
+        self.connect_retries = 0
 
     def connect_with_retry(self):
+        self.connect_retries = 0
         if not self.retries: return socket.create_connection((self.hostname, self.port), self.timeout)
         delay = 0.01
         for i in xrange(self.retries):
@@ -496,95 +1416,292 @@ class OvenCtl(object):
                 return sock
             except socket.error as err:
                 left = self.retries - i - 1
-                print '%s; %d tries left' % (err, left)
+                self.connect_retries = i + 1
+                if self.observer is None:
+                    print '%s; %d tries left' % (err, left)
+                else:
+                    self.observer.connect_retry(self, err, left)
                 if left == 0:
                     raise err
             time.sleep(delay)
             delay *= 2
 
+    @contextlib.contextmanager
+    def session(self):
+        """Context manager to hold one connection for a burst of operations
+        
+        Usage:
+            with oven.session():
+                [several operations]
+        
+        Normally each transaction opens and closes its own connection.
+        Within a session the first transaction's connection is kept open and
+        reused; if it fails it is transparently reopened.  It is closed when
+        the (outermost) session ends, or when it has been idle for
+        self.session_idle seconds, since the XPort-03 only accepts one
+        connection at a time and no-one else can talk to the oven while we
+        hold it.  So it's fine to sleep inside a session, but you won't save
+        anything by doing so.
+        
+        Sessions can be nested, and can be used from several threads at
+        once; transactions are serialised by self.lock.  If you need a
+        sequence of operations to be atomic with respect to other threads,
+        hold self.lock as well:
+            with oven.lock, oven.session():
+                [several operations]"""
+        with self.lock:
+            self._sessions += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self._sessions -= 1
+                if not self._sessions:
+                    self._checked_safe = None
+                    self.release()
+
+    def release(self):
+        """Close the connection held by session(), if any.  Returns None
+        
+        The session itself carries on, and will reconnect if needed"""
+        with self.lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            if self._sock is not None:
+                try:
+                    self._sock.close()
+                finally:
+                    self._sock = None
+
+    def _idle_check(self):
+        """Idle timer callback: release the connection if it's idle"""
+        with self.lock:
+            self._idle_timer = None
+            if self._sock is None:
+                return
+            left = self._last_used + self.session_idle - time.time()
+            if left > 0:
+                self._arm_idle_timer(left)
+            else:
+                self.release()
+
+    def _arm_idle_timer(self, delay):
+        """Start the idle timer, which fires after delay seconds"""
+        self._idle_timer = threading.Timer(delay, self._idle_check)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+        _idle_timers.add(self._idle_timer)
+
+    def _exchange(self, sock, req, decoder, event):
+        """Send req on sock and receive the response into decoder
+        
+        If event (a TransactionEvent) is given, the bytes sent are counted
+        in it"""
+        sock.sendall(req)
+        if event is not None:
+            event.bytes_sent += len(req)
+        while not decoder.recv_from(sock):
+            pass
+        self._last_used = time.time()
+        return decoder.result()
+
+    def transact(self, req, decoder):
+        """Send req, a request string, to the oven and receive the response
+        
+        The response is received by decoder, an MbFrameDecoder
+        
+        Outside of a session() the connection is opened and closed again
+        for each transaction
+        
+        If there is an observer, it is told about the transaction
+        
+        Returns the decoded response (see MbFrameDecoder.result)
+        
+        Can raise: ModbusException: trouble at t' mill"""
+        with self.lock:
+            observer = self.observer
+            if observer is None:
+                return self._transact(req, decoder, None)
+            event = TransactionEvent(self, req)
+            start = time.time()
+            try:
+                return self._transact(req, decoder, event)
+            except Exception as err:
+                event.exception = err.__class__.__name__
+                raise
+            finally:
+                event.time = time.time()
+                if event.bytes_sent:
+                    event.rtt_ms = (event.time - start) * 1000
+                    if event.connect_ms is not None:
+                        event.rtt_ms -= event.connect_ms
+                event.bytes_received = decoder.have
+                event.retries = self.connect_retries
+                observer.transaction(event)
+
+    def _connect(self, event):
+        """connect_with_retry, timed if event (a TransactionEvent) is given"""
+        if event is None:
+            return self.connect_with_retry()
+        start = time.time()
+        sock = self.connect_with_retry()
+        event.connect_ms = (time.time() - start) * 1000
+        return sock
+
+    def _transact(self, req, decoder, event):
+        """Guts of transact; event is a TransactionEvent or None
+        
+        Must be called with self.lock held"""
+        self.connect_retries = 0
+        if self._sock is not None:
+            try:
+                return self._exchange(self._sock, req, decoder, event)
+            except (socket.error, ModbusShortMessageException):
+                # Connection went stale; try again with a new one
+                self.release()
+                decoder.reset()
+            except ModbusErrorException:
+                raise # connection is still in sync
+            except:
+                self.release()
+                raise
+        sock = self._connect(event)
+        if not self._sessions:
+            try:
+                return self._exchange(sock, req, decoder, event)
+            finally:
+                sock.close()
+        self._sock = sock
+        try:
+            result = self._exchange(sock, req, decoder, event)
+        except ModbusErrorException:
+            raise
+        except:
+            self.release()
+            raise
+        if self._idle_timer is None:
+            self._arm_idle_timer(self.session_idle)
+        return result
+
     def do_readn(self, addr, n_words):
         """Read n_words words from the oven at address addr
         
         Returns a list of words read
         
         Can raise: ModbusException: trouble at t' mill"""
-        read_req = make_readn_request(addr, n_words)
-        sock = self.connect_with_retry()
-        try:
-            sock.send(read_req)
-            # slave_addr, function, n_bytes, value(n_words)(2), crc(2)
-            resp_len = 5+(n_words*2)
-            good_resp = False
-            resp = str()
-            while not good_resp:
-                if len(resp) >= resp_len:
-                    raise ModbusBadResponseException(resp)
-                resp += sock.recv(resp_len-len(resp))
-                iserr,e = parse_err_response(resp)
-                if iserr:
-                    raise ModbusErrorException(e, resp)
-                try:
-                    data = parse_readn_response(resp)
-                except ModbusShortMessageException:
-                    continue
-                good_resp = (len(data) == n_words)
-            return data
-        finally:
-            sock.close()
+        with self.lock:
+            if self.cache is not None:
+                words = self.cache.get(addr, n_words)
+                if words is not None:
+                    return words
+            return self._readn(addr, n_words)
+
+    def _readn(self, addr, n_words):
+        """Read n_words words from the oven, bypassing (but filling) cache
+        
+        The lock is held from the read until the cache is filled, so that a
+        write from another thread can't slip in between and be overwritten
+        in the cache by the value read before it"""
+        with self.lock:
+            words = self.transact(make_readn_request(addr, n_words),
+                                  MbFrameDecoder(MB_FN_READN, n_words))
+            if self.cache is not None:
+                self.cache.put(addr, words)
+            return words
 
     def do_write(self, addr, data):
         """Write data, a single word, to address addr on the oven
         
+        If there is a shadow, and it says the oven already holds data, the
+        write is skipped
+        
         Can raise: ModbusException: trouble at t' mill"""
-        write_req = make_write_request(addr, data)
-        sock = self.connect_with_retry()
-        try:
-            sock.send(write_req)
-            resp_len = 8 # slave_addr, function, addr(2), data(2), crc(2)
-            good_resp = False
-            resp = str()
-            while not good_resp:
-                if len(resp) >= resp_len:
-                    raise ModbusBadResponseException(resp)
-                resp += sock.recv(resp_len-len(resp))
-                iserr,e = parse_err_response(resp)
-                if iserr:
-                    raise ModbusErrorException(e, resp)
-                try:
-                    resp_addr, resp_data = parse_write_response(resp)
-                except ModbusShortMessageException:
-                    continue
-                good_resp = (resp_addr==addr) and (resp_data==data)
-            return
-        finally:
-            sock.close()
+        decoder = MbFrameDecoder(MB_FN_WRITE)
+        with self.lock:
+            if self.shadow is not None:
+                if self.shadow.lookup(addr, 1) == [data]:
+                    self.shadow.skipped += 1
+                    return
+                self.shadow.invalidate(addr, 1)
+            try:
+                resp_addr, resp_data = self.transact(
+                    make_write_request(addr, data), decoder)
+            finally:
+                if self.cache is not None:
+                    self.cache.invalidate(addr, 1)
+            if (resp_addr!=addr) or (resp_data!=data):
+                raise ModbusBadResponseException(decoder.frame())
+            if self.shadow is not None:
+                self.shadow.put(addr, [data])
+                self.shadow.written += 1
 
     def do_writen(self, addr, data): # data is a list of WORDS
         """Write data, a list of words, to the oven, starting at address addr
         
+        If there is a shadow, and it says the oven already holds data, the
+        write is skipped
+        
         Can raise: ModbusException: trouble at t' mill"""
-        write_req = make_writen_request(addr, data)
-        sock = self.connect_with_retry()
-        try:
-            sock.send(write_req)
-            resp_len = 8 # slave_addr, function, addr(2), length(2), crc(2)
-            good_resp = False
-            resp = str()
-            while not good_resp:
-                if len(resp) >= resp_len:
-                    raise ModbusBadResponseException(resp)
-                resp += sock.recv(resp_len-len(resp))
-                iserr,e = parse_err_response(resp)
-                if iserr:
-                    raise ModbusErrorException(e, resp)
-                try:
-                    resp_addr, resp_words = parse_writen_response(resp)
-                except ModbusShortMessageException:
-                    continue
-                good_resp = (resp_addr==addr) and (resp_words==len(data))
-            return
-        finally:
-            sock.close()
+        data = list(data)
+        decoder = MbFrameDecoder(MB_FN_WRITEN)
+        with self.lock:
+            if self.shadow is not None:
+                if self.shadow.lookup(addr, len(data)) == data:
+                    self.shadow.skipped += 1
+                    return
+                self.shadow.invalidate(addr, len(data))
+            try:
+                resp_addr, resp_words = self.transact(
+                    make_writen_request(addr, data), decoder)
+            finally:
+                if self.cache is not None:
+                    self.cache.invalidate(addr, len(data))
+            if (resp_addr!=addr) or (resp_words!=len(data)):
+                raise ModbusBadResponseException(decoder.frame())
+            if self.shadow is not None:
+                self.shadow.put(addr, data)
+                self.shadow.written += 1
+
+    def read_registers(self, names):
+        """Read several registers, named as in OVEN_REGISTER_TABLE
+        
+        The reads are coalesced using plan_reads, so neighbouring registers
+        cost a single READN.  If a coalesced READN gets an error (because
+        one of the words in a gap can't be read) its registers are read
+        separately instead, and the gap is remembered in self.bad_gaps so
+        it won't be read again.
+        
+        If there is a cache, registers found in it aren't read at all.
+        
+        Returns a dict of {name: value}
+        
+        Can raise: ModbusException"""
+        regs = [OVENREG[name] for name in names]
+        values = {}
+        if self.cache is not None:
+            uncached = []
+            with self.lock:
+                for reg in regs:
+                    words = self.cache.get(reg.addr, reg.length)
+                    if words is None:
+                        uncached.append(reg)
+                    else:
+                        values[reg.name] = reg.decode(words)
+            regs = uncached
+        plan = plan_reads(regs, self.plan_max_gap, self.plan_max_words,
+                          self.bad_gaps)
+        while len(plan):
+            addr, n_words, group = plan.pop(0)
+            try:
+                words = self._readn(addr, n_words)
+            except ModbusErrorException as err:
+                if len(group) < 2 or err.ecode not in (MB_EE_ADDR, MB_EE_RANGE):
+                    raise
+                plan[:0] = replan_failed_read(group, self.bad_gaps)
+                continue
+            decode_read(addr, words, group, values)
+        return values
 
     def read_float(self, addr):
         """Read a floating-point value from the oven at address addr
@@ -636,16 +1753,72 @@ class OvenCtl(object):
         
         Can raise: ModbusException"""
         mode=self.read_int(OVENADDR_MODE)
-        modes = []
-        if mode&0x1000:
-            modes.append("basic")
-        if mode&0x0800:
-            modes.append("manual")
-        if mode&0x0400:
-            modes.append("auto")
-        if not len(modes):
-            modes.append("idle")
-        return(mode, modes)
+        return(mode, mode_names(mode))
+
+    def snapshot(self, fields=OVEN_STATUS_FIELDS, partial=False):
+        """Fetch the oven's status as an OvenStatus
+        
+        fields is a list of the OvenStatus fields wanted (default all of
+        them); the others are left as None.  Everything is fetched over one
+        connection, in as few transactions as possible (see
+        read_registers), and the time taken is recorded in the snapshot's
+        elapsed attribute.
+        
+        If partial is True, a failed read doesn't fail the whole snapshot:
+        the fields are read again one at a time, and any which still can't
+        be read are left as None, with the exception recorded in the
+        snapshot's errors attribute.
+        
+        Relies on reverse-engineered addresses
+        
+        Can raise: ModbusException (only if partial is False)"""
+        table = status_table(fields)
+        start = time.time()
+        with self.session():
+            try:
+                regs = self.read_registers(map(lambda f: f[1], table))
+            except ModbusException:
+                if not partial:
+                    raise
+                regs, errors = {}, {}
+                for field, reg, conv in table:
+                    try:
+                        regs.update(self.read_registers([reg]))
+                    except ModbusException as err:
+                        errors[field] = err
+                return OvenStatus.from_registers(table, regs, start,
+                                                 time.time(), errors)
+        return OvenStatus.from_registers(table, regs, start, time.time())
+
+    def watch(self, fields=OVEN_STATUS_FIELDS, threshold=0, callback=None):
+        """Subscribe to changes in the oven's status
+        
+        All subscribers to an oven share one background poller thread (an
+        OvenWatcher, kept in self.watcher), which takes one snapshot of
+        all the fields they want every WATCH_INTERVAL seconds; so
+        dashboards, scripts etc. in one process can all follow the oven
+        without fighting over its one connection.
+        
+        Returns a Subscription; cancel it when you're done
+        
+        Parameters:
+            fields: the OvenStatus fields to watch (default all of them)
+            threshold: the least change in temp or setpoint to report
+             (other fields report every change)
+            callback: called (in the poller thread) as callback(old, new)
+             with the last OvenStatus delivered and the new one; if None,
+             iterate over the Subscription instead
+        
+        Can raise: ValueError if a field isn't in OVEN_STATUS_FIELDS
+        
+        Example:
+            with oven.watch(['mode', 'door', 'alarm']) as sub:
+                for old, new in sub:
+                    [react to the transition]"""
+        with self._watch_lock:
+            if self.watcher is None:
+                self.watcher = OvenWatcher(self)
+        return self.watcher.subscribe(fields, threshold, callback)
 
     def get_door_state(self):
         """Return door state as bool (True = Open)
@@ -662,9 +1835,8 @@ class OvenCtl(object):
         Relies on reverse-engineered address
         
         Can raise: ModbusException"""
-        alarm=self.read_int(OVENADDR_ALARM)
-        note=self.read_int(OVENADDR_NOTE)
-        return(bool(alarm), bool(note))
+        regs=self.read_registers(('alarm', 'note'))
+        return(bool(regs['alarm']), bool(regs['note']))
 
     def get_alarm_text(self):
         """Return alarm/note text as string, or None if text was all spaces
@@ -672,9 +1844,8 @@ class OvenCtl(object):
         Relies on reverse-engineered address
         
         Can raise:ModbusException"""
-        text=self.do_readn(OVENADDR_ALRMTEXT, 0x14)
-        if not len(filter(lambda x: x!=0x20, text)): return None
-        return(''.join(map(lambda x: chr(x&0xff), text)))
+        reg=OVENREG['alrmtext']
+        return(reg.decode(self.do_readn(reg.addr, reg.length)))
 
     def check_safety(self, force=False):
         """Check the oven is in a safe state.  Returns None
@@ -684,16 +1855,29 @@ class OvenCtl(object):
         
         If force is given and True, Notes are ignored as is the door state
         
+        If there is a shadow (see ShadowRegisters), a check that passes
+        inside a session is good for SAFETY_RECHECK seconds (or until the
+        outermost session ends, if sooner), so that a burst of set_* calls
+        only reads the safety registers once; a long-held session still
+        re-reads them before writing once the burst is over.
+        
         Indirectly relies on reverse-engineered addresses
         
         Can raise:
             SafetyException: Oven in unsafe state
             ModbusException: Trouble at t' mill"""
-        alarm, note = self.get_alarm_state()
-        if alarm: raise SafetyAlarmException(self.get_alarm_text().strip())
-        if (not force):
-            if self.get_door_state(): raise SafetyDoorException("Door is open")
-            if note: raise SafetyNoteException(self.get_alarm_text().strip())
+        with self.lock:
+            if self._checked_safe is not None:
+                forced, when = self._checked_safe
+                if ((force or not forced) and
+                    monotonic() - when < SAFETY_RECHECK):
+                    return
+                self._checked_safe = None
+            with self.session():
+                regs = self.read_registers(safety_registers(force))
+            check_registers_safe(regs, force)
+            if self.shadow is not None and self._sessions:
+                self._checked_safe = (force, monotonic())
         return
 
     def set_setpoint(self, setpoint, force=False):
@@ -705,13 +1889,11 @@ class OvenCtl(object):
         Can raise:
             SafetyException: Oven in unsafe state
             ModbusException: Trouble at t' mill"""
-        self.check_safety(force)
-        if setpoint < OVENSAFE_MINTEMP:
-            raise SafetyTempException(False, setpoint, OVENSAFE_MINTEMP)
-        if setpoint > OVENSAFE_MAXTEMP:
-            raise SafetyTempException(True, setpoint, OVENSAFE_MAXTEMP)
-        self.write_float(OVENADDR_MANSETPT, setpoint)
-        self.write_float(OVENADDR_BASICSETPT, setpoint)
+        check_setpoint_range(setpoint)
+        with self.lock, self.session():
+            self.check_safety(force)
+            self.write_float(OVENADDR_MANSETPT, setpoint)
+            self.write_float(OVENADDR_BASICSETPT, setpoint)
 
     def set_mode_idle(self):
         """Set the oven to Idle mode.  Returns None
@@ -725,8 +1907,9 @@ class OvenCtl(object):
         Can raise:
             SafetyException: Oven in unsafe state
             ModbusException: Trouble at t' mill"""
-        self.check_safety(force)
-        self.write_int(OVENADDR_MODE, 0x0800)
+        with self.lock, self.session():
+            self.check_safety(force)
+            self.write_int(OVENADDR_MODE, 0x0800)
 
     def set_oplines(self, to_set=0, to_clear=0):
         """Set or clear the selected operation lines
@@ -734,9 +1917,16 @@ class OvenCtl(object):
         
         Arguments to_set and to_clear are bitmasks of lines to set or
         clear."""
-        old = self.read_int(OVENADDR_OPLINES)
-        new = (old | to_set) & ~to_clear
-        self.write_int(OVENADDR_OPLINES, new)
+        with self.lock, self.session():
+            words = None
+            if self.shadow is not None:
+                words = self.shadow.lookup(OVENADDR_OPLINES, 1)
+            if words is not None:
+                old = words[0]
+            else:
+                old = self.read_int(OVENADDR_OPLINES)
+            new = (old | to_set) & ~to_clear
+            self.write_int(OVENADDR_OPLINES, new)
         return new
     
     @property
@@ -756,7 +1946,12 @@ class OvenCtl(object):
         
         Returns a function of no arguments which returns either a
         similar function or None (the latter case indicating that the
-        temp was reached)
+        temp was reached).  Each function also has attributes
+            delay: how long (in seconds) to wait before calling it; short
+             when the trend says the temp is nearly there, long when
+             it's far off
+            eta: predicted time (in seconds) until the temp is close, or
+             None if it's not known (yet)
         
         Parameters:
             limit: the maximum error that counts as 'close'
@@ -773,11 +1968,17 @@ class OvenCtl(object):
         During your loop:
             tester = tester()
             if tester is None:
-                [exit the loop]"""
+                [exit the loop]
+            [wait for tester.delay seconds]"""
         setpoint = self.get_setpoint()
-        return lambda: self._temp_ready_loop(limit, stabilise, acclimatise, None, 0, setpoint)
-
-    def _temp_ready_loop(self, limit, stabilise, acclimatise, since, stable, setpoint):
+        tester = lambda: self._temp_ready_loop(limit, stabilise, acclimatise,
+                                               None, 0, setpoint, TempTrend())
+        tester.delay = 0
+        tester.eta = None
+        return tester
+
+    def _temp_ready_loop(self, limit, stabilise, acclimatise, since, stable,
+                         setpoint, trend):
         """Test whether the oven temperature is close to the setpoint
         
         Returns either None or an anonymous closure of itself
@@ -788,7 +1989,7 @@ class OvenCtl(object):
         Explanation: I didn't want to create an OvenTempTesterFrobFoo
         object, because it seemed unnecessarily heavyweight, so instead
         I made this anonymous closure.  It gets its internal variables
-        (since, stable, setpoint) by passing them into the closure.
+        (since, stable, setpoint, trend) by passing them into the closure.
         Given that it's doing that, it may as well do the same with the
         original arguments (limit, stabilise, acclimatise) so that the
         closure itself takes no arguments
@@ -796,24 +1997,31 @@ class OvenCtl(object):
         In other words, a _temp_ready_loop closure is a lightweight
         object.  Sort of.  It's probably overcomplicated and unPythonic
         but it's kinda neat"""
-        mode, modes = self.get_mode()
-        if modes == ["idle"]:
+        status = self.snapshot(('mode', 'setpoint', 'temp'))
+        if status.modes == ["idle"]:
             raise OvenIdleException("Oven is idle, will never reach temp.")
-        newset = self.get_setpoint()
-        if newset != setpoint:
-            raise OvenSetChangedException(newset, setpoint)
-        temp = self.get_temp()
+        if status.setpoint != setpoint:
+            raise OvenSetChangedException(status.setpoint, setpoint)
+        temp = status.temp
+        now = monotonic()
+        trend.add(now, temp)
+        eta = trend.eta(setpoint, limit)
+        delay = WAIT_POLL
         print "Temperature: %.2f" % temp,
         if temp < setpoint - limit or temp > setpoint + limit:
             stable = 0
-            print "- waiting..."
+            if eta is None:
+                print "- waiting..."
+            else:
+                print "- waiting... (ETA %s)" % format_eta(eta)
+                delay = approach_delay(eta)
         else:
             stable += 1
             if stable >= (6 if stabilise else 0):
                 if acclimatise:
                     if since is None:
-                        since = time.time()
-                    elif time.time() > since + acclimatise:
+                        since = now
+                    elif now > since + acclimatise:
                         print
                         return None
                     print "- acclimatising..."
@@ -821,8 +2029,11 @@ class OvenCtl(object):
                     return None
             else:
                 print "- stabilising..."
-        return lambda: self._temp_ready_loop(
-            limit, stabilise, acclimatise, since, stable, setpoint)
+        tester = lambda: self._temp_ready_loop(
+            limit, stabilise, acclimatise, since, stable, setpoint, trend)
+        tester.delay = delay
+        tester.eta = eta
+        return tester
 
     def wait_for_temp(self, limit, stabilise=False, acclimatise=0):
         """Block until the oven temperature is close to the setpoint
@@ -839,6 +2050,10 @@ class OvenCtl(object):
             OvenStatusException: Oven state inappropriate for waiting
             ModbusException: trouble at t' mill
         
+        While the temperature is far from the setpoint, readings are spaced
+        out according to its trend (see TempTrend), getting closer together
+        as it nears; once it's close, they're every WAIT_POLL seconds.
+        
         Note: This method calls time.sleep and thus won't play nicely with
         async frameworks like Twisted; for those use temp_ready_tester"""
         tester = self.temp_ready_tester(limit, stabilise, acclimatise)
@@ -846,12 +2061,584 @@ class OvenCtl(object):
             tester = tester()
             if tester is None:
                 return
-            time.sleep(10)
+            time.sleep(tester.delay)
+
+class Fleet(object):
+    """Poll many ovens concurrently
+    
+    Each oven is its own OvenCtl, so has its own connection; a pool of
+    worker threads talks to several ovens at once.  A sweep of the fleet
+    therefore takes about as long as the slowest oven, rather than the sum
+    of them all."""
+    def __init__(self, ovens, parallel=FLEET_PARALLEL, timeout=FLEET_TIMEOUT):
+        """Construct a Fleet
+        
+        Parameters:
+            ovens: a list of OvenCtl instances
+            parallel: the max. number of ovens to talk to at once
+            timeout: the time in seconds after which an oven that hasn't
+             finished is given up on (default 10)"""
+        self.ovens = list(ovens)
+        self.parallel = parallel
+        self.timeout = timeout
+
+    @classmethod
+    def from_hosts(cls, hosts, port=BINDER_PORT, **kwargs):
+        """Construct a Fleet from a list of hostnames
+        
+        Each hostname may have a ':port' suffix; otherwise port is used.
+        Other keyword arguments are passed to the Fleet constructor"""
+        ovens = []
+        for host in hosts:
+            hostname, colon, hostport = host.partition(':')
+            ovens.append(OvenCtl(hostname, hostport if colon else port))
+        return cls(ovens, **kwargs)
+
+    def run(self, func):
+        """Call func(oven) for each oven in the fleet, concurrently
+        
+        Generates (oven, result) in order of completion, where result is
+        the return value of func, or the exception it raised.  Ovens which
+        don't finish within self.timeout seconds of a worker starting on
+        them get a socket.timeout.  Their worker threads are abandoned (but
+        will finish eventually, since OvenCtl has its own socket timeouts),
+        and replaced, so that ovens still queued behind them get their
+        turn and their full timeout."""
+        jobs = Queue.Queue()
+        results = Queue.Queue()
+        for oven in self.ovens:
+            jobs.put(oven)
+        def worker():
+            try:
+                while True:
+                    try:
+                        oven = jobs.get_nowait()
+                    except Queue.Empty:
+                        return
+                    results.put(('start', oven, monotonic()))
+                    try:
+                        result = func(oven)
+                    except Exception as err:
+                        result = err
+                    results.put(('done', oven, result))
+            except:
+                # An abandoned worker can still be running when the
+                # interpreter shuts down, and fail as the modules go away;
+                # nobody is waiting for its result, so keep quiet about it
+                pass
+        def start_worker():
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+        for i in xrange(min(self.parallel, len(self.ovens))):
+            start_worker()
+        pending = set(self.ovens)
+        started = {} # oven -> time its worker started on it, until it's done
+        while len(pending):
+            now = monotonic()
+            for oven in self.ovens:
+                if oven in started and now - started[oven] >= self.timeout:
+                    del started[oven]
+                    pending.discard(oven)
+                    yield oven, socket.timeout(
+                        "No response within %gs" % self.timeout)
+                    start_worker() # to take over from the stuck one
+            if not len(pending):
+                return
+            if started:
+                wait = min(started.itervalues()) + self.timeout - now
+            else:
+                wait = self.timeout # the workers will start something soon
+            try:
+                event, oven, value = results.get(timeout=max(wait, 0))
+            except Queue.Empty:
+                continue
+            if oven not in pending:
+                continue # already given up on
+            if event == 'start':
+                started[oven] = value
+            else:
+                started.pop(oven, None)
+                pending.discard(oven)
+                yield oven, value
+
+    def poll(self, fields=OVEN_STATUS_FIELDS):
+        """Take a snapshot of each oven in the fleet, concurrently
+        
+        Generates (oven, OvenStatus or exception) in order of completion;
+        see run and OvenCtl.snapshot"""
+        return self.run(lambda oven: oven.snapshot(fields))
+
+class Subscription(object):
+    """A subscriber's interest in changes to an oven's status
+    
+    Returned by OvenCtl.watch (see there).  A status is delivered when any
+    of the subscribed fields differs from the last status delivered: for
+    floats (temp, setpoint) by more than the threshold, for the rest by
+    any change at all (so mode, door and alarm give transitions).  The
+    first status polled is always delivered, with old=None.
+    
+    Without a callback, iterating over the Subscription blocks for each
+    change, generating (old, new) pairs of OvenStatus; iteration ends when
+    the Subscription is cancelled or the watcher stopped.
+    
+    Attributes:
+        fields: the OvenStatus fields subscribed to
+        threshold: the least change in a float field that counts
+        last: the OvenStatus last delivered, or None
+        error: the exception the callback raised, if it did (this also
+         cancels the Subscription)"""
+    def __init__(self, watcher, fields, threshold=0, callback=None):
+        self.watcher = watcher
+        self.fields = tuple(fields)
+        self.threshold = threshold
+        self.callback = callback
+        self.last = None
+        self.error = None
+        self.queue = None if callback else Queue.Queue()
+    def changed(self, status): # OvenStatus -> bool
+        """Would this status be delivered?"""
+        if self.last is None: return True
+        for field in self.fields:
+            old, new = getattr(self.last, field), getattr(status, field)
+            if isinstance(old, float) and isinstance(new, float):
+                if abs(new - old) > self.threshold: return True
+            elif old != new:
+                return True
+        return False
+    def deliver(self, status):
+        """Pass status on to the subscriber, if it's changed enough
+        
+        Called by the OvenWatcher's thread"""
+        if not self.changed(status): return
+        old, self.last = self.last, status
+        if self.queue is not None:
+            self.queue.put((old, status))
+            return
+        try:
+            self.callback(old, status)
+        except Exception as err:
+            self.error = err
+            self.cancel()
+    def get(self, timeout=None):
+        """Wait for the next change, and return it as (old, new)
+        
+        Returns None if the Subscription has been cancelled
+        
+        Can raise: Queue.Empty if nothing changed within timeout seconds"""
+        if self.queue is None:
+            raise TypeError("Subscription has a callback, can't get from it")
+        return self.queue.get(timeout=timeout)
+    def __iter__(self):
+        while True:
+            change = self.get()
+            if change is None: return
+            yield change
+    def cancel(self):
+        """Stop delivering changes (and end any iteration)"""
+        self.watcher.unsubscribe(self)
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cancel()
+
+class OvenWatcher(object):
+    """Poll one oven in a background thread, on behalf of many subscribers
+    
+    Each poll is one snapshot of just the fields subscribed to (by anyone),
+    so the bus traffic doesn't grow with the number of subscribers.  Don't
+    construct this yourself; OvenCtl.watch makes one per oven, and starts
+    it when the first Subscription is made.
+    
+    Attributes:
+        interval: time in seconds between polls
+        status: the latest OvenStatus polled, or None
+        error: the exception from the latest poll, or None if it worked
+        polls: the number of polls made"""
+    def __init__(self, oven, interval=WATCH_INTERVAL):
+        self.oven = oven
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.status = None
+        self.error = None
+        self.polls = 0
+        self.thread = None
+        self._wake = threading.Event()
+    def subscribe(self, fields, threshold=0, callback=None):
+        """Add a Subscription (see OvenCtl.watch), starting the poller"""
+        for field in fields:
+            if field not in OVEN_STATUS_FIELDS:
+                raise ValueError("Unknown OvenStatus field", field)
+        sub = Subscription(self, fields, threshold, callback)
+        with self.lock:
+            self.subscriptions.append(sub)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        self._wake.set() # Poll now, so the new subscriber hears soon
+        return sub
+    def unsubscribe(self, sub):
+        """Remove sub, stopping the poller if it was the last Subscription"""
+        with self.lock:
+            if sub not in self.subscriptions: return
+            self.subscriptions.remove(sub)
+            last = not self.subscriptions
+            if last:
+                self.thread = None # subscribe starts another if need be
+        if last:
+            self._wake.set()
+        if sub.queue is not None:
+            sub.queue.put(None)
+    def fields(self): # () -> [str...]
+        """The fields wanted by any subscriber, in OVEN_STATUS_FIELDS order"""
+        with self.lock:
+            wanted = set()
+            for sub in self.subscriptions:
+                wanted.update(sub.fields)
+        return [f for f in OVEN_STATUS_FIELDS if f in wanted]
+    def poll(self):
+        """Take one snapshot and deliver it to the subscribers"""
+        fields = self.fields()
+        if not fields: return
+        try:
+            status = self.oven.snapshot(fields)
+        except (socket.error, ModbusException) as err:
+            self.error = err
+            return
+        self.polls += 1
+        self.status = status
+        self.error = None
+        with self.lock:
+            subs = list(self.subscriptions)
+        for sub in subs:
+            # Skip anyone who subscribed while we were polling
+            if all(f in fields for f in sub.fields):
+                sub.deliver(status)
+    def run(self):
+        """The poller thread: poll every self.interval until stopped"""
+        while self.thread is threading.current_thread():
+            self.poll()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+    def stop(self):
+        """Stop polling, and cancel all the subscriptions"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+            subs, self.subscriptions = self.subscriptions, []
+        self._wake.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        for sub in subs:
+            if sub.queue is not None:
+                sub.queue.put(None)
+
+class StatusBoardException(Exception): pass
+
+def board_key(hostname, port=BINDER_PORT): # (str, int) -> str
+    """The key an oven's status is filed under on a StatusBoard"""
+    return "%s:%d" % (hostname, int(port))
+
+class StatusBoard(object):
+    """A memory-mapped file holding the latest status of each of some ovens
+    
+    One publisher (see ovenboard.py) polls the ovens and writes each one's
+    latest OvenStatus into a fixed-size slot; any number of processes on
+    the same host can then read them, with no socket and no transaction.
+    
+    Each slot is guarded by a seqlock: its sequence number is made odd
+    while the publisher writes the slot, and even again afterwards.  A
+    reader copies the slot out, and retries unless it saw the same even
+    number before and after, so it never gets half of one snapshot and
+    half of the next.  The file is never truncated or resized while in
+    use, as that would crash readers with SIGBUS.
+    
+    Attributes:
+        slots: the number of slots
+        interval: the publisher's polling interval, in seconds
+        pid: the publisher's process ID"""
+    def __init__(self, filename=BOARD_FILE, writer=False, slots=BOARD_SLOTS,
+                 interval=0):
+        """Open the board in filename
+        
+        Parameters:
+            filename: path of the board file
+            writer: if True, open for publishing, creating the board if
+             it doesn't exist (or doesn't have slots slots); there can
+             only be one writer at a time, which holds an exclusive lock
+             on filename + '.lock' (the board itself may be replaced, so
+             can't carry the lock)
+            slots: the number of slots, when creating the board
+            interval: the publisher's polling interval, in seconds (the
+             writer records this for readers, see is_fresh)
+        
+        Can raise: StatusBoardException, IOError, OSError"""
+        self.filename = filename
+        self.writer = writer
+        self.lockf = None
+        if writer:
+            # Lock before looking at the board, so that no-one can replace
+            # it from under a running publisher
+            import fcntl
+            self.lockf = open(filename + '.lock', 'a')
+            try:
+                fcntl.flock(self.lockf, fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except IOError:
+                self.lockf.close()
+                raise StatusBoardException("Board already has a publisher",
+                                           filename)
+            try:
+                if self._check_file(slots) != slots:
+                    self.create(filename, slots)
+                self.f = open(filename, 'r+b')
+            except:
+                self.lockf.close()
+                raise
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_WRITE)
+        else:
+            self.f = open(filename, 'rb')
+            if os.fstat(self.f.fileno()).st_size < BOARD_HEADER_SIZE:
+                self.f.close()
+                raise StatusBoardException("File too short", filename)
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size, self.slots, self.interval, self.pid = BOARD_HEADER.unpack_from(self.mm)
+        if magic != BOARD_MAGIC:
+            raise StatusBoardException("Not a status board", filename)
+        if size != BOARD_SLOT_SIZE:
+            raise StatusBoardException("Bad slot size", size)
+        if len(self.mm) < self.offset(self.slots):
+            raise StatusBoardException("File truncated", filename)
+        self._keys = {} # key -> slot, for the writer
+        if writer:
+            self.interval = interval
+            self.pid = os.getpid()
+            BOARD_HEADER.pack_into(self.mm, 0, BOARD_MAGIC, BOARD_SLOT_SIZE,
+                                   self.slots, self.interval, self.pid)
+            # Forget the last publisher's ovens
+            for slot in xrange(self.slots):
+                self._write_slot(slot, '', 0, 0, 0, 0, 0, 0, '')
+
+    def _check_file(self, slots):
+        """Return the number of slots in an existing board, or None"""
+        try:
+            with open(self.filename, 'rb') as f:
+                header = f.read(BOARD_HEADER.size)
+                f.seek(0, os.SEEK_END)
+                length = f.tell()
+        except IOError:
+            return None
+        if len(header) < BOARD_HEADER.size: return None
+        magic, size, n, interval, pid = BOARD_HEADER.unpack(header)
+        if magic != BOARD_MAGIC or size != BOARD_SLOT_SIZE: return None
+        if length < self.offset(n): return None
+        return n
+
+    @classmethod
+    def create(cls, filename, slots):
+        """Create an empty board with room for slots ovens
+        
+        It's written beside filename and renamed into place, so anyone who
+        has the old one open keeps a whole (if stale) board."""
+        if slots < 1:
+            raise StatusBoardException("Bad number of slots", slots)
+        temp = "%s.%d" % (filename, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(BOARD_HEADER.pack(BOARD_MAGIC, BOARD_SLOT_SIZE, slots, 0, 0).ljust(BOARD_HEADER_SIZE, '\0'))
+            f.write('\0' * (BOARD_SLOT_SIZE * slots))
+        os.rename(temp, filename)
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+        if self.lockf is not None:
+            self.lockf.close() # releasing the lock
+            self.lockf = None
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+    def offset(self, slot):
+        """File offset of slot number slot"""
+        return BOARD_HEADER_SIZE + slot * BOARD_SLOT_SIZE
+
+    def _write_slot(self, slot, *body):
+        """Write a slot (under its seqlock); body is as BOARD_BODY"""
+        off = self.offset(slot)
+        seq, = BOARD_SEQ.unpack_from(self.mm, off)
+        seq += seq & 1 # in case a previous writer died mid-write
+        BOARD_SEQ.pack_into(self.mm, off, seq + 1)
+        BOARD_BODY.pack_into(self.mm, off + BOARD_SEQ.size, *body)
+        BOARD_SEQ.pack_into(self.mm, off, seq + 2)
+
+    def _read_slot(self, slot):
+        """Read a consistent copy of a slot, as a BOARD_BODY tuple
+        
+        Can raise: StatusBoardException if the slot never stops changing"""
+        off = self.offset(slot)
+        for i in xrange(BOARD_RETRIES):
+            before, = BOARD_SEQ.unpack_from(self.mm, off)
+            if not before & 1:
+                body = BOARD_BODY.unpack_from(self.mm, off + BOARD_SEQ.size)
+                after, = BOARD_SEQ.unpack_from(self.mm, off)
+                if before == after:
+                    return body
+            time.sleep(BOARD_BACKOFF) # let the writer finish
+        raise StatusBoardException("Slot busy", slot)
+
+    def publish(self, key, status):
+        """Post status (an OvenStatus) for the oven with key (see board_key)
+        
+        Can raise: StatusBoardException if the board is full"""
+        if not self.writer:
+            raise StatusBoardException("Board not open for writing")
+        flags = 0
+        for field, bit in BOARD_FLAGS:
+            if getattr(status, field):
+                flags |= bit
+        if status.mode is not None:
+            flags |= BOARD_FLAG_MODE
+        nan = float('nan')
+        self._write_slot(self._slot(key), key, status.time,
+                         status.elapsed or 0,
+                         nan if status.temp is None else status.temp,
+                         nan if status.setpoint is None else status.setpoint,
+                         status.mode or 0, flags, status.alarm_text or '')
+
+    def publish_failure(self, key):
+        """Mark the oven with key as having failed its latest poll"""
+        if not self.writer:
+            raise StatusBoardException("Board not open for writing")
+        slot = self._slot(key)
+        body = list(self._read_slot(slot))
+        body[0] = key
+        body[6] |= BOARD_FLAG_FAILED
+        self._write_slot(slot, *body)
+
+    def _slot(self, key):
+        """The writer's slot for key, claiming a free one if need be"""
+        if key not in self._keys:
+            if len(self._keys) >= self.slots:
+                raise StatusBoardException("Board full", self.slots)
+            self._keys[key] = len(self._keys)
+        return self._keys[key]
+
+    def keys(self): # () -> [str...]
+        """The keys of all the ovens on the board"""
+        keys = []
+        for slot in xrange(self.slots):
+            key = self._read_slot(slot)[0].rstrip('\0')
+            if key: keys.append(key)
+        return keys
+
+    def read(self, key): # str -> (OvenStatus, bool) or None
+        """Read the latest status of the oven with key (see board_key)
+        
+        Returns (status, failed), where failed is True if the latest poll
+        of the oven failed (so status is from an earlier one); or None if
+        the oven isn't on the board
+        
+        Can raise: StatusBoardException"""
+        for slot in xrange(self.slots):
+            body = self._read_slot(slot)
+            if body[0].rstrip('\0') == key:
+                break
+        else:
+            return None
+        key, t, elapsed, temp, setpoint, mode, flags, text = body
+        values = dict((field, bool(flags & bit)) for field, bit in BOARD_FLAGS)
+        text = text.rstrip('\0')
+        status = OvenStatus(time=t, elapsed=elapsed,
+                            temp=None if temp != temp else temp,
+                            setpoint=None if setpoint != setpoint else setpoint,
+                            mode=mode if flags & BOARD_FLAG_MODE else None,
+                            alarm_text=text or None, **values)
+        return status, bool(flags & BOARD_FLAG_FAILED)
+
+    def is_fresh(self, status):
+        """Is status (from read) recent enough to stand in for a poll?
+        
+        That is, no older than two of the publisher's polling intervals
+        (plus time for a sweep of the fleet to time out)"""
+        return time.time() - status.time <= 2 * self.interval + FLEET_TIMEOUT
+
+def board_status(hostname, port=BINDER_PORT, filename=BOARD_FILE):
+    """Get an oven's status from the status board, if it's on there
+    
+    Returns an OvenStatus, or None if there is no board, the oven isn't on
+    it, its latest poll failed, or the status is stale (see is_fresh)"""
+    if not filename or not os.path.exists(filename):
+        return None
+    try:
+        with StatusBoard(filename) as board:
+            entry = board.read(board_key(hostname, port))
+            if entry is None: return None
+            status, failed = entry
+            if failed or not board.is_fresh(status): return None
+            return status
+    except (StatusBoardException, EnvironmentError):
+        return None
+
+# What print_status calls each field when it couldn't be read
+STATUS_FAILURES = {
+    'alarm': "alarm state", 'note': "alarm state",
+    'alarm_text': "alarm text", 'mode': "oven mode",
+    'bedew': "bedew operation status", 'door': "door state",
+    'temp': "oven temperature", 'setpoint': "oven setpoint",
+}
+
+def print_status(status):
+    """Print an OvenStatus in human-readable form, as for -Q
+    
+    Fields in status.errors are reported as failures, and the rest are
+    printed as usual"""
+    errors = status.errors or {}
+    failed = set()
+    def ok(*fields):
+        for field in fields:
+            if field not in errors: continue
+            what = STATUS_FAILURES[field]
+            if what not in failed:
+                print "Failed to get %s: %s" % (what, errors[field])
+                failed.add(what)
+            return False
+        return True
+    if ok('alarm', 'note'):
+        if status.alarm and ok('alarm_text'):
+            print "ALARM: %s" % (status.alarm_text or '').strip()
+        elif status.note and ok('alarm_text'):
+            print "Note: %s" % (status.alarm_text or '').strip()
+    if ok('mode'):
+        print "Mode: %04x (%s)" % (status.mode, '&'.join(status.modes))
+    if ok('bedew') and status.bedew:
+        print "Bedew protection active"
+    if ok('door'):
+        print "Door: %s" % ("open" if status.door else "closed")
+    if ok('temp'):
+        print "Temperature: %.2f" % (status.temp,)
+    if ok('setpoint'):
+        print "Target temperature: %.2f" % (status.setpoint,)
+    print "Query time: %.1f ms" % (status.elapsed*1000,)
+
+def read_hostfile(filename): # string -> [string...]
+    """Read a list of hosts, one per line; blank lines and #comments ignored"""
+    hosts = []
+    with open(filename) as f:
+        for line in f:
+            host = line.partition('#')[0].strip()
+            if len(host):
+                hosts.append(host)
+    return hosts
 
 def parse_cmdline():
     parser = optparse.OptionParser()
     parser.usage = "%prog -H hostname [-p port] [options]"
-    parser.add_option('-H', '--host', help='host to connect to')
+    parser.add_option('-H', '--host', action='append', default=[],
+                      help='host to connect to (may be repeated for -Q)')
+    parser.add_option('-F', '--hostfile', type='string',
+                      help='file listing hosts to connect to (for -Q)')
     parser.add_option('-p', '--port', help='TCP port to connect to',
                       default=BINDER_PORT)
     parser.add_option('-Q', '--query', action='store_true', 
@@ -873,8 +2660,20 @@ def parse_cmdline():
                       help='Activate bedew protection')
     parser.add_option('-f', '--force', action='store_true',
                       help='Override safety interlocks')
+    parser.add_option('-j', '--parallel', type='int', default=FLEET_PARALLEL,
+                      help='Max. hosts to query at once (for -Q)')
+    parser.add_option('-B', '--board', type='string', default=BOARD_FILE,
+                      help="Status board to answer -Q from, if it's fresh "
+                           "(default %default; '' to always ask the oven)")
     options, args = parser.parse_args()
 
+    if options.hostfile:
+        try:
+            options.host.extend(read_hostfile(options.hostfile))
+        except IOError as err:
+            print "ERROR: Failed to read hostfile: %s" % err
+            sys.exit(2)
+
     if not options.host:
         print "ERROR: -H/--host is required"
         sys.exit(2)
@@ -883,52 +2682,49 @@ def parse_cmdline():
         print "ERROR: Please specify exactly one action"
         sys.exit(2)
 
+    if len(options.host) > 1 and not options.query:
+        print "ERROR: Multiple hosts are only supported with -Q"
+        sys.exit(2)
+
     return options
 
 
 
 if __name__ == '__main__':
     options = parse_cmdline()
-    oven = OvenCtl(options.host, options.port)
+    if len(options.host) > 1:
+        fleet = Fleet.from_hosts(options.host, options.port,
+                                 parallel=options.parallel)
+        start = time.time()
+        ovens = []
+        for oven in fleet.ovens:
+            status = board_status(oven.hostname, oven.port, options.board)
+            if status is None:
+                ovens.append(oven)
+                continue
+            print "== %s:%s (from status board) ==" % (oven.hostname, oven.port)
+            print_status(status)
+        fleet.ovens = ovens
+        for oven, status in fleet.poll():
+            print "== %s:%s ==" % (oven.hostname, oven.port)
+            if isinstance(status, Exception):
+                print "Failed to get oven status: %s" % status
+            else:
+                print_status(status)
+        print "Sweep of %d ovens took %.1f ms" % (len(options.host),
+                                                  (time.time()-start)*1000)
+        sys.exit(0)
+    oven = OvenCtl(options.host[0], options.port)
 
     try:
         if options.query:
-            try:
-                alarm, note = oven.get_alarm_state()
-                if alarm:
-                    try:
-                        print "ALARM: %s" % oven.get_alarm_text().strip()
-                    except ModbusException as err:
-                        print "Failed to get alarm text: %s" % err
-                elif note:
-                    try:
-                        print "Note: %s" % oven.get_alarm_text().strip()
-                    except ModbusException as err:
-                        print "Failed to get note text: %s" % err
-            except ModbusException as err:
-                print "Failed to get alarm state: %s" % err
-            try:
-                mode,modes = oven.get_mode()
-                print "Mode: %04x (%s)" % (mode, '&'.join(modes))
-            except ModbusException as err:
-                print "Failed to get oven mode: %s" % err
-            try:
-                if oven.bedew_protection:
-                    print "Bedew protection active"
-            except ModbusException as err:
-                print "Failed to get bedew operation status: %s" % err
-            try:
-                print "Door: %s" % ("open" if oven.get_door_state() else "closed")
-            except ModbusException as err:
-                print "Failed to get door state: %s" % err
-            try:
-                print "Temperature: %.2f" % (oven.get_temp(),)
-            except ModbusException as err:
-                print "Failed to get oven temperature: %s" % err
-            try:
-                print "Target temperature: %.2f" % (oven.get_setpoint(),)
-            except ModbusException as err:
-                print "Failed to get oven setpoint: %s" % err
+            status = board_status(oven.hostname, oven.port, options.board)
+            if status is not None:
+                print_status(status)
+                print "From status board %s, %.1f s old" % (options.board,
+                    time.time() - status.time)
+            else:
+                print_status(oven.snapshot(partial=True))
         elif options.idle:
             try:
                 oven.set_mode_idle()
@@ -0,0 +1,287 @@
+#! /usr/bin/env python
+#
+# Copyright Solarflare Communications Inc., 2012-13
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of Solarflare Communications Inc. nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL SOLARFLARE COMMUNICATIONS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Export oven telemetry and client statistics for Prometheus
+
+A single poller thread takes a snapshot of each oven (see
+ovenctl.OvenCtl.snapshot and ovenctl.Fleet) at a fixed interval, and a small
+HTTP server serves the latest values in the Prometheus text exposition
+format at /metrics.  Scrapes never cause MODBus transactions, so any number
+of scrapers can watch the ovens without adding to the load on their
+(single-connection) XPort adaptors.
+
+Besides the oven status, the client-side statistics gathered by
+ovenctl.TransactionStats (transaction counts, errors, retries and latency
+histograms) are exported for each oven."""
+import sys, optparse, threading, time
+import BaseHTTPServer, SocketServer
+import ovenctl
+
+EXPORTER_PORT     = 9418 # Default HTTP port to serve /metrics on
+EXPORTER_INTERVAL = 30   # Default time (in seconds) between polls
+
+# Oven status metrics
+#  (metric name, OvenStatus field, help)
+EXPORTER_STATUS_TABLE = (
+    ('oven_temperature_celsius', 'temp', 'Current chamber temperature'),
+    ('oven_setpoint_celsius', 'setpoint', 'Temperature setpoint'),
+    ('oven_mode_bits', 'mode', 'Operating mode bitmask'),
+    ('oven_door_open', 'door', '1 if the door is open'),
+    ('oven_alarm', 'alarm', '1 if an Alarm is active'),
+    ('oven_note', 'note', '1 if a Note is active'),
+    ('oven_bedew_protection', 'bedew', '1 if bedew protection is active'),
+)
+EXPORTER_MODES = ('basic', 'manual', 'auto', 'idle')
+
+def escape_label(value): # string -> string
+    """Escape a label value for the Prometheus text format"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n',
+                                                                  '\\n')
+
+def labels(**kwargs): # -> string
+    """Format a label set, eg. {oven="host:10001"}"""
+    return '{%s}' % ','.join('%s="%s"' % (k, escape_label(str(v)))
+                             for k, v in sorted(kwargs.iteritems()))
+
+class MetricsWriter(object):
+    """Accumulate metrics in the Prometheus text format"""
+    def __init__(self):
+        self.lines = []
+    def header(self, name, kind, text):
+        """Start a metric family"""
+        self.lines.append('# HELP %s %s' % (name, text))
+        self.lines.append('# TYPE %s %s' % (name, kind))
+    def sample(self, name, labelset, value):
+        """Add a sample; labelset is as returned by labels()"""
+        if isinstance(value, bool):
+            value = int(value)
+        self.lines.append('%s%s %r' % (name, labelset, value))
+    def histogram(self, name, labelset, hist, scale=1.0):
+        """Add an ovenctl.LatencyHistogram, its values multiplied by scale
+        
+        labelset is a dict of labels (the 'le' label is added here)"""
+        cumulative = 0
+        bounds = tuple(b * scale for b in ovenctl.HIST_BOUNDS) + ('+Inf',)
+        for bound, count in zip(bounds, hist.counts):
+            cumulative += count
+            self.sample(name + '_bucket', labels(le=bound, **labelset),
+                        cumulative)
+        self.sample(name + '_sum', labels(**labelset), hist.total * scale)
+        self.sample(name + '_count', labels(**labelset), hist.count)
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+class MetricsPoller(object):
+    """Poll a Fleet of ovens periodically, keeping the latest snapshots"""
+    def __init__(self, fleet, interval=EXPORTER_INTERVAL):
+        """Construct a MetricsPoller
+        
+        Parameters:
+            fleet: the ovenctl.Fleet to poll
+            interval: the time in seconds between polls"""
+        self.fleet = fleet
+        self.interval = interval
+        self.stats = ovenctl.TransactionStats(quiet=True)
+        for oven in fleet.ovens:
+            oven.observer = self.stats
+        self.lock = threading.Lock()
+        self.latest = {} # {oven: (OvenStatus or None, exception or None)}
+        self.sweeps = 0
+        self.sweep_time = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def sweep(self):
+        """Poll every oven once"""
+        start = time.time()
+        for oven, status in self.fleet.poll():
+            if isinstance(status, Exception):
+                entry = (None, status)
+            else:
+                entry = (status, None)
+            with self.lock:
+                self.latest[oven] = entry
+        with self.lock:
+            self.sweeps += 1
+            self.sweep_time = time.time() - start
+
+    def run(self):
+        """Poll until stop() is called"""
+        while not self.stopping.is_set():
+            start = time.time()
+            self.sweep()
+            self.stopping.wait(max(0, start + self.interval - time.time()))
+
+    def start(self):
+        """Start polling in a background thread"""
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop polling, and wait for the current sweep to finish"""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def render(self): # -> string
+        """Render the latest values in the Prometheus text format"""
+        with self.lock:
+            latest = dict(self.latest)
+            sweeps, sweep_time = self.sweeps, self.sweep_time
+        ovens = [('%s:%s' % (oven.hostname, oven.port), latest.get(oven,
+                  (None, None))) for oven in self.fleet.ovens]
+        w = MetricsWriter()
+        w.header('oven_up', 'gauge', '1 if the last poll of the oven worked')
+        for key, (status, err) in ovens:
+            w.sample('oven_up', labels(oven=key), status is not None)
+        for name, field, text in EXPORTER_STATUS_TABLE:
+            w.header(name, 'gauge', text)
+            for key, (status, err) in ovens:
+                if status is not None:
+                    w.sample(name, labels(oven=key), getattr(status, field))
+        w.header('oven_mode', 'gauge', '1 for each operating mode in effect')
+        for key, (status, err) in ovens:
+            if status is not None:
+                for mode in EXPORTER_MODES:
+                    w.sample('oven_mode', labels(oven=key, mode=mode),
+                             mode in status.modes)
+        w.header('oven_last_poll_timestamp_seconds', 'gauge',
+                 'Time of the last successful poll')
+        for key, (status, err) in ovens:
+            if status is not None:
+                w.sample('oven_last_poll_timestamp_seconds',
+                         labels(oven=key), status.time)
+        w.header('oven_poll_duration_seconds', 'gauge',
+                 'Time taken by the last successful poll')
+        for key, (status, err) in ovens:
+            if status is not None:
+                w.sample('oven_poll_duration_seconds', labels(oven=key),
+                         status.elapsed)
+        self.render_stats(w)
+        w.header('oven_exporter_sweeps_total', 'counter',
+                 'Number of polls of the whole fleet')
+        w.sample('oven_exporter_sweeps_total', '', sweeps)
+        if sweep_time is not None:
+            w.header('oven_exporter_sweep_duration_seconds', 'gauge',
+                     'Time taken by the last poll of the whole fleet')
+            w.sample('oven_exporter_sweep_duration_seconds', '', sweep_time)
+        return w.text()
+
+    def render_stats(self, w):
+        """Render the client-side transaction statistics into w"""
+        with self.stats.lock:
+            stats = sorted(self.stats.ovens.iteritems())
+            for name, field, text in (
+                    ('transactions', 'transactions', 'MODBus transactions'),
+                    ('connects', 'connects', 'TCP connections opened'),
+                    ('retries', 'retries', 'Failed connection attempts'),
+                    ('bytes_sent', 'bytes_sent', 'Bytes sent'),
+                    ('bytes_received', 'bytes_received', 'Bytes received')):
+                metric = 'oven_client_%s_total' % name
+                w.header(metric, 'counter', text)
+                for key, s in stats:
+                    w.sample(metric, labels(oven=key), s[field])
+            w.header('oven_client_errors_total', 'counter',
+                     'Failed transactions, by exception')
+            for key, s in stats:
+                for exc, count in sorted(s['errors'].iteritems()):
+                    w.sample('oven_client_errors_total',
+                             labels(oven=key, exception=exc), count)
+            for name, text in (('connect', 'Time to connect'),
+                               ('rtt', 'Transaction round-trip time')):
+                metric = 'oven_client_%s_seconds' % name
+                w.header(metric, 'histogram', text)
+                for key, s in stats:
+                    w.histogram(metric, {'oven': key}, s[name], 0.001)
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve /metrics from the server's MetricsPoller"""
+    def do_GET(self):
+        if self.path.partition('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.poller.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        pass # don't log every scrape
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server for /metrics"""
+    daemon_threads = True
+    def __init__(self, address, poller):
+        """Construct a MetricsServer on address, serving poller's metrics"""
+        BaseHTTPServer.HTTPServer.__init__(self, address, MetricsHandler)
+        self.poller = poller
+
+def parse_cmdline():
+    parser = optparse.OptionParser()
+    parser.usage = "%prog -H hostname [-H hostname...] [options]"
+    parser.add_option('-H', '--host', action='append', default=[],
+                      help='oven to poll (may be repeated)')
+    parser.add_option('-F', '--hostfile', type='string',
+                      help='file listing ovens to poll')
+    parser.add_option('-p', '--port', help='TCP port to connect to ovens on',
+                      default=ovenctl.BINDER_PORT)
+    parser.add_option('-b', '--bind', type='string', default='',
+                      help='Address to serve /metrics on (default all)')
+    parser.add_option('-P', '--listen', type='int', default=EXPORTER_PORT,
+                      help='Port to serve /metrics on')
+    parser.add_option('-i', '--interval', type='float',
+                      default=EXPORTER_INTERVAL,
+                      help='Time (in seconds) between polls')
+    options, args = parser.parse_args()
+
+    if options.hostfile:
+        try:
+            options.host.extend(ovenctl.read_hostfile(options.hostfile))
+        except IOError as err:
+            print "ERROR: Failed to read hostfile: %s" % err
+            sys.exit(2)
+
+    if not options.host:
+        print "ERROR: -H/--host is required"
+        sys.exit(2)
+
+    return options
+
+if __name__ == '__main__':
+    options = parse_cmdline()
+    fleet = ovenctl.Fleet.from_hosts(options.host, options.port)
+    poller = MetricsPoller(fleet, options.interval)
+    poller.start()
+    server = MetricsServer((options.bind, options.listen), poller)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    poller.stop()
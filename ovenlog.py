@@ -0,0 +1,304 @@
+#! /usr/bin/env python
+#
+# Copyright Solarflare Communications Inc., 2012-13
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of Solarflare Communications Inc. nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL SOLARFLARE COMMUNICATIONS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Compact binary telemetry log for long oven runs
+
+A TelemetryLog is a preallocated file of fixed-width records, used as a
+ring: once it is full, each new record overwrites the oldest.  The file is
+memory-mapped, so appending a record costs no allocation and a run of any
+length takes constant memory (and disk).  Each record holds:
+    time: timestamp (seconds since the epoch)
+    temp: chamber temperature
+    setpoint: temperature setpoint
+    mode: operating mode bitmask (see ovenctl.OvenCtl.get_mode)
+    flags: TLOG_FLAG_* bits (door, alarm, note, bedew)
+    action: index of the current rampspec action, or -1
+Missing temp or setpoint are recorded as NaN.
+
+For analysis, TelemetryLog.read returns a NumPy structured array (dtype
+TLOG_DTYPE) for a time range, which is a view straight onto the mapped file
+unless the range wraps around the end of the ring.  NumPy is optional;
+without it, TelemetryLog.records yields plain tuples instead."""
+import sys, os, struct, mmap, bisect, optparse, time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TLOG_MAGIC = 'OVENTLOG'
+TLOG_HEADER = struct.Struct('<8sIIQ') # magic, record size, capacity, count
+TLOG_HEADER_SIZE = 64 # header is padded to this size
+TLOG_STARTED = struct.Struct('<Q') # in the padding: records begun by append
+TLOG_STARTED_OFFSET = TLOG_HEADER.size
+TLOG_RECORD = struct.Struct('<dffHHi') # time, temp, setpoint, mode, flags, action
+TLOG_FIELDS = ('time', 'temp', 'setpoint', 'mode', 'flags', 'action')
+TLOG_CAPACITY = 1<<20 # Default number of records (36 days at 3s per record)
+
+TLOG_FLAG_DOOR  = 1
+TLOG_FLAG_ALARM = 2
+TLOG_FLAG_NOTE  = 4
+TLOG_FLAG_BEDEW = 8
+TLOG_FLAGS = (('door', TLOG_FLAG_DOOR), ('alarm', TLOG_FLAG_ALARM),
+              ('note', TLOG_FLAG_NOTE), ('bedew', TLOG_FLAG_BEDEW))
+
+# OvenStatus fields needed by TelemetryLog.record
+TLOG_STATUS_FIELDS = ('temp', 'setpoint', 'mode') + tuple(f[0] for f in TLOG_FLAGS)
+
+if numpy is not None:
+    TLOG_DTYPE = numpy.dtype([('time', '<f8'), ('temp', '<f4'),
+                              ('setpoint', '<f4'), ('mode', '<u2'),
+                              ('flags', '<u2'), ('action', '<i4')])
+    assert TLOG_DTYPE.itemsize == TLOG_RECORD.size
+
+class TelemetryLogException(Exception): pass
+
+class _RecordTimes(object):
+    """Sequence of the timestamps in a TelemetryLog, oldest first (for bisect)"""
+    def __init__(self, log, first, count):
+        self.log = log
+        self.first = first
+        self.count = count
+    def __len__(self):
+        return self.count - self.first
+    def __getitem__(self, i):
+        return self.log.record_at(self.first + i)[0]
+
+class TelemetryLog(object):
+    """A memory-mapped ring of fixed-width telemetry records"""
+    def __init__(self, filename, capacity=TLOG_CAPACITY, readonly=False):
+        """Open the log in filename, creating it if it does not exist
+        
+        Parameters:
+            filename: path of the log file
+            capacity: number of records to preallocate, if creating the log;
+                an existing log keeps its own capacity
+            readonly: open an existing log for reading only; this can be done
+                while another process is appending to it
+        
+        Can raise: TelemetryLogException, IOError, OSError"""
+        if not readonly and not os.path.exists(filename):
+            self.create(filename, capacity)
+        self.f = open(filename, 'rb' if readonly else 'r+b')
+        self.readonly = readonly
+        access = mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=access)
+        if len(self.mm) < TLOG_HEADER_SIZE:
+            raise TelemetryLogException("File too short", filename)
+        magic, size, self.capacity, count = TLOG_HEADER.unpack_from(self.mm)
+        if magic != TLOG_MAGIC:
+            raise TelemetryLogException("Not a telemetry log", filename)
+        if size != TLOG_RECORD.size:
+            raise TelemetryLogException("Bad record size", size)
+        if len(self.mm) < self.offset(self.capacity):
+            raise TelemetryLogException("File truncated", filename)
+
+    @classmethod
+    def create(cls, filename, capacity):
+        """Create an empty log with space for capacity records
+        
+        The whole file is written out now, so that the disk can't fill up
+        mid-run (which would kill the writer with SIGBUS)."""
+        if capacity < 1:
+            raise TelemetryLogException("Bad capacity", capacity)
+        with open(filename, 'wb') as f:
+            f.write(TLOG_HEADER.pack(TLOG_MAGIC, TLOG_RECORD.size, capacity, 0).ljust(TLOG_HEADER_SIZE, '\0'))
+            chunk = '\0' * (TLOG_RECORD.size * 4096)
+            left = capacity * TLOG_RECORD.size
+            while left:
+                f.write(chunk[:left])
+                left -= min(left, len(chunk))
+
+    def close(self):
+        """Close the log
+        
+        Arrays returned by read() may still be views onto the mapped file,
+        so the mapping isn't closed here but left to be unmapped once the
+        last of them has gone."""
+        self.mm = None
+        self.f.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def count(self):
+        """Total number of records ever appended (including overwritten ones)"""
+        return TLOG_HEADER.unpack_from(self.mm)[3]
+
+    def first(self, count=None):
+        """Index (counting from the start of the log) of the oldest record kept"""
+        if count is None:
+            count = self.count
+        return max(0, count - self.capacity)
+
+    def __len__(self):
+        count = self.count
+        return count - self.first(count)
+
+    @property
+    def started(self):
+        """Number of records append has begun writing (>= count)
+        
+        Logs written before this was kept have 0 in the header; count is
+        used for them instead."""
+        return max(TLOG_STARTED.unpack_from(self.mm, TLOG_STARTED_OFFSET)[0],
+                   self.count)
+
+    def overwritten(self): # () -> int
+        """Index of the oldest record not (being) overwritten by append
+        
+        A reader which re-checks this after unpacking or copying records
+        can discard any below it, which may be partly overwritten."""
+        return self.first(self.started)
+
+    def offset(self, index):
+        """File offset of the slot holding record number index"""
+        return TLOG_HEADER_SIZE + (index % self.capacity) * TLOG_RECORD.size
+
+    def append(self, t, temp, setpoint, mode, flags=0, action=-1):
+        """Append a record, overwriting the oldest if the log is full
+        
+        The record is written before the count in the header is updated, so
+        readers never see a partly-written new record.  Once the ring has
+        wrapped, though, a reader may see the oldest record half-overwritten
+        by the new one; so started is updated first, and records and read
+        use it (see overwritten) to drop any such records."""
+        count = self.count
+        TLOG_STARTED.pack_into(self.mm, TLOG_STARTED_OFFSET, count + 1)
+        TLOG_RECORD.pack_into(self.mm, self.offset(count), t,
+                              float('nan') if temp is None else temp,
+                              float('nan') if setpoint is None else setpoint,
+                              mode or 0, flags, action)
+        struct.pack_into('<Q', self.mm, TLOG_HEADER.size - 8, count + 1)
+
+    def record(self, status, action=-1):
+        """Append a record from an ovenctl.OvenStatus
+        
+        status should have (at least) the TLOG_STATUS_FIELDS; action is the
+        index of the current rampspec action, if any."""
+        flags = 0
+        for field, bit in TLOG_FLAGS:
+            if getattr(status, field):
+                flags |= bit
+        self.append(status.time, status.temp, status.setpoint, status.mode,
+                    flags, action)
+
+    def record_at(self, index):
+        """Return record number index as a tuple (see TLOG_FIELDS)"""
+        return TLOG_RECORD.unpack_from(self.mm, self.offset(index))
+
+    def find(self, start=None, end=None): # -> (first, last)
+        """Return the range [first, last) of records from start to end
+        
+        start and end are timestamps; None means the oldest or newest record"""
+        count = self.count
+        first = self.first(count)
+        times = _RecordTimes(self, first, count)
+        lo = first if start is None else first + bisect.bisect_left(times, start)
+        hi = count if end is None else first + bisect.bisect_right(times, end)
+        return lo, max(lo, hi)
+
+    def records(self, start=None, end=None):
+        """Iterate over the records from start to end, as tuples
+        
+        Records which were overwritten by append while being read, because
+        the ring has wrapped, are skipped"""
+        lo, hi = self.find(start, end)
+        for i in xrange(lo, hi):
+            rec = self.record_at(i)
+            if i >= self.overwritten():
+                yield rec
+
+    def read(self, start=None, end=None):
+        """Return the records from start to end as a NumPy array
+        
+        The array has dtype TLOG_DTYPE.  It is a view onto the mapped file
+        (so it doesn't copy, and is read-only if the log is) except when the
+        range wraps around the end of the ring, when the two parts are
+        copied into a new array.  Either way it stays valid after the log
+        is closed.  Records overwritten by append while being read (because
+        the ring has wrapped) are left out, but if the log is being appended
+        to, records in a view may be overwritten later.
+        
+        Can raise: TelemetryLogException if NumPy is not available"""
+        if numpy is None:
+            raise TelemetryLogException("NumPy is needed to read() a telemetry log")
+        lo, hi = self.find(start, end)
+        slot = lo % self.capacity
+        if slot + hi - lo <= self.capacity:
+            view = numpy.frombuffer(self.mm, TLOG_DTYPE, hi - lo, self.offset(lo))
+            if self.readonly:
+                view.setflags(write=False)
+        else:
+            split = self.capacity - slot
+            view = numpy.concatenate((
+                numpy.frombuffer(self.mm, TLOG_DTYPE, split, self.offset(lo)),
+                numpy.frombuffer(self.mm, TLOG_DTYPE, hi - lo - split, TLOG_HEADER_SIZE)))
+        return view[max(0, self.overwritten() - lo):]
+
+def format_record(rec): # -> string
+    t, temp, setpoint, mode, flags, action = rec
+    flagnames = [name for name, bit in TLOG_FLAGS if flags & bit]
+    return "%s %7.2f %7.2f 0x%04x %-3d %s" % (
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)), temp, setpoint,
+        mode, action, ','.join(flagnames))
+
+def parse_cmdline():
+    parser = optparse.OptionParser()
+    parser.usage = "%prog [options] logfile"
+    parser.add_option('-s', '--start', type='float',
+                      help='Show records from this time (seconds since the epoch)')
+    parser.add_option('-e', '--end', type='float',
+                      help='Show records up to this time (seconds since the epoch)')
+    parser.add_option('-l', '--last', type='float',
+                      help='Show records from the last LAST hours')
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_usage()
+        sys.exit(2)
+    options.logfile = args[0]
+
+    if options.last is not None:
+        options.start = time.time() - options.last * 3600
+
+    return options
+
+if __name__ == '__main__':
+    options = parse_cmdline()
+    try:
+        log = TelemetryLog(options.logfile, readonly=True)
+    except (IOError, TelemetryLogException) as err:
+        print "ERROR: Failed to open log: %s" % (err,)
+        sys.exit(1)
+    with log:
+        print "%d records (capacity %d)" % (len(log), log.capacity)
+        for rec in log.records(options.start, options.end):
+            print format_record(rec)
@@ -0,0 +1,386 @@
+#! /usr/bin/env python
+#
+# Copyright Solarflare Communications Inc., 2012-13
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of Solarflare Communications Inc. nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL SOLARFLARE COMMUNICATIONS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Share one BINDER oven between many clients, through its XPort-03
+
+The XPort-03 only accepts one connection at a time (see notes), so clients
+of the same oven (rampspec, monitoring, engineers running nmbtest...) lock
+each other out.  This proxy holds the one connection to the oven, and
+accepts any number of client connections speaking the same BINDER MODBus
+frames; OvenCtl and the C tools in tools/ just need pointing at the proxy
+instead of the oven.
+
+Requests from clients are sent to the oven one at a time.  Clients take
+turns (round-robin, one request each), except that writes go before reads.
+A READN identical to one already queued or in flight, or to one answered
+within the last PROXY_FRESH seconds, gets that answer rather than a
+transaction of its own; any write empties that store of recent answers, so
+clients never read back a value from before a write they've seen acked.
+
+If the oven doesn't answer properly, the clients waiting on that request
+are disconnected, so that they retry (as they would with a failed
+connection to the oven itself).
+
+class OvenProxy is the proxy server"""
+import sys, socket, select, struct, optparse, threading, collections
+import ovenctl
+
+PROXY_FRESH = 0.5 # Time (in seconds) to reuse a READN's answer for
+PROXY_IDLE  = 30  # Release the oven connection after this many idle seconds
+PROXY_POLL  = 0.1 # Server loop poll interval, in seconds
+
+def is_write(frame): # string -> bool
+    """Is a request frame anything other than a READN?
+    
+    Unknown function codes are treated as writes, to be on the safe side"""
+    return not ovenctl.mb_fn_is_readn(ord(frame[1]))
+
+def response_decoder(frame): # string -> MbFrameDecoder
+    """Make an MbFrameDecoder for the response to a request frame"""
+    func = ord(frame[1])
+    if ovenctl.mb_fn_is_readn(func):
+        n_words, = struct.unpack('>H', frame[4:6])
+        return ovenctl.MbFrameDecoder(func, n_words)
+    return ovenctl.MbFrameDecoder(func)
+
+class ProxyClient(object):
+    """One client connection to an OvenProxy
+    
+    Attributes:
+        peer: the client's (address, port)
+        pending: deque of (request frame, arrival time) not yet answered
+        requests: the number of requests received"""
+    def __init__(self, sock, peer):
+        self.sock = sock
+        self.peer = peer
+        self.pending = collections.deque()
+        self.requests = 0
+        self.closed = False
+    def __str__(self):
+        return "%s:%d" % self.peer
+    def send(self, resp):
+        """Send a response frame; on failure, close the connection"""
+        try:
+            self.sock.sendall(resp)
+        except socket.error:
+            self.close()
+    def close(self):
+        """Close the connection (the reader thread notices, and cleans up)"""
+        if self.closed: return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+class OvenProxy(object):
+    """Serve one oven to many clients, over a single connection to it"""
+    def __init__(self, oven, host='', port=ovenctl.BINDER_PORT,
+                 fresh=PROXY_FRESH, verbose=False):
+        """Construct an OvenProxy
+        
+        Parameters:
+            oven: the OvenCtl to send requests through; its session_idle
+             sets how long the connection to the oven is kept open unused
+            host: the address to listen on (default all)
+            port: the port to listen on (0 to pick a free one)
+            fresh: the time in seconds to reuse a READN's answer for
+             (0 to only collapse READNs queued alongside each other)
+            verbose: if True, log client connections and oven errors"""
+        self.oven = oven
+        self.host = host
+        self.port = port
+        self.fresh = fresh
+        self.verbose = verbose
+        self.cond = threading.Condition()
+        self.clients = [] # in round-robin order
+        self.turn = 0 # index into self.clients of the next to go
+        self.recent = {} # READN frame -> (response frame, time answered)
+        self.stopping = False
+        self.listener = None
+        self.threads = []
+        # Statistics
+        self.connections = 0
+        self.requests = 0
+        self.transactions = 0
+        self.collapsed = 0 # requests answered by another's transaction
+        self.failures = 0
+
+    def log(self, msg):
+        if self.verbose:
+            print msg
+            sys.stdout.flush()
+
+    def listen(self):
+        """Open the listening socket"""
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+
+    def submit(self, client, frame):
+        """Queue a request frame from client"""
+        with self.cond:
+            self.requests += 1
+            client.requests += 1
+            client.pending.append((frame, ovenctl.monotonic()))
+            self.cond.notify()
+
+    def _recent(self, frame, arrived, now):
+        """A recent answer to READN frame that will do, or None
+        
+        Must be called with self.cond held"""
+        if frame not in self.recent: return None
+        resp, answered = self.recent[frame]
+        # Anything asked before the answer came is an in-flight duplicate
+        if arrived <= answered or now - answered <= self.fresh:
+            return resp
+        del self.recent[frame]
+        return None
+
+    def _pick(self):
+        """Choose the next request to send to the oven
+        
+        Also takes any requests that can be answered from self.recent.
+        Returns (frame, [clients to answer], [(client, response)...]);
+        frame is None if there's nothing to send.
+        
+        Closed clients are skipped, so that requests queued by a client
+        which has since been dropped (eg. after a failed transaction) are
+        never sent.
+        
+        Must be called with self.cond held"""
+        now = ovenctl.monotonic()
+        answered = []
+        writes = []
+        reads = []
+        n = len(self.clients)
+        for i in xrange(n):
+            client = self.clients[(self.turn + i) % n]
+            if client.closed:
+                continue # its reader thread will remove it
+            while client.pending:
+                frame, arrived = client.pending[0]
+                if is_write(frame):
+                    writes.append(client)
+                    break
+                resp = self._recent(frame, arrived, now)
+                if resp is None:
+                    reads.append(client)
+                    break
+                client.pending.popleft()
+                answered.append((client, resp))
+                self.collapsed += 1
+        if writes:
+            chosen = writes[0]
+        elif reads:
+            chosen = reads[0]
+        else:
+            return None, [], answered
+        self.turn = (self.clients.index(chosen) + 1) % n
+        frame, arrived = chosen.pending.popleft()
+        waiting = [chosen]
+        if is_write(frame):
+            self.recent.clear()
+        else:
+            for client in reads:
+                if client is not chosen and client.pending[0][0] == frame:
+                    client.pending.popleft()
+                    waiting.append(client)
+                    self.collapsed += 1
+        return frame, waiting, answered
+
+    def forward(self, frame): # string -> string or None
+        """Send a request frame to the oven, and return its response frame
+        
+        Error responses (and responses with bad CRCs) are passed on as they
+        are, for the client to deal with.  Returns None if there was no
+        complete response"""
+        decoder = response_decoder(frame)
+        self.transactions += 1
+        try:
+            self.oven.transact(frame, decoder)
+        except (ovenctl.ModbusErrorException, ovenctl.ModbusCrcException):
+            pass
+        except (socket.error, ovenctl.ModbusException) as err:
+            self.log("Oven %s: %s" % (self.oven.hostname, err))
+            return None
+        return decoder.frame()
+
+    def dispatch(self):
+        """Send queued requests to the oven, one at a time, until stop()"""
+        with self.oven.session():
+            while not self.stopping:
+                with self.cond:
+                    frame, waiting, answered = self._pick()
+                    if frame is None and not answered:
+                        self.cond.wait(PROXY_POLL)
+                for client, resp in answered:
+                    client.send(resp)
+                if frame is None:
+                    continue
+                resp = self.forward(frame)
+                if resp is None:
+                    self.failures += 1
+                    for client in waiting:
+                        client.close()
+                    continue
+                if not is_write(frame):
+                    with self.cond:
+                        self.recent[frame] = (resp, ovenctl.monotonic())
+                for client in waiting:
+                    client.send(resp)
+
+    def serve_client(self, client):
+        """Read requests from one client until it disconnects"""
+        buf = ''
+        try:
+            while not self.stopping and not client.closed:
+                readable, w, x = select.select([client.sock], [], [],
+                                               PROXY_POLL)
+                if not readable:
+                    continue
+                data = client.sock.recv(4096)
+                if not data:
+                    break
+                buf += data
+                while True:
+                    length = ovenctl.request_len(buf)
+                    if length is None or len(buf) < length:
+                        break
+                    frame, buf = buf[:length], buf[length:]
+                    crc, = struct.unpack('<H', frame[-2:])
+                    if crc != ovenctl.calc_crc16(frame[:-2]):
+                        continue # bad requests are ignored, like the oven
+                    self.submit(client, frame)
+        except socket.error:
+            pass
+        finally:
+            with self.cond:
+                self.clients.remove(client)
+                if self.turn >= len(self.clients):
+                    self.turn = 0
+            client.close()
+            client.sock.close()
+            self.log("Client %s disconnected after %d requests" %
+                     (client, client.requests))
+
+    def serve_forever(self):
+        """Accept clients and serve them, until stop()"""
+        if self.listener is None:
+            self.listen()
+        dispatcher = threading.Thread(target=self.dispatch)
+        dispatcher.daemon = True
+        dispatcher.start()
+        try:
+            while not self.stopping:
+                readable, w, x = select.select([self.listener], [], [],
+                                               PROXY_POLL)
+                if not readable:
+                    continue
+                sock, peer = self.listener.accept()
+                client = ProxyClient(sock, peer)
+                with self.cond:
+                    self.clients.append(client)
+                    self.connections += 1
+                self.log("Client %s connected" % (client,))
+                thread = threading.Thread(target=self.serve_client,
+                                          args=(client,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.stopping = True
+            dispatcher.join()
+            self.listener.close()
+            self.listener = None
+
+    def start(self):
+        """Start serving in a background thread.  Returns the port"""
+        self.listen()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+        return self.port
+
+    def stop(self):
+        """Stop serving, and wait for the background thread (if any)"""
+        self.stopping = True
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def stats(self): # () -> str
+        """Summarise the traffic so far"""
+        return ("%d connections, %d requests, %d oven transactions "
+                "(%d requests collapsed), %d failures" %
+                (self.connections, self.requests, self.transactions,
+                 self.collapsed, self.failures))
+
+def parse_cmdline():
+    parser = optparse.OptionParser()
+    parser.usage = "%prog -H hostname [options]"
+    parser.add_option('-H', '--host', help='oven to connect to')
+    parser.add_option('-p', '--port', help='TCP port to connect to the oven on',
+                      default=ovenctl.BINDER_PORT)
+    parser.add_option('-b', '--bind', type='string', default='',
+                      help='Address to listen on (default all)')
+    parser.add_option('-P', '--listen', type='int',
+                      default=ovenctl.BINDER_PORT,
+                      help='Port to listen on (default %default, as the C '
+                           'tools expect)')
+    parser.add_option('-f', '--fresh', type='float', default=PROXY_FRESH,
+                      help='Time (in seconds) to reuse a READN answer for')
+    parser.add_option('-i', '--idle', type='float', default=PROXY_IDLE,
+                      help='Time (in seconds) after which to release an '
+                           'unused connection to the oven')
+    parser.add_option('-v', '--verbose', action='store_true',
+                      help='Log clients and oven errors')
+    options, args = parser.parse_args()
+
+    if not options.host:
+        print "ERROR: -H/--host is required"
+        sys.exit(2)
+
+    return options
+
+if __name__ == '__main__':
+    options = parse_cmdline()
+    oven = ovenctl.OvenCtl(options.host, options.port,
+                           session_idle=options.idle)
+    proxy = OvenProxy(oven, options.bind, options.listen, options.fresh,
+                      options.verbose)
+    proxy.listen()
+    print "Proxying %s:%s on %s:%d" % (options.host, options.port,
+                                       options.bind or '*', proxy.port)
+    sys.stdout.flush()
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print proxy.stats()
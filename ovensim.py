@@ -0,0 +1,416 @@
+#! /usr/bin/env python
+#
+# Copyright Solarflare Communications Inc., 2012-13
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of Solarflare Communications Inc. nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL SOLARFLARE COMMUNICATIONS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Simulate a BINDER oven (MK 53) with an XPort-03, for testing
+
+This serves BINDER's variant of MODBus over TCP/IP (see ovenctl) from an
+in-memory model of the MB1 controller, so that ovenctl, rampspec and the C
+tools in tools/ can be tested and benchmarked without a real oven.
+
+The controller's memory is seeded from an nmbdump memory image (see
+nmbdumps/dumps.readme).  Words which were MBER or TIME in the image can't
+be read or written (the simulator answers with error 3, 'parameter value
+outside range of values', for both).  Registers which ovenctl knows to be
+read-only (see ovenctl.OVEN_REGISTER_TABLE) can't be written (error 5).
+
+The chamber temperature follows a first-order lag towards the setpoint (or
+towards ambient, in Idle mode), optionally limited to a maximum rate.  The
+model can run faster than real time, by an acceleration factor.
+
+As with the real XPort-03, only one connection is served at a time; while a
+client is connected, further connections are refused.  (Since a client's
+next connection can then race with the server noticing that its last one
+was closed, the server can instead be told to leave further connections
+queued in the listen backlog; this is handy for benchmarking.)
+
+Faults can be injected: extra latency on each response, dropped bytes
+(the tail of a response is never sent), corrupted CRCs, and extra ranges
+of unreadable (MBER) addresses.  They are driven by a seeded random number
+generator so that runs are repeatable.
+
+class OvenModel is the model of the controller and chamber
+class OvenSimServer serves an OvenModel over TCP"""
+import sys, os, socket, select, struct, threading, optparse, random, math
+import time
+import ovenctl, nmbdump
+
+SIM_AMBIENT = 25.0 # Ambient temperature, deg C
+SIM_TAU     = 600  # Time constant of chamber temperature lag, in seconds
+SIM_POLL    = 0.1  # Server loop poll interval, in seconds
+
+DUMPDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nmbdumps')
+SIM_STATES = ('closed', 'open', 'active', 'limit')
+
+# Modes in which the oven is heating/cooling towards the setpoint
+SIM_ACTIVE_MODES = 0x1000|0x0800|0x0400
+
+class OvenModel(object):
+    """Model of a BINDER oven's MB1 controller and chamber"""
+    def __init__(self, memory, tau=SIM_TAU, max_rate=None,
+                 ambient=SIM_AMBIENT, accel=1.0, mber=(), clock=time.time):
+        """Construct an OvenModel
+        
+        Parameters:
+            memory: the initial memory image, as nmbdump.read_dump
+            tau: time constant of the chamber temperature, in seconds
+            max_rate: max. rate of temperature change, in deg C per hour
+             (default unlimited)
+            ambient: the ambient temperature, deg C
+            accel: how much faster than real time the model runs
+            mber: list of (start, end) address ranges to make unreadable
+            clock: function returning the real time in seconds"""
+        self.memory = {}
+        for addr, word in memory.iteritems():
+            self.memory[addr] = word if isinstance(word, int) else None
+        for start, end in mber:
+            for addr in xrange(start, end):
+                self.memory[addr] = None
+        self.readonly = set()
+        for reg in ovenctl.OVEN_REGISTERS:
+            if reg.access == "r":
+                self.readonly.update(xrange(reg.addr, reg.end()))
+        self.tau = tau
+        self.max_rate = max_rate
+        self.ambient = ambient
+        self.accel = accel
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.last = clock()
+        self.elapsed = 0.0 # simulated seconds
+        self.temp = self.read_float(ovenctl.OVENADDR_CURTEMP)
+        if self.temp is None:
+            self.temp = ambient
+        self.update_setpoint()
+
+    @classmethod
+    def from_dump(cls, filename, **kwargs):
+        """Construct an OvenModel from an nmbdump file"""
+        return cls(nmbdump.load_dump(filename), **kwargs)
+
+    def read_float(self, addr):
+        """Peek a float at address addr, or None if it's unreadable"""
+        words = [self.memory.get(a) for a in (addr, addr+1)]
+        if None in words: return None
+        return ovenctl.decode_float(words)
+
+    def write_float(self, addr, value):
+        """Poke a float at address addr"""
+        self.memory[addr], self.memory[addr+1] = ovenctl.encode_float(value)
+
+    def setpoint(self):
+        """Return the active setpoint"""
+        return self.read_float(ovenctl.OVENADDR_SETPOINT)
+
+    def active(self):
+        """Return True if the oven is in an active mode"""
+        return bool(self.memory.get(ovenctl.OVENADDR_MODE, 0) &
+                    SIM_ACTIVE_MODES)
+
+    def update_setpoint(self):
+        """Update the read-only setpoint from the writable ones
+        
+        In Manual mode it's the manual setpoint, otherwise the basic one
+        (see notes)"""
+        if self.memory.get(ovenctl.OVENADDR_MODE, 0)&0x0800:
+            addr = ovenctl.OVENADDR_MANSETPT
+        else:
+            addr = ovenctl.OVENADDR_BASICSETPT
+        value = self.read_float(addr)
+        if value is not None:
+            self.write_float(ovenctl.OVENADDR_SETPOINT, value)
+
+    def step(self):
+        """Advance the thermal model to the current time"""
+        with self.lock:
+            now = self.clock()
+            dt = (now - self.last) * self.accel
+            self.last = now
+            self.elapsed += dt
+            if dt <= 0: return
+            target = self.setpoint() if self.active() else self.ambient
+            if target is None: target = self.ambient
+            new = target + (self.temp - target) * math.exp(-dt/self.tau)
+            if self.max_rate is not None:
+                limit = self.max_rate * dt / 3600.0
+                new = max(self.temp - limit, min(self.temp + limit, new))
+            self.temp = new
+            if self.read_float(ovenctl.OVENADDR_CURTEMP) is not None:
+                self.write_float(ovenctl.OVENADDR_CURTEMP, self.temp)
+
+    def read(self, addr, n_words): # (int, int) -> (int, [int...])
+        """Read n_words words at address addr
+        
+        Returns (error code, words); error code is None on success"""
+        with self.lock:
+            self.step()
+            words = [self.memory.get(a) for a in xrange(addr, addr+n_words)]
+            if None in words:
+                return ovenctl.MB_EE_RANGE, None
+            return None, words
+
+    def write(self, addr, words): # (int, [int...]) -> int
+        """Write words at address addr
+        
+        Returns the error code, or None on success"""
+        with self.lock:
+            self.step()
+            span = xrange(addr, addr+len(words))
+            if any(self.memory.get(a) is None for a in span):
+                return ovenctl.MB_EE_RANGE
+            if any(a in self.readonly for a in span):
+                return ovenctl.MB_EE_ACCESS
+            for a, word in zip(span, words):
+                self.memory[a] = word
+            self.update_setpoint()
+            return None
+
+    def set_door(self, is_open):
+        """Open or close the (simulated) door, raising a Note if open"""
+        with self.lock:
+            self.memory[ovenctl.OVENADDR_DOOROPEN] = int(bool(is_open))
+            self.memory[ovenctl.OVENADDR_NOTE] = int(bool(is_open))
+            self.set_alarm_text("DOOR OPEN" if is_open else None)
+
+    def set_alarm(self, text):
+        """Raise an Alarm with the given text, or clear it if text is None"""
+        with self.lock:
+            self.memory[ovenctl.OVENADDR_ALARM] = int(text is not None)
+            self.set_alarm_text(text)
+
+    def set_alarm_text(self, text):
+        """Set the Alarm/Note text (one byte to a word, space-padded)"""
+        reg = ovenctl.OVENREG['alrmtext']
+        text = (text or '').ljust(reg.length)[:reg.length]
+        for a, c in enumerate(text, reg.addr):
+            self.memory[a] = ord(c)
+
+def crc_frame(msg): # string -> string
+    """Append the (little-endian) CRC16 to msg"""
+    return msg + struct.pack('<H', ovenctl.calc_crc16(msg))
+
+class OvenSimServer(object):
+    """Serve an OvenModel over TCP, like an XPort-03"""
+    def __init__(self, model, host='127.0.0.1', port=ovenctl.BINDER_PORT,
+                 latency=0, drop=0, badcrc=0, seed=None, refuse=True):
+        """Construct an OvenSimServer
+        
+        Parameters:
+            model: the OvenModel to serve
+            host: the address to listen on (default localhost only)
+            port: the port to listen on (0 to pick a free one)
+            latency: delay before each response, in (real) seconds
+            drop: probability of dropping the tail of each response
+            badcrc: probability of corrupting the CRC of each response
+            seed: seed for the fault injection random number generator
+            refuse: if True, refuse connections while one is open, like
+             the XPort-03; if False, queue them"""
+        self.model = model
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.drop = drop
+        self.badcrc = badcrc
+        self.random = random.Random(seed)
+        self.refuse = refuse
+        self.stopping = False
+        self.thread = None
+        self.listener = None
+        self.connections = 0
+        self.refused = 0
+        self.transactions = 0
+
+    def listen(self):
+        """Open the listening socket"""
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(1 if self.refuse else 16)
+        self.port = self.listener.getsockname()[1]
+
+    def respond(self, req): # string -> string or None
+        """Work out the response to a request frame"""
+        crc, = struct.unpack('<H', req[-2:])
+        if crc != ovenctl.calc_crc16(req[:-2]):
+            return None # bad requests are ignored, like a real slave
+        slave, func, addr, count = struct.unpack('>BBHH', req[:6])
+        self.transactions += 1
+        if ovenctl.mb_fn_is_readn(func):
+            ecode, words = self.model.read(addr, count)
+            if ecode is None:
+                return crc_frame(struct.pack('>BBB%dH' % count, slave, func,
+                                             count*2, *words))
+        elif func == ovenctl.MB_FN_WRITE:
+            ecode = self.model.write(addr, [count])
+            if ecode is None:
+                return crc_frame(req[:6])
+        elif func == ovenctl.MB_FN_WRITEN:
+            words = struct.unpack('>%dH' % count, req[7:7+count*2])
+            ecode = self.model.write(addr, words)
+            if ecode is None:
+                return crc_frame(req[:6])
+        else:
+            ecode = ovenctl.MB_EE_FN
+        return crc_frame(struct.pack('>BBB', slave, func|0x80, ecode))
+
+    def send(self, sock, resp):
+        """Send a response, with any faults applied"""
+        if self.latency:
+            time.sleep(self.latency)
+        if self.badcrc and self.random.random() < self.badcrc:
+            resp = resp[:-2] + struct.pack('<H', ~ovenctl.calc_crc16(
+                resp[:-2]) & 0xffff)
+        if self.drop and self.random.random() < self.drop:
+            resp = resp[:self.random.randrange(len(resp))]
+        sock.sendall(resp)
+
+    def serve_client(self, sock):
+        """Handle requests on one connection until it's closed"""
+        buf = ''
+        while not self.stopping:
+            readable, w, x = select.select([sock], [], [], SIM_POLL)
+            if not readable:
+                continue
+            data = sock.recv(4096)
+            if not data:
+                return
+            buf += data
+            while True:
+                length = ovenctl.request_len(buf)
+                if length is None or len(buf) < length:
+                    break
+                req, buf = buf[:length], buf[length:]
+                resp = self.respond(req)
+                if resp is not None:
+                    self.send(sock, resp)
+
+    def serve_forever(self):
+        """Accept and serve connections, one at a time, until stop()"""
+        if self.listener is None:
+            self.listen()
+        while not self.stopping:
+            readable, w, x = select.select([self.listener], [], [], SIM_POLL)
+            if not readable:
+                continue
+            sock, peer = self.listener.accept()
+            self.connections += 1
+            if self.refuse:
+                # Refuse any other connections while this one's open
+                self.listener.close()
+                self.listener = None
+            try:
+                self.serve_client(sock)
+            except socket.error:
+                pass
+            finally:
+                sock.close()
+                if self.listener is None and not self.stopping:
+                    self.listen()
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+    def start(self):
+        """Start serving in a background thread.  Returns the port"""
+        self.listen()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        """Stop serving, and wait for the background thread (if any)"""
+        self.stopping = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+def parse_range(string): # string -> (int, int)
+    """Parse a hex address range 'start-end' (end exclusive), or 'addr'"""
+    start, dash, end = string.partition('-')
+    start = int(start, 16)
+    return start, (int(end, 16) if dash else start+1)
+
+def parse_cmdline():
+    parser = optparse.OptionParser()
+    parser.usage = "%prog [options]"
+    parser.add_option('-s', '--state', type='choice', choices=SIM_STATES,
+                      default='closed',
+                      help='Initial state, from nmbdumps (%s)' %
+                           ', '.join(SIM_STATES))
+    parser.add_option('-D', '--dump', type='string',
+                      help='Initial memory image (overrides -s)')
+    parser.add_option('-b', '--bind', type='string', default='127.0.0.1',
+                      help='Address to listen on')
+    parser.add_option('-p', '--port', type='int',
+                      default=ovenctl.BINDER_PORT,
+                      help='TCP port to listen on')
+    parser.add_option('-t', '--tau', type='float', default=SIM_TAU,
+                      help='Time constant (in seconds) of temp. lag')
+    parser.add_option('-r', '--rate', type='float', default=None,
+                      help='Max. rate of temp. change in deg C per hour')
+    parser.add_option('-a', '--accel', type='float', default=1.0,
+                      help='Time acceleration factor')
+    parser.add_option('-L', '--latency', type='float', default=0,
+                      help='Extra latency (in seconds) per response')
+    parser.add_option('-d', '--drop', type='float', default=0,
+                      help='Probability of dropping bytes of a response')
+    parser.add_option('-c', '--badcrc', type='float', default=0,
+                      help='Probability of corrupting the CRC of a response')
+    parser.add_option('-m', '--mber', action='append', default=[],
+                      help='Hex address range start-end to make unreadable '
+                           '(may be repeated)')
+    parser.add_option('-S', '--seed', type='int', default=None,
+                      help='Seed for the fault injection RNG')
+    parser.add_option('-q', '--queue', action='store_true',
+                      help="Queue connections rather than refusing them "
+                           "while one is open")
+    options, args = parser.parse_args()
+
+    try:
+        options.mber = map(parse_range, options.mber)
+    except ValueError as err:
+        print "ERROR: Bad -m/--mber range: %s" % err
+        sys.exit(2)
+
+    return options
+
+if __name__ == '__main__':
+    options = parse_cmdline()
+    dump = options.dump or os.path.join(DUMPDIR, options.state + '.dump')
+    model = OvenModel.from_dump(dump, tau=options.tau,
+                                max_rate=options.rate, accel=options.accel,
+                                mber=options.mber)
+    server = OvenSimServer(model, options.bind, options.port,
+                           options.latency, options.drop, options.badcrc,
+                           options.seed, not options.queue)
+    server.listen()
+    print "Simulating %s on %s:%d" % (dump, options.bind, server.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
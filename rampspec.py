@@ -25,49 +25,55 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import time, optparse, math, sys, operator
+import time, optparse, math, sys, operator, re
+import ovenctl
 
-def MacroRepeat(args, text):
+def MacroRepeat(args, body):
     count = int(args)
-    return count*text
+    if count <= 0: return []
+    return [RSRepeat(count, body)]
 
 RSActionArgumentTable = (('H', ('c', 'd', 's', 't')), ('I', ('t',)), ('J', ('j',)), ('R', ('c', 'd', 'r', 's', 't')), ('W', ('c', 'd', 'l', 's', 't', 'z')), ('X', ('j',)))
 RSActionEnum = tuple(rsaa[0] for rsaa in RSActionArgumentTable)
+RSActionArguments = dict(RSActionArgumentTable)
 RSArgumentTypes = (('c', "float"), ('d', "bool"), ('j', "int"), ('l', "float"), ('r', "float"), ('s', "float"), ('t', "float"), ('z', "int"))
 RSArgumentEnum = tuple(rsa[0] for rsa in RSArgumentTypes)
+RSArgumentType = dict(RSArgumentTypes)
 RSMacroCalls = (('#', MacroRepeat),)
 RSMacroEnum = tuple(rsm[0] for rsm in RSMacroCalls)
+# Tokens of the pre-processor: brackets, and runs of anything else
+RSMacroToken = re.compile(r'[\[\]]|[^\[\]]+')
 
 class RSParseException(Exception): pass
 
-class RSArgument:
+class RSArgument(object):
+    __slots__ = ('arg', 'value', 'text')
     def __init__(self, arg, value):
         self.arg = arg
-        ai = RSArgumentEnum.index(arg)
-        argtype = RSArgumentTypes[ai][1]
+        argtype = RSArgumentType[arg]
         if argtype == "bool":
             self.value = True
+            self.text = arg
         elif argtype == "int":
             self.value = int(value)
+            self.text = "%s%d" % (arg, self.value)
         elif argtype == "float":
             self.value = float(value)
+            self.text = "%s%g" % (arg, self.value)
         else:
             raise Exception("Argument", arg, "has invalid type", argtype)
     def __str__(self):
-        ai = RSArgumentEnum.index(self.arg)
-        argtype = RSArgumentTypes[ai][1]
-        if argtype == "bool":
-            return self.arg if self.value else ""
-        elif argtype == "int":
-            return "%s%d" % (self.arg, self.value)
-        elif argtype == "float":
-            return "%s%g" % (self.arg, self.value)
-        else:
-            raise Exception("Argument", self.arg, "has invalid type", argtype)
+        return self.text
 
-class RSAction:
+class RSAction(object):
+    """A parsed action
+    
+    Each argument is resolved into an attribute of the same name (None if
+    the argument was not given), so that RampCtl can get at them directly;
+    action['s'] and 's' in action also work."""
+    __slots__ = ('label', 'act', 'args') + RSArgumentEnum
     def __init__(self, string):
-        self.label = None
+        self.label = self.c = self.d = self.j = self.l = self.r = self.s = self.t = self.z = None
         label, colon, rest = string.partition(':')
         if len(colon):
             try:
@@ -75,111 +81,314 @@ class RSAction:
             except ValueError:
                 raise RSParseException("Invalid label", label, ":", rest)
             string = rest
+        if not len(string):
+            raise RSParseException("Missing action after label", label)
         self.act = string[0]
         try:
-            ai = RSActionEnum.index(self.act)
-        except ValueError:
+            allowed = RSActionArguments[self.act]
+        except KeyError:
             raise RSParseException("No such action", self.act)
         self.args = []
-        argstr = string[1:]
-        while len(argstr):
-            arg = argstr[0]
-            if arg in map(lambda arg: arg.arg, self.args):
-                raise RSParseException("Argument", arg, "specified twice")
-            if arg not in RSArgumentEnum:
-                raise RSParseException("No such argument", arg)
-            if arg not in RSActionArgumentTable[ai][1]:
-                raise RSParseException("Invalid argument", arg, "for action", self.act)
-            value, ignore, argstr = argstr[1:].partition(',')
-            self.args.append(RSArgument(arg, value))
+        if len(string) > 1:
+            argstrs = string[1:].split(',')
+            if not len(argstrs[-1]): # trailing comma
+                argstrs.pop()
+            for argstr in argstrs:
+                arg = argstr[:1]
+                if arg not in RSArgumentType:
+                    raise RSParseException("No such argument", arg)
+                if getattr(self, arg) is not None:
+                    raise RSParseException("Argument", arg, "specified twice")
+                if arg not in allowed:
+                    raise RSParseException("Invalid argument", arg, "for action", self.act)
+                argument = RSArgument(arg, argstr[1:])
+                self.args.append(argument)
+                setattr(self, arg, argument.value)
         # validate the argument list
         #  R must have at least one of r,t
         if self.act=='R':
-            if 'r' not in self and 't' not in self:
+            if self.r is None and self.t is None:
                 raise RSParseException("Action 'R' (ramp) must have at least one of r, t")
         #  Can't have Wz without l
         elif self.act=='W':
-            if 'z' in self and 'l' not in self:
+            if self.z is not None and self.l is None:
                 raise RSParseException("Action 'W' (wait) can't have z without l")
         #  J must have j
-        elif self.act=='J' and 'j' not in self:
+        elif self.act=='J' and self.j is None:
             raise RSParseException("Action 'J' (jump) must have j")
         #  Can't have s,c anywhere
-        elif 's' in self and 'c' in self:
+        elif self.s is not None and self.c is not None:
             raise RSParseException("Can't combine s, c")
     def __str__(self):
         return self.act + ','.join(map(str, self.args))
     def __getitem__(self, arg):
-        items = filter(lambda a: a.arg==arg, self.args)
-        if len(items) > 1:
-            raise Exception("Multiple values for argument", arg)
-        elif not len(items):
+        value = getattr(self, arg) if arg in RSArgumentType else None
+        if value is None:
             raise KeyError(arg)
-        return items[0].value
+        return value
     def __contains__(self, arg):
-        items = filter(lambda a: a.arg==arg, self.args)
-        return len(items) == 1
+        return arg in RSArgumentType and getattr(self, arg) is not None
     def duration(self):
-        try:
-            return self['t']
-        except KeyError:
-            return 0
+        return self.t or 0
     def setpoint(self, old):
-        if 's' in self:
-            return self['s']
-        elif 'c' in self:
-            return old + self['c']
+        if self.s is not None:
+            return self.s
+        elif self.c is not None:
+            return old + self.c
         else:
             return old
 
-def macroexecute(string):
-    for i,c in enumerate(string):
-        if c in RSMacroEnum:
-            n = RSMacroEnum.index(c)
-            return(RSMacroCalls[n][1](string[:i], string[i+1:]))
-    raise RSParseException("No recognisable macro call in [", string, "]")
+class RSRepeat(object):
+    """A repeat block, [count#body], in the output of macroparse
+    
+    body is a list as returned by macroalign.  If the block starts and ends
+    on action boundaries it is kept as it is and becomes a loop in the
+    compiled RampSpec (see RSLoop); otherwise it is expanded into text."""
+    __slots__ = ('count', 'body')
+    def __init__(self, count, body):
+        self.count = count
+        self.body = body
+    def aligned(self):
+        """Does the body end on an action boundary?"""
+        if not len(self.body): return False
+        last = self.body[-1]
+        return isinstance(last, RSRepeat) or last.endswith(';')
+    def expand(self):
+        return self.count * macroflatten(self.body)
 
-def macroexpand(string):
+def macroflatten(segments): # [string or RSRepeat...] -> string
+    """Expand a list of segments into text, as the pre-processor would"""
+    return ''.join(seg.expand() if isinstance(seg, RSRepeat) else seg
+                   for seg in segments)
+
+def macroalign(segments): # [string or RSRepeat...] -> [string or RSRepeat...]
+    """Expand any repeat blocks that don't lie on action boundaries
+    
+    A repeat is kept as an RSRepeat only if it starts at the beginning of
+    segments or after a ';' (or another kept repeat), and its body ends with
+    ';' (or a kept repeat).  Adjacent text is merged."""
+    out = []
+    for seg in segments:
+        if isinstance(seg, RSRepeat):
+            if seg.aligned() and (not len(out) or
+                                  isinstance(out[-1], RSRepeat) or
+                                  out[-1].endswith(';')):
+                out.append(seg)
+                continue
+            seg = seg.expand()
+        if not len(seg): continue
+        if len(out) and not isinstance(out[-1], RSRepeat):
+            out[-1] += seg
+        else:
+            out.append(seg)
+    return out
+
+def macroexecute(segments):
+    for i,seg in enumerate(segments):
+        if isinstance(seg, RSRepeat): break
+        for j,c in enumerate(seg):
+            if c in RSMacroEnum:
+                n = RSMacroEnum.index(c)
+                body = [seg[j+1:]] + segments[i+1:]
+                return(RSMacroCalls[n][1](''.join(segments[:i]) + seg[:j],
+                                          macroalign(body)))
+    else:
+        raise RSParseException("No recognisable macro call in [", macroflatten(segments), "]")
+    # a repeat before the macro name; can only be treated as text
+    string = macroflatten(segments)
+    return macroexecute([string])
+
+def macroparse(string): # string -> [string or RSRepeat...]
+    """Run the pre-processor, keeping repeats as RSRepeat where possible
+    
+    Returns a list as macroalign"""
     stack = [[]]
-    for c in string:
-        if c == '[':
+    for token in RSMacroToken.findall(string):
+        if token == '[':
             stack.append([])
-        elif c == ']':
+        elif token == ']':
             try:
-                block = ''.join(stack.pop())
-                stack[-1].append(macroexecute(block))
+                block = stack.pop()
+                stack[-1].extend(macroexecute(block))
             except IndexError:
                 raise RSParseException("Unmatched ']'")
         else:
-            stack[-1].append(c)
+            stack[-1].append(token)
     if len(stack) > 1:
         raise RSParseException("Unmatched '['")
-    return ''.join(stack[0])
+    return macroalign(stack[0])
+
+def macroexpand(string):
+    """Run the pre-processor, expanding everything into text"""
+    return macroflatten(macroparse(string))
+
+class RSLoop(object):
+    """Start of a repeat block in a compiled RampSpec
+    
+    Attributes:
+        count: number of times to run the block
+        end: index in the program of the matching RSEndLoop
+        length: number of actions in one pass of the block (ignoring jumps)
+        labels: the labels of actions in the block"""
+    __slots__ = ('count', 'end', 'length', 'labels')
+    def __init__(self, count):
+        self.count = count
+        self.end = None
+        self.length = 0
+        self.labels = frozenset()
+
+class RSEndLoop(object):
+    """End of a repeat block; start is the index of its RSLoop"""
+    __slots__ = ('start',)
+    def __init__(self, start):
+        self.start = start
 
 class RampSpec:
+    """A parsed rampspec
+    
+    The actions are compiled into self.program, a tuple of RSActions in
+    which repeat blocks appear once, between an RSLoop and an RSEndLoop, so
+    that its size does not depend on the repeat counts.  len() gives the
+    number of actions that would be run (ignoring jumps), and iterating
+    gives them in order."""
     def __init__(self, string):
-        self.actions = []
-        for actstr in macroexpand(string).split(';'):
-            if len(actstr):
-                self.actions.append(RSAction(actstr))
+        # Actions are immutable once parsed, so repeats of the same text
+        # can share one RSAction
+        program = []
+        self.compile(macroparse(string), program, {})
+        self.program = tuple(program)
+        # self.tail[i] is the number of actions run from program[i] to the
+        # end of the enclosing block (or the program)
+        tail = [0] * (len(program) + 1)
+        for i in xrange(len(program) - 1, -1, -1):
+            ins = program[i]
+            if isinstance(ins, RSEndLoop):
+                continue
+            elif isinstance(ins, RSLoop):
+                ins.length = tail[i+1]
+                ins.labels = frozenset(a.label for a in program[i+1:ins.end]
+                                       if isinstance(a, RSAction) and
+                                       a.label is not None)
+                tail[i] = ins.count * ins.length + tail[ins.end+1]
+            else:
+                tail[i] = 1 + tail[i+1]
+        self.tail = tuple(tail)
+    def compile(self, segments, program, parsed):
+        for seg in segments:
+            if isinstance(seg, RSRepeat):
+                loop = RSLoop(seg.count)
+                start = len(program)
+                program.append(loop)
+                self.compile(seg.body, program, parsed)
+                loop.end = len(program)
+                program.append(RSEndLoop(start))
+                continue
+            for actstr in seg.split(';'):
+                if len(actstr):
+                    action = parsed.get(actstr)
+                    if action is None:
+                        action = parsed[actstr] = RSAction(actstr)
+                    program.append(action)
+    def __len__(self):
+        return self.tail[0]
+    def __iter__(self):
+        loops = []
+        i = 0
+        while i < len(self.program):
+            ins = self.program[i]
+            if isinstance(ins, RSLoop):
+                loops.append([i, ins.count])
+            elif isinstance(ins, RSEndLoop):
+                loops[-1][1] -= 1
+                if loops[-1][1]:
+                    i = ins.start
+                else:
+                    loops.pop()
+            else:
+                yield ins
+            i += 1
+    @property
+    def actions(self):
+        """List of all the actions, with repeats expanded"""
+        return list(self)
     def __str__(self):
-        return ';'.join(map(str, self.actions))
-    def prepare(self, oven, xcallback=None, xcdata=None):
-        return RampCtl(self, oven, xcallback, xcdata)
+        parts = []
+        for ins in self.program:
+            if isinstance(ins, RSLoop):
+                parts.append('[%d#' % ins.count)
+            elif isinstance(ins, RSEndLoop):
+                parts.append(']')
+            else:
+                parts.append(str(ins) + ';')
+        string = ''.join(parts)
+        return string[:-1] if string.endswith(';') else string
+    def prepare(self, oven, xcallback=None, xcdata=None, clock=ovenctl.monotonic):
+        return RampCtl(self, oven, xcallback, xcdata, clock)
+
+def check_jumps(program):
+    """Check that every jump in a compiled program has somewhere to go
+    
+    Jumps only go forwards, to the next action to be run which has the
+    label; that may be later in the program, or (inside a repeat block)
+    earlier in the block on its next pass.
+    
+    Can raise: RSParseException if a jump has no label to go to"""
+    last = {}
+    for i, ins in enumerate(program):
+        if isinstance(ins, RSAction) and ins.label is not None:
+            last[ins.label] = i
+    loops = []
+    for i, ins in enumerate(program):
+        if isinstance(ins, RSLoop):
+            loops.append(ins)
+        elif isinstance(ins, RSEndLoop):
+            loops.pop()
+        elif ins.act in ('J', 'X') and ins.j is not None:
+            if last.get(ins.j, -1) > i: continue
+            if any(l.count > 1 and ins.j in l.labels for l in loops): continue
+            raise RSParseException("Action", str(ins), "jumps to missing label", ins.j)
+
+RAMPCTL_WAIT_POLL   = 3    # Time between temperature readings in a Wait, seconds
+RAMPCTL_RESOLUTION  = 0.01 # Smallest setpoint step worth writing, deg C
+RAMPCTL_MIN_STEP    = 1    # Min. time between setpoint writes in a Ramp, seconds
+RAMPCTL_SAFETY_POLL = 30   # Max. time between RampCtl.run calls, seconds
+RAMPCTL_MIN_DELAY   = 0.1  # Min. time between RampCtl.run calls, seconds
 
 class RampCtl:
-    def __init__(self, spec, oven, xcallback=None, xcdata=None):
-        self.actions = spec.actions
+    """Runs a RampSpec on an oven
+    
+    self.index points at the current action in the spec's program, and
+    self.loops holds [index of RSLoop, passes left] for each repeat block
+    we're in.  Jumps are checked here, before anything is sent to the oven.
+    clock is a function returning the time in seconds (see VirtualClock);
+    it should be monotonic, so that wall-clock adjustments don't stretch or
+    cut short the actions.  Use next_deadline() or delay() to decide when
+    to call run() again.
+    
+    Can raise: RSParseException if a jump target is missing"""
+    def __init__(self, spec, oven, xcallback=None, xcdata=None,
+                 clock=ovenctl.monotonic):
+        check_jumps(spec.program)
+        self.clock = clock
+        self.spec = spec
+        self.program = spec.program
+        self.index = 0
+        self.loops = []
+        self.settle()
         self.oven = oven
-        self.act_start = time.time()/3600.0
+        self.act_start = self.clock()/3600.0
         self.old_setpoint = None
-        self.new_action = bool(len(self.actions))
+        self.new_action = self.index < len(self.program)
         self.xcallback = xcallback
         self.xcdata = xcdata
+        self.history = [] # [(index, hours spent)...] of finished actions
     def run(self):
-        if not len(self.actions): return 0
-        now = time.time()/3600.0
-        action = self.actions[0]
+        """Do whatever the current action needs doing now
+        
+        Returns the number of actions left (0 when the profile is done)"""
+        if self.index >= len(self.program): return 0
+        now = self.clock()/3600.0
+        action = self.program[self.index]
         duration = action.duration()
         finished = (now > self.act_start + duration)
         jump_to = None
@@ -195,23 +404,18 @@ class RampCtl:
             if finished:
                 self.old_setpoint = self.oven.get_temp()
         elif action.act == 'J':
-            jump_to = action['j']
+            jump_to = action.j
         elif action.act == 'R':
-            new_setpoint = action.setpoint(self.old_setpoint)
-            if 'r' in action:
-                if duration:
-                    rate = min(abs((new_setpoint-self.old_setpoint)/duration), abs(action['r']))
-                else:
-                    rate = action['r']
+            new_setpoint, rate = self.ramp(action)
+            if action.r is not None:
                 temp = self.old_setpoint + (now-self.act_start)*math.copysign(rate, new_setpoint-self.old_setpoint)
-                finished = ((self.old_setpoint < new_setpoint) != (temp < new_setpoint))
+                finished = (new_setpoint == self.old_setpoint or
+                            (self.old_setpoint < new_setpoint) != (temp < new_setpoint))
                 if finished: temp = new_setpoint
-            elif duration:
+            else:
                 tfrac = (now-self.act_start)/duration
                 temp = sum(map(operator.mul, (self.old_setpoint, new_setpoint), (1-tfrac, tfrac)))
                 if finished: temp = new_setpoint
-            else:
-                raise Exception("Action 'R' with neither 'r'ate nor 't'ime: %s" % action)
             if finished: self.old_setpoint = temp
             self.oven.set_setpoint(temp, force=True)
             self.oven.set_mode_active(force=True)
@@ -226,15 +430,15 @@ class RampCtl:
             if self.new_action:
                 self.old_temp = None
                 self.stable = 0
-            if 'l' in action and action['l']>0:
-                near = abs(self.old_setpoint - temp)<action['l']
+            if action.l is not None and action.l>0:
+                near = abs(self.old_setpoint - temp)<action.l
             elif self.old_temp is not None:
                 near = ((self.old_setpoint < self.old_temp) != (self.old_setpoint < temp))
             else:
                 near = False
-            if 'z' in action and action['z']>0:
+            if action.z is not None and action.z>0:
                 self.stable = (self.stable + 1) if near else 0
-                finished = self.stable > action['z']
+                finished = self.stable > action.z
             else:
                 finished = near
             self.old_temp = temp
@@ -245,38 +449,294 @@ class RampCtl:
                 except (TypeError, ValueError) as err:
                     raise Exception("XCallback didn't return a 2-tuple", err)
                 if status:
-                    try:
-                        jump_to = action['j']
-                    except KeyError:
-                        jump_to = None
+                    jump_to = action.j
             else:
                 raise Exception("XCallback is not callable")
         else:
             raise Exception("Unrecognised action", action.act)
-        self.oven.bedew_protection = ('d' in action and action['d'] and self.oven.get_setpoint()<20)
+        self.oven.bedew_protection = (action.d is not None and self.oven.get_setpoint()<20)
         self.new_action = False
         if finished: self.next()
         if jump_to is not None:
-            while len(self.actions):
-                if self.actions[0].label == jump_to: break
-                self.next()
-        return len(self.actions)
+            self.jump(jump_to)
+        return self.remaining()
+    def ramp(self, action):
+        """Target setpoint and rate (deg C per hour, unsigned) of a Ramp
+        
+        Can raise: Exception if the action has neither 'r'ate nor 't'ime"""
+        new_setpoint = action.setpoint(self.old_setpoint)
+        duration = action.duration()
+        if action.r is not None:
+            if duration:
+                return new_setpoint, min(abs((new_setpoint-self.old_setpoint)/duration), abs(action.r))
+            return new_setpoint, abs(action.r)
+        if duration:
+            return new_setpoint, abs(new_setpoint-self.old_setpoint)/duration
+        raise Exception("Action 'R' with neither 'r'ate nor 't'ime: %s" % action)
+    def next_deadline(self):
+        """When run() next has something to do, in seconds by self.clock
+        
+        That's straight away for a new action, a Jump or an X; the end of a
+        Hold or Idle; the next RAMPCTL_RESOLUTION step of a Ramp (no sooner
+        than RAMPCTL_MIN_STEP), or its end; and the next temperature reading
+        of a Wait.  Between deadlines the oven still needs checking, so
+        don't leave it longer than a safety poll (see delay()).
+        Returns None if the profile is done."""
+        action = self.action
+        if action is None: return None
+        now = self.clock()
+        if self.new_action: return now
+        start = self.act_start*3600.0
+        if action.act in ('H', 'I'):
+            return start + action.duration()*3600.0
+        if action.act == 'W':
+            return now + RAMPCTL_WAIT_POLL
+        if action.act == 'R':
+            new_setpoint, rate = self.ramp(action)
+            if not rate:
+                # Nowhere to go: a rate ramp finishes at once, a timed one holds
+                if action.r is not None: return now
+                return start + action.duration()*3600.0
+            end = start + abs(new_setpoint-self.old_setpoint)*3600.0/rate
+            step = max(RAMPCTL_RESOLUTION*3600.0/rate, RAMPCTL_MIN_STEP)
+            return min(now + step, end)
+        return now
+    def delay(self, safety_poll=RAMPCTL_SAFETY_POLL):
+        """Time to wait before calling run() again, in seconds
+        
+        Parameters:
+            safety_poll: the longest to wait, whatever the deadline"""
+        deadline = self.next_deadline()
+        wait = safety_poll
+        if deadline is not None:
+            wait = min(deadline - self.clock(), wait)
+        return max(wait, RAMPCTL_MIN_DELAY)
+    @property
+    def action(self):
+        """The current RSAction, or None if the profile is done"""
+        if self.index < len(self.program):
+            return self.program[self.index]
+        return None
+    def remaining(self):
+        """Number of actions left, including the current one (ignoring jumps)"""
+        if self.index >= len(self.program): return 0
+        n = self.spec.tail[self.index]
+        for start, left in self.loops:
+            loop = self.program[start]
+            n += (left - 1) * loop.length + self.spec.tail[loop.end+1]
+        return n
+    def settle(self):
+        """Step over any loop instructions, stopping at the next action"""
+        program = self.program
+        while self.index < len(program):
+            ins = program[self.index]
+            if isinstance(ins, RSLoop):
+                if ins.length:
+                    self.loops.append([self.index, ins.count])
+                    self.index += 1
+                else:
+                    self.index = ins.end + 1
+            elif isinstance(ins, RSEndLoop):
+                loop = self.loops[-1]
+                loop[1] -= 1
+                if loop[1]:
+                    self.index = ins.start + 1
+                else:
+                    self.loops.pop()
+                    self.index += 1
+            else:
+                break
     def next(self):
+        now = self.clock()/3600.0
+        self.history.append((self.index, now - self.act_start))
+        self.new_action = True
+        self.index += 1
+        self.settle()
+        self.act_start = now
+    def jump(self, label):
+        """Go to the next action to be run (from the current one) with label
+        
+        Repeat blocks not containing the label are skipped over whole"""
+        program = self.program
+        while self.index < len(program):
+            ins = program[self.index]
+            if isinstance(ins, RSLoop):
+                if label in ins.labels:
+                    self.loops.append([self.index, ins.count])
+                    self.index += 1
+                else:
+                    self.index = ins.end + 1
+            elif isinstance(ins, RSEndLoop):
+                loop = self.loops[-1]
+                if loop[1] > 1 and label in program[ins.start].labels:
+                    loop[1] -= 1
+                    self.index = ins.start + 1
+                else:
+                    self.loops.pop()
+                    self.index += 1
+            elif ins.label == label:
+                break
+            else:
+                self.index += 1
         self.new_action = True
-        self.actions = self.actions[1:]
-        self.act_start = time.time()/3600.0
+        self.act_start = self.clock()/3600.0
+    def progress(self):
+        """Report progress through the profile
+        
+        Returns a dict with keys:
+            index: index of the current action in the spec's program
+            done: number of actions finished
+            remaining: number of actions left, including the current one
+            action: the current RSAction (None when done)
+            elapsed: hours spent so far in the current action
+            history: [(index, hours spent)...] for each finished action"""
+        return {'index': self.index, 'done': len(self.history),
+                'remaining': self.remaining(), 'action': self.action,
+                'elapsed': self.clock()/3600.0 - self.act_start,
+                'history': self.history}
+
+DRYRUN_AMBIENT  = 25.0 # Ambient temperature, deg C (as ovensim)
+DRYRUN_TAU      = 600  # Time constant of chamber temperature, seconds
+DRYRUN_MAXHOURS = 1000 # Give up on a dry run after this long
+
+class VirtualClock(object):
+    """A clock for RampCtl which only moves when told to"""
+    def __init__(self, start=0.0):
+        self.now = start
+    def __call__(self):
+        return self.now
+    def advance(self, seconds):
+        self.now += seconds
+
+class DryRunOven(object):
+    """A modelled oven, with the OvenCtl methods that RampCtl uses
+    
+    The chamber temperature follows the setpoint (or, when idle, ambient)
+    with a first-order lag of time constant tau seconds, and (optionally)
+    changes by at most max_rate deg C per hour, as in ovensim.  The model
+    is advanced to clock() whenever it is used."""
+    def __init__(self, clock, tau=DRYRUN_TAU, max_rate=None,
+                 ambient=DRYRUN_AMBIENT, temp=None):
+        self.clock = clock
+        self.tau = tau
+        self.max_rate = max_rate
+        self.ambient = ambient
+        self.temp = ambient if temp is None else temp
+        self.setpoint = self.temp
+        self.active = False
+        self.bedew_protection = False
+        self.last = clock()
+    def step(self):
+        """Advance the model to the current time"""
+        now = self.clock()
+        dt = now - self.last
+        self.last = now
+        if dt <= 0: return
+        target = self.setpoint if self.active else self.ambient
+        new = target + (self.temp - target) * math.exp(-dt/self.tau)
+        if self.max_rate is not None:
+            limit = self.max_rate * dt / 3600.0
+            new = max(self.temp - limit, min(self.temp + limit, new))
+        self.temp = new
+    def set_setpoint(self, setpoint, force=False):
+        self.step()
+        self.setpoint = setpoint
+    def set_mode_active(self, force=False):
+        self.step()
+        self.active = True
+    def set_mode_idle(self):
+        self.step()
+        self.active = False
+    def get_setpoint(self):
+        return self.setpoint
+    def get_temp(self):
+        self.step()
+        return self.temp
+
+class DryRun(object):
+    """Results of simulate
+    
+    Attributes:
+        hours: total duration of the profile, in hours
+        finished: False if the profile was still running at max_hours
+        timings: [(index in program, action, start, hours)...] for each
+         action run, times in hours from the start
+        curve: [(time, setpoint, temp, active)...] sampled at every run"""
+    def __init__(self):
+        self.hours = 0
+        self.finished = False
+        self.timings = []
+        self.curve = []
+
+def simulate(spec, oven=None, tick=RAMPCTL_SAFETY_POLL, xdur=0,
+             max_hours=DRYRUN_MAXHOURS, **model):
+    """Run spec against a DryRunOven on a VirtualClock, as fast as possible
+    
+    Parameters:
+        spec: the RampSpec to run
+        oven: the oven to run against (default a DryRunOven; other
+         keyword arguments are passed to its constructor)
+        tick: the safety poll, in seconds; RampCtl.run is called at each
+         of its deadlines, but never less often than this
+        xdur: the time each X action takes, in seconds; X never jumps
+        max_hours: stop (with DryRun.finished False) after this long
+    
+    Returns a DryRun
+    
+    Can raise: RSParseException if a jump target is missing"""
+    clock = VirtualClock()
+    if oven is None:
+        oven = DryRunOven(clock, **model)
+    def xcallback(data):
+        clock.advance(xdur)
+        return False, data
+    rc = spec.prepare(oven, xcallback, None, clock)
+    result = DryRun()
+    limit = max_hours * 3600.0
+    while clock.now < limit:
+        running = rc.run()
+        oven.step()
+        result.curve.append((clock.now/3600.0, oven.setpoint, oven.temp,
+                             oven.active))
+        if not running:
+            result.finished = True
+            break
+        clock.advance(rc.delay(tick))
+    result.hours = clock.now/3600.0
+    start = 0
+    for index, hours in rc.history:
+        result.timings.append((index, rc.program[index], start, hours))
+        start += hours
+    return result
 
 def parse_cmdline():
     parser = optparse.OptionParser()
-    parser.usage = "%prog -H hostname [-p port] -r rampspec"
+    parser.usage = "%prog -H hostname [-p port] -r rampspec\n       %prog -n -r rampspec [options]"
     parser.add_option('-H', '--host', help='host to connect to')
     parser.add_option('-p', '--port', help='TCP port to connect to',
                       default=ovenctl.BINDER_PORT)
     parser.add_option('-r', '--rampspec', type='string', 
                       help='Rampspec to follow')
+    parser.add_option('-l', '--log', type='string',
+                      help='Record telemetry to LOG (see ovenlog.py)')
+    parser.add_option('-s', '--safety-poll', type='float',
+                      default=RAMPCTL_SAFETY_POLL,
+                      help='Max. seconds between checks of the oven (default %default)')
+    parser.add_option('-n', '--dry-run', action='store_true',
+                      help="Simulate the rampspec against a model oven")
+    parser.add_option('-T', '--tau', type='float', default=DRYRUN_TAU,
+                      help='Dry run: time constant of chamber temperature (seconds)')
+    parser.add_option('-m', '--max-rate', type='float',
+                      help='Dry run: max. rate of temperature change (deg C per hour)')
+    parser.add_option('-a', '--ambient', type='float', default=DRYRUN_AMBIENT,
+                      help='Dry run: ambient temperature (deg C)')
+    parser.add_option('-x', '--xdur', type='float', default=0,
+                      help='Dry run: duration (minutes) of each X action')
+    parser.add_option('-o', '--output', type='string',
+                      help='Dry run: write the setpoint and temperature curves to OUTPUT')
     options, args = parser.parse_args()
 
-    if not options.host:
+    if not options.host and not options.dry_run:
         print "ERROR: -H/--host is required"
         sys.exit(2)
 
@@ -286,15 +746,68 @@ def parse_cmdline():
 
     return options
 
+def dry_run(options):
+    try:
+        rs=RampSpec(options.rampspec)
+        result=simulate(rs, tick=options.safety_poll, xdur=options.xdur*60,
+                        tau=options.tau, max_rate=options.max_rate,
+                        ambient=options.ambient)
+    except RSParseException as err:
+        print "ERROR: %s" % (err,)
+        sys.exit(2)
+    # Summarise per action of the program, as repeats may run many times
+    summary = {}
+    for index, action, start, hours in result.timings:
+        runs, total = summary.get(index, (0, 0))
+        summary[index] = (runs + 1, total + hours)
+    print "Index  Runs      Hours  Action"
+    for index in sorted(summary):
+        runs, total = summary[index]
+        print "%5d %5d %10.3f  %s" % (index, runs, total, rs.program[index])
+    if result.finished:
+        print "Total duration: %.3f hours" % result.hours
+    else:
+        print "Still running after %.3f hours" % result.hours
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write("# hours setpoint temp active\n")
+            for t, setpoint, temp, active in result.curve:
+                f.write("%.5f %s %.3f %d\n" % (t, setpoint, temp, active))
+
 if __name__ == '__main__':
-    import socket, ovenctl
+    import socket
     options = parse_cmdline()
-    rs=RampSpec(options.rampspec)
-    oven = ovenctl.OvenCtl(options.host, options.port)
-    rc=rs.prepare(oven)
+    if options.dry_run:
+        dry_run(options)
+        sys.exit(0)
+    oven = ovenctl.OvenCtl(options.host, options.port,
+                           cache=ovenctl.RegisterCache(),
+                           shadow=ovenctl.ShadowRegisters())
+    try:
+        rs=RampSpec(options.rampspec)
+        rc=rs.prepare(oven)
+    except RSParseException as err:
+        print "ERROR: %s" % (err,)
+        sys.exit(2)
+    log = None
+    if options.log:
+        import ovenlog
+        log = ovenlog.TelemetryLog(options.log)
     while True:
-        if rc.new_action: print "Started action: %s" % rc.actions[0]
+        if rc.new_action:
+            done = len(rc.history)
+            print "Started action: %s (%d of %d)" % (rc.action, done+1,
+                                                     done+rc.remaining())
         try:
-            if not rc.run(): break
-        except socket.error: pass
-        time.sleep(3)
+            with oven.session():
+                if log is not None:
+                    index = rc.index
+                if not rc.run(): break
+                if log is not None:
+                    log.record(oven.snapshot(ovenlog.TLOG_STATUS_FIELDS),
+                               index)
+        except socket.error:
+            # Don't hammer an oven that isn't answering
+            time.sleep(RAMPCTL_WAIT_POLL)
+            continue
+        time.sleep(rc.delay(options.safety_poll))